@@ -1,4 +1,5 @@
 import logging
+import threading
 from typing import List
 from ..models import Agv
 from ..main_algorithms.algorithm2.algorithm2 import ControlPolicy
@@ -6,9 +7,24 @@ from ..main_algorithms.algorithm3.algorithm3 import DeadlockResolver
 from ..main_algorithms.algorithm4.algorithm4 import BackupNodesAllocator
 
 from ..direction_change.direction_to_turn import determine_direction_change
+from ..dispatcher_service import get_dispatcher_service
+from ..metrics import REGISTRY, STAGE_FAILURES, stage_timer
+from ..profiling import profile_decision
+from ..rerouting import ReroutePolicy
+from ..zones import get_zone_map, is_sharded
 
 logger = logging.getLogger(__name__)
 
+DEADLOCKS_RESOLVED = REGISTRY.counter(
+    "agv_deadlocks_resolved_total",
+    "Deadlocks detected and resolved by Algorithm 3",
+    label_names=("kind",),
+)
+
+# Serializes control decisions of the threads of this process (MQTT ingest,
+# prepositioning), the default fleet state does not make reservations atomic
+decision_lock = threading.RLock()
+
 
 def _get_agv_by_id(agv_id):
     """Get AGV instance by ID."""
@@ -19,6 +35,42 @@ def _get_agv_by_id(agv_id):
         return None
 
 
+def process_agv_position_report(agv_id: int, current_node: int) -> List[Agv]:
+    """
+    Run the full DSPA pipeline for one AGV position report, independent of how the
+    report arrived (MQTT, simulator).
+
+    Args:
+        agv_id: ID of the reporting AGV
+        current_node: Node the AGV reported to be at
+
+    Returns:
+        List[Agv]: The reporting AGV followed by every other AGV whose command changed,
+        empty if the AGV does not exist
+    """
+    with decision_lock, profile_decision():
+        # The map may have been imported by another server process, whose
+        # map_data_changed signal never reaches this one
+        get_dispatcher_service().check_map_version()
+
+        this_agv = _get_agv_by_id(agv_id)
+        if not this_agv:
+            return []
+
+        # Update AGV position and path information
+        # Apply DSPA control policy to determine next action
+        with stage_timer("update_position"):
+            _update_agv_position(agv=this_agv, current_node=current_node)
+        with stage_timer("control_policy"):
+            initially_affected_agvs = _apply_control_policy(agv=this_agv)
+
+        # Check if any other AGVs were waiting for this AGV due to deadlock resolution
+        with stage_timer("deadlock_partners"):
+            partner_agvs = _trigger_deadlock_partner_control_policy(moved_agv_id=agv_id)
+
+    return [this_agv] + list(initially_affected_agvs) + list(partner_agvs)
+
+
 def _update_agv_position(agv: Agv, current_node: int):
     """Update AGV's position and path information."""
     control_policy = ControlPolicy(agv)
@@ -41,7 +93,11 @@ def _apply_control_policy(agv: Agv) -> List[Agv]:
 
     # Check if AGV can move based on basic conditions
     if control_policy.can_move_freely():
-        control_policy.set_moving_state()
+        if not control_policy.set_moving_state():
+            # Another server process reserved the nodes first, wait for the next report
+            determine_direction_change(agv)
+            return []
+
         # Clear deadlock resolution state if it was set
         if agv.waiting_for_deadlock_resolution:
             deadlock_resolver = DeadlockResolver(agv)
@@ -55,12 +111,14 @@ def _apply_control_policy(agv: Agv) -> List[Agv]:
 
     # Handle backup node scenarios
     if control_policy.should_use_backup_nodes():
-        _handle_backup_node_scenario(agv)
+        with stage_timer("backup_allocation"):
+            _handle_backup_node_scenario(agv)
         determine_direction_change(agv)
         return []
 
     # Handle waiting and deadlock scenarios
-    affected_agvs = _handle_waiting_scenario(agv)
+    with stage_timer("deadlock_resolution"):
+        affected_agvs = _handle_waiting_scenario(agv)
     determine_direction_change(agv)
     return affected_agvs
 
@@ -83,6 +141,9 @@ def _trigger_deadlock_partner_control_policy(moved_agv_id: int) -> List[Agv]:
         )
 
         for waiting_agv in waiting_agvs:
+            if is_sharded() and not get_zone_map().owns(waiting_agv.current_node):
+                # Its own shard re-runs the policy on the AGV's next report
+                continue
             logger.info(
                 f"Triggering control policy for AGV {waiting_agv.agv_id} "
                 f"after partner AGV {moved_agv_id} moved"
@@ -91,8 +152,10 @@ def _trigger_deadlock_partner_control_policy(moved_agv_id: int) -> List[Agv]:
             partner_agvs.append(waiting_agv)
             partner_agvs.extend(additional_affected_agvs)
 
-    except Exception as e:
-        logger.error(f"Error triggering deadlock partner control policy: {str(e)}")
+    except Exception:
+        # The moving AGV's own command must still go out, so only count the failure
+        STAGE_FAILURES.inc(stage="deadlock_partners")
+        logger.exception("Error triggering deadlock partner control policy")
 
     return partner_agvs
 
@@ -122,9 +185,26 @@ def _handle_waiting_scenario(agv: Agv) -> List[Agv]:
 
     deadlock_resolver = DeadlockResolver(agv)
     if deadlock_resolver.has_heading_on_deadlock():
+        DEADLOCKS_RESOLVED.inc(kind="heading_on")
         return deadlock_resolver.resolve_heading_on_deadlock()
     elif deadlock_resolver.has_loop_deadlock():
+        DEADLOCKS_RESOLVED.inc(kind="loop")
         return deadlock_resolver.resolve_loop_deadlock()
     else:
         deadlock_resolver.reserve_current_position()
+        _reroute_if_waited_too_long(agv, control_policy)
         return []
+
+
+def _reroute_if_waited_too_long(agv: Agv, control_policy: ControlPolicy) -> None:
+    """Send an AGV that waited too long for a blocked node around it."""
+    reroute_policy = ReroutePolicy(agv)
+    if not reroute_policy.should_reroute():
+        return
+    try:
+        if reroute_policy.reroute() and control_policy.can_move_freely():
+            control_policy.set_moving_state()
+    except Exception:
+        # The AGV keeps waiting on its old path
+        STAGE_FAILURES.inc(stage="reroute")
+        logger.exception(f"Error rerouting AGV {agv.agv_id}")
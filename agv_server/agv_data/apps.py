@@ -8,8 +8,29 @@ class AgvDataConfig(AppConfig):
     def ready(self):
         import os
 
+        from map_data.signals import map_data_changed
+
+        from .dispatcher_service import on_map_data_changed
+
+        # Rebuild the dispatcher and zones from the new map after imports
+        map_data_changed.connect(
+            on_map_data_changed, dispatch_uid="agv_data_map_data_changed"
+        )
+
         if os.getenv("RUN_MAIN"):
+            import atexit
+
             # Import and start MQTT client only when app is ready
             from . import mqtt
+            from .leader_election import create_leader_elector
+            from .zones import validate_sharding_settings
+
+            validate_sharding_settings()
+            mqtt.validate_downlink_settings()
 
-            mqtt.client.loop_start()
+            # Only the elected process consumes AGV reports, the others stand by
+            elector = create_leader_elector(
+                on_elected=mqtt.start_consumer, on_demoted=mqtt.stop_consumer
+            )
+            elector.start()
+            atexit.register(elector.stop)
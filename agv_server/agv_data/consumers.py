@@ -1,23 +1,135 @@
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from urllib.parse import parse_qs
 import json
 
+DELTA_PROTOCOL = "delta"
+
 
 class AgvConsumer(AsyncWebsocketConsumer):
+    """
+    Streams AGV state to the browser.
+
+    Legacy protocol (default): every change is sent as the full AGV ("agv_update").
+    Delta protocol (?protocol=delta): one "agv_snapshot" of all AGVs on connect,
+    then "agv_patch" messages with JSON-patch operations for the fields that
+    actually changed. Snapshots and patches carry a sequence number; a client that
+    sees a gap sends {"type": "resync"} and receives a new snapshot.
+    """
+
     async def connect(self):
         # Accept the WebSocket connection
         print("WebSocket connection established")
         self.room_group_name = "agv_group"
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.use_delta_protocol = DELTA_PROTOCOL in query.get("protocol", [])
+        self.sequence = 0
+        # Last state sent to this client, to drop updates that change nothing
+        self.agv_states = {}
+
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
+        await self._send_snapshot()
 
     async def disconnect(self, close_code):
         # Handle disconnection
         print(f"WebSocket connection closed with code: {close_code}")
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            request = json.loads(text_data or "{}")
+        except ValueError:
+            return
+        if request.get("type") == "resync":
+            await self._send_snapshot()
+
     async def agv_message(self, event):
         # Send AGV update message to WebSocket client
         message = event["message"]
 
         # Forward the message to the WebSocket client
         await self.send(text_data=json.dumps(message))
+
+    async def agv_delta(self, event):
+        """Send the fields of an AGV that changed since the last message to this client."""
+        agv_id = event["agv_id"]
+        state = self.agv_states.get(agv_id)
+
+        if state is None:
+            # Unknown AGV (created after the snapshot): send it whole
+            state = await self._load_agv(agv_id)
+            if state is None:
+                return
+            self.agv_states[agv_id] = state
+            await self._send_change(agv_id, [{"op": "add", "path": "", "value": state}])
+            return
+
+        changed_fields = {
+            field_name: value
+            for field_name, value in event["data"].items()
+            if field_name not in state or state[field_name] != value
+        }
+        if not changed_fields:
+            return
+
+        state.update(changed_fields)
+        await self._send_change(
+            agv_id,
+            [
+                {"op": "replace", "path": f"/{field_name}", "value": value}
+                for field_name, value in changed_fields.items()
+            ],
+        )
+
+    async def _send_change(self, agv_id, operations):
+        if not self.use_delta_protocol:
+            await self.send(
+                text_data=json.dumps(
+                    {"type": "agv_update", "data": self.agv_states[agv_id]}
+                )
+            )
+            return
+
+        self.sequence += 1
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "type": "agv_patch",
+                    "seq": self.sequence,
+                    "agv_id": agv_id,
+                    "ops": operations,
+                }
+            )
+        )
+
+    async def _send_snapshot(self):
+        agvs = await self._load_agvs()
+        self.agv_states = {agv["agv_id"]: agv for agv in agvs}
+        if not self.use_delta_protocol:
+            return
+
+        self.sequence += 1
+        await self.send(
+            text_data=json.dumps(
+                {"type": "agv_snapshot", "seq": self.sequence, "data": agvs}
+            )
+        )
+
+    @database_sync_to_async
+    def _load_agvs(self):
+        from .models import Agv
+        from .serializers import AGVSerializer
+
+        agvs = Agv.objects.select_related("active_order")
+        return [dict(agv) for agv in AGVSerializer(agvs, many=True).data]
+
+    @database_sync_to_async
+    def _load_agv(self, agv_id):
+        from .models import Agv
+        from .serializers import AGVSerializer
+
+        agv = Agv.objects.select_related("active_order").filter(agv_id=agv_id).first()
+        if agv is None:
+            return None
+        return dict(AGVSerializer(agv).data)
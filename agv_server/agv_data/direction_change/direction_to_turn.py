@@ -69,30 +69,44 @@ def get_action(previous_node, current_node, reserved_node):
         current_node, reserved_node
     )
 
-    if (
-        direction_from_previous_node_to_current_node is None
-        or direction_from_current_node_to_reserved_node is None
-    ):
+    return get_action_between_directions(
+        direction_from_previous_node_to_current_node,
+        direction_from_current_node_to_reserved_node,
+    )
+
+
+# Maps to determine action based on direction transitions
+# Format: {current_direction: {next_direction: action}}
+DIRECTION_ACTIONS = {
+    NORTH: {EAST: TURN_RIGHT, WEST: TURN_LEFT, SOUTH: TURN_AROUND},
+    EAST: {SOUTH: TURN_RIGHT, NORTH: TURN_LEFT, WEST: TURN_AROUND},
+    SOUTH: {WEST: TURN_RIGHT, EAST: TURN_LEFT, NORTH: TURN_AROUND},
+    WEST: {NORTH: TURN_RIGHT, SOUTH: TURN_LEFT, EAST: TURN_AROUND},
+}
+
+
+def get_action_between_directions(incoming_direction, outgoing_direction):
+    """
+    Determine the action at a node from the direction the AGV arrives in and the
+    direction it leaves in.
+
+    Args:
+        incoming_direction (int): Cardinal direction of the previous edge, or None
+        outgoing_direction (int): Cardinal direction of the next edge, or None
+
+    Returns:
+        int: GO_STRAIGHT, TURN_RIGHT, TURN_LEFT or TURN_AROUND. GO_STRAIGHT if
+             a direction is unknown.
+    """
+    if incoming_direction is None or outgoing_direction is None:
         return GO_STRAIGHT  # Default to GO_STRAIGHT if direction data is missing
 
-    if (
-        direction_from_previous_node_to_current_node
-        == direction_from_current_node_to_reserved_node
-    ):
+    if incoming_direction == outgoing_direction:
         return GO_STRAIGHT  # No direction change
 
-    # Maps to determine action based on direction transitions
-    # Format: {current_direction: {next_direction: action}}
-    direction_actions = {
-        NORTH: {EAST: TURN_RIGHT, WEST: TURN_LEFT, SOUTH: TURN_AROUND},
-        EAST: {SOUTH: TURN_RIGHT, NORTH: TURN_LEFT, WEST: TURN_AROUND},
-        SOUTH: {WEST: TURN_RIGHT, EAST: TURN_LEFT, NORTH: TURN_AROUND},
-        WEST: {NORTH: TURN_RIGHT, SOUTH: TURN_LEFT, EAST: TURN_AROUND},
-    }
-
     # Get the action from the direction maps, default to GO_STRAIGHT if not found
-    return direction_actions.get(direction_from_previous_node_to_current_node, {}).get(
-        direction_from_current_node_to_reserved_node, GO_STRAIGHT
+    return DIRECTION_ACTIONS.get(incoming_direction, {}).get(
+        outgoing_direction, GO_STRAIGHT
     )
 
 
@@ -0,0 +1,186 @@
+"""
+Process-wide task dispatcher.
+
+Building a TaskDispatcher loads every Direction and Connection row, builds the
+adjacency map of the common nodes calculator and, on first use, the pathfinding
+engines. The service keeps one dispatcher per process for all requests and
+scheduled jobs, rebuilds it when the map changes, and runs the single scheduler
+thread that assigns scheduled orders.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import schedule
+from django.conf import settings
+from django.db.models import Count, Max
+
+from map_data.models import Connection, Direction
+
+from .fleet_state import get_fleet_state
+from .main_algorithms.algorithm1.algorithm1 import TaskDispatcher
+from .main_algorithms.algorithm1.common_nodes import (
+    coalesce_common_nodes_recalculation,
+    reset_common_nodes_calculator,
+)
+from .rerouting import reset_planners
+from .zones import reset_zone_map
+
+logger = logging.getLogger(__name__)
+
+
+def _get_map_version() -> Tuple:
+    """
+    Get a cheap fingerprint of the map rows. Imports replace all rows, so the count
+    and highest id change, also for imports made by another server process, which
+    the map_data_changed signal does not reach.
+    """
+    connections = Connection.objects.aggregate(count=Count("id"), last_id=Max("id"))
+    directions = Direction.objects.aggregate(count=Count("id"), last_id=Max("id"))
+    return (
+        connections["count"],
+        connections["last_id"],
+        directions["count"],
+        directions["last_id"],
+    )
+
+
+class DispatcherService:
+    """Holds the process's TaskDispatcher and its scheduler thread."""
+
+    def __init__(self):
+        self._dispatcher: Optional[TaskDispatcher] = None
+        self._map_version: Optional[Tuple] = None
+        self._map_checked_at = 0.0
+        self._lock = threading.RLock()
+        self._scheduler_thread: Optional[threading.Thread] = None
+        self._scheduler_running = False
+
+    def get_dispatcher(self) -> TaskDispatcher:
+        """
+        Get the dispatcher of the current map, built on first use and after the map
+        changed.
+
+        Returns:
+            TaskDispatcher: The shared dispatcher
+
+        Raises:
+            ValueError: If map data is incomplete or missing
+        """
+        self.check_map_version()
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = TaskDispatcher()
+                logger.info("Built task dispatcher for the current map")
+            return self._dispatcher
+
+    def check_map_version(self) -> None:
+        """
+        Drop the dispatcher and every cache derived from the map (common nodes
+        calculator, rerouting planners, zone map) if the map rows changed, also when
+        another server process imported the map. The rows are only checked once per
+        MAP_VERSION_CHECK_SECONDS, and not while holding the lock.
+        """
+        now = time.monotonic()
+        if (
+            self._map_version is not None
+            and now - self._map_checked_at < settings.MAP_VERSION_CHECK_SECONDS
+        ):
+            return
+
+        map_version = _get_map_version()
+        with self._lock:
+            self._map_checked_at = now
+            if map_version == self._map_version:
+                return
+            if self._map_version is not None:
+                logger.info("Map changed, dropping the caches built from the old map")
+            self._dispatcher = None
+            self._map_version = map_version
+            reset_map_caches()
+
+    def get_alternative_paths(self, start: int, end: int) -> List[List[int]]:
+        """
+        Get the precomputed k shortest paths between two nodes of the current map,
+        shortest first. Empty if ALTERNATIVE_PATHS_K is below 2.
+        """
+        alternative_paths = self.get_dispatcher().get_alternative_paths()
+        if alternative_paths is None:
+            return []
+        return alternative_paths.get_paths(start, end)
+
+    def invalidate(self) -> None:
+        """Drop the dispatcher, the next get_dispatcher() builds it from the new map."""
+        with self._lock:
+            self._dispatcher = None
+            self._map_version = None
+
+    def assign_scheduled_order(self, order_id: int, algorithm: str) -> bool:
+        """Assign an order whose scheduled start time has come."""
+        try:
+            return self.get_dispatcher().assign_single_order(order_id, algorithm)
+        except ValueError as e:
+            logger.error(f"Error assigning scheduled order {order_id}: {str(e)}")
+            return False
+
+    # === Scheduler ===
+
+    def start_scheduler_if_needed(self, scheduled_orders: List[Dict]) -> None:
+        """
+        Start the scheduler thread if there are scheduled orders and it's not already running.
+
+        Args:
+            scheduled_orders: List of scheduled orders
+        """
+        with self._lock:
+            if not scheduled_orders:
+                return
+            if self._scheduler_thread and self._scheduler_thread.is_alive():
+                # Reuse existing thread
+                return
+            self._scheduler_running = True
+            self._scheduler_thread = threading.Thread(
+                target=self._run_scheduler,
+                daemon=True,
+                name="task_dispatcher_scheduler_thread",
+            )
+            self._scheduler_thread.start()
+
+    def stop_scheduler(self) -> None:
+        """Stop the scheduler thread after its current round."""
+        self._scheduler_running = False
+
+    def _run_scheduler(self) -> None:
+        """Run the scheduler in a background thread"""
+        fleet_state = get_fleet_state()
+        while self._scheduler_running:
+            # Orders due in the same tick share one common nodes recalculation
+            with coalesce_common_nodes_recalculation():
+                schedule.run_pending()
+                for order_id, algorithm in fleet_state.pop_due_orders():
+                    self.assign_scheduled_order(order_id, algorithm)
+            time.sleep(1)
+        logger.info("Task dispatcher scheduler thread stopped")
+
+
+_dispatcher_service = DispatcherService()
+
+
+def get_dispatcher_service() -> DispatcherService:
+    """Get the process-wide dispatcher service."""
+    return _dispatcher_service
+
+
+def reset_map_caches() -> None:
+    """Drop the process-wide caches that are built from the map on first use."""
+    reset_common_nodes_calculator()
+    reset_planners()
+    reset_zone_map()
+
+
+def on_map_data_changed(sender, **kwargs) -> None:
+    """Refresh everything derived from the map after it was imported or deleted."""
+    _dispatcher_service.invalidate()
+    reset_map_caches()
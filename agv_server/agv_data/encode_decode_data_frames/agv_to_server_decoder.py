@@ -1,4 +1,20 @@
 import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from .calculate_crc import calculate_crc
+from .frame_format import (
+    BATCH_HEADER_LENGTH,
+    BATCH_TRAILER_LENGTH,
+    BATCH_UPLINK_MESSAGE_TYPE,
+    FLAG_SEQUENCE_NUMBER,
+    FRAME_END,
+    FRAME_START,
+    PROTOCOL_VERSION,
+    SEQUENCE_NUMBER_MODULO,
+    UPLINK_RECORD_LENGTH,
+)
+from ..metrics import REGISTRY
 
 """
 Decoder for messages received from AGVs via MQTT.
@@ -89,6 +105,43 @@ def example_frame_from_agv_to_server() -> bytes:
     return bytes(frame)
 
 
+def example_batch_frame_from_agv_to_server(reports: List[Dict]) -> bytes:
+    """
+    Generate a version 2 frame carrying the given position reports.
+    Note: This is for testing purposes only, AGVs build these frames themselves.
+
+    Args:
+        reports (List[Dict]): Reports with agv_id, current_node and optionally sequence
+
+    Returns:
+        bytes: The encoded frame
+    """
+    with_sequence = any(report.get("sequence") is not None for report in reports)
+
+    body = bytearray()
+    body.append(FLAG_SEQUENCE_NUMBER if with_sequence else 0)
+    body.append(len(reports))
+    for report in reports:
+        body.extend(report["agv_id"].to_bytes(2, byteorder="little"))
+        body.extend(report["current_node"].to_bytes(2, byteorder="little"))
+        if with_sequence:
+            body.extend((report.get("sequence") or 0).to_bytes(2, byteorder="little"))
+
+    data_for_crc = bytearray()
+    data_for_crc.append(BATCH_UPLINK_MESSAGE_TYPE)
+    data_for_crc.append(PROTOCOL_VERSION)
+    data_for_crc.extend(len(body).to_bytes(2, byteorder="little"))
+    data_for_crc.extend(body)
+
+    frame = bytearray()
+    frame.append(FRAME_START)
+    frame.extend(data_for_crc)
+    frame.append(calculate_crc(data_for_crc))
+    frame.append(FRAME_END)
+
+    return bytes(frame)
+
+
 def validate_frame(data: bytearray) -> bool:
     """
     Validate the received data frame format and verify CRC for data integrity.
@@ -129,6 +182,232 @@ def validate_frame(data: bytearray) -> bool:
     return True
 
 
+def is_batch_frame(data: bytearray) -> bool:
+    """Check if the frame uses the version 2 (batched) layout."""
+    return (
+        len(data) > 2
+        and data[0] == FRAME_START
+        and data[1] == BATCH_UPLINK_MESSAGE_TYPE
+    )
+
+
+def decode_batch_message(payload: bytes) -> List[Dict]:
+    """
+    Decode a version 2 frame carrying one or more AGV position reports.
+
+    Args:
+        payload (bytes): Raw byte array received from MQTT broker
+
+    Returns:
+        List[Dict]: Decoded reports with agv_id, current_node and, if the frame
+        carries sequence numbers, sequence
+
+    Raises:
+        ValueError: If message format is invalid
+    """
+    try:
+        data = bytearray(payload)
+        if len(data) < BATCH_HEADER_LENGTH + 2 + BATCH_TRAILER_LENGTH:
+            raise ValueError("Frame too short")
+
+        if data[0] != FRAME_START or data[-1] != FRAME_END:
+            raise ValueError("Invalid frame markers")
+
+        if data[1] != BATCH_UPLINK_MESSAGE_TYPE:
+            raise ValueError(f"Unexpected message type {data[1]:#04x}")
+
+        if data[2] != PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported protocol version {data[2]}")
+
+        body_length = int.from_bytes(data[3:5], byteorder="little")
+        if len(data) != BATCH_HEADER_LENGTH + body_length + BATCH_TRAILER_LENGTH:
+            raise ValueError("Body length does not match frame length")
+
+        # A CRC computed over data followed by its own CRC leaves a zero remainder
+        if calculate_crc(data[1:-1]) != 0:
+            raise ValueError("CRC check failed")
+
+        body = data[BATCH_HEADER_LENGTH : BATCH_HEADER_LENGTH + body_length]
+        field_flags, record_count = body[0], body[1]
+        record_length = UPLINK_RECORD_LENGTH
+        if field_flags & FLAG_SEQUENCE_NUMBER:
+            record_length += 2
+
+        if len(body) != 2 + record_count * record_length:
+            raise ValueError("Record count does not match body length")
+
+        reports = []
+        for index in range(record_count):
+            offset = 2 + index * record_length
+            record = body[offset : offset + record_length]
+            report = {
+                "agv_id": int.from_bytes(record[0:2], byteorder="little"),
+                "current_node": int.from_bytes(record[2:4], byteorder="little"),
+            }
+            if field_flags & FLAG_SEQUENCE_NUMBER:
+                report["sequence"] = int.from_bytes(record[4:6], byteorder="little")
+            reports.append(report)
+
+        return reports
+
+    except Exception as e:
+        raise ValueError(f"Failed to decode batch message: {str(e)}")
+
+
+FRAMES_DROPPED = REGISTRY.counter(
+    "agv_frames_dropped_total",
+    "AGV position reports discarded before processing",
+    label_names=("reason",),
+)
+
+
+def is_sequence_newer(sequence: int, reference: int) -> bool:
+    """
+    Compare two 16 bit sequence numbers using serial number arithmetic (RFC 1982),
+    so the comparison stays correct when the counter wraps around.
+
+    Returns:
+        bool: True if sequence was sent after reference
+    """
+    difference = (sequence - reference) % SEQUENCE_NUMBER_MODULO
+    return 0 < difference < SEQUENCE_NUMBER_MODULO // 2
+
+
+class SequenceTracker:
+    """
+    Remembers the last accepted sequence number of every AGV to discard duplicated
+    (QoS redelivery) and out-of-order (reconnect burst) position reports.
+
+    Tracking of an AGV starts over when it has not reported for reset_after seconds,
+    when it sends sequence number 0 (the first report after a restart) or when
+    reset() is called for it.
+
+    Version 1 frames and version 2 frames without sequence numbers carry nothing to
+    order reports by. For those, a report of the node of the AGV's last accepted
+    report within duplicate_window seconds is dropped as a redelivery; out-of-order reports are
+    only detected with sequence numbers, which need version 2 firmware.
+    """
+
+    def __init__(self, reset_after: float = 30.0, duplicate_window: float = 2.0):
+        self.reset_after = reset_after
+        self.duplicate_window = duplicate_window
+        self._last_sequences: Dict[int, Tuple[int, float]] = {}
+        self._last_positions: Dict[int, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def accept(
+        self,
+        agv_id: int,
+        sequence: Optional[int],
+        now: Optional[float] = None,
+        current_node: Optional[int] = None,
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Check a report and remember its sequence number if it is accepted.
+
+        Args:
+            agv_id (int): The AGV that sent the report
+            sequence (Optional[int]): The report's sequence number, None if the frame has none
+            now (Optional[float]): Current monotonic time, for testing
+            current_node (Optional[int]): The reported node, used to detect
+                redelivered reports without a sequence number
+
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the report is accepted and, if not,
+            the reason ("duplicate" or "stale")
+        """
+        now = time.monotonic() if now is None else now
+        if sequence is None:
+            return self._accept_unsequenced(agv_id, current_node, now)
+
+        with self._lock:
+            last = self._last_sequences.get(agv_id)
+            if last is not None and now - last[1] <= self.reset_after:
+                last_sequence = last[0]
+                if sequence == last_sequence:
+                    return False, "duplicate"
+                if sequence != 0 and not is_sequence_newer(sequence, last_sequence):
+                    return False, "stale"
+
+            self._last_sequences[agv_id] = (sequence, now)
+            return True, None
+
+    def _accept_unsequenced(
+        self, agv_id: int, current_node: Optional[int], now: float
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Drop a report without sequence number that repeats the node of the last
+        accepted report within duplicate_window seconds. Dropped reports do not
+        extend the window, so an AGV that keeps reporting its node while it waits
+        still gets a decision every duplicate_window seconds.
+        """
+        if current_node is None or self.duplicate_window <= 0:
+            return True, None
+
+        with self._lock:
+            last = self._last_positions.get(agv_id)
+            if (
+                last is not None
+                and last[0] == current_node
+                and now - last[1] <= self.duplicate_window
+            ):
+                return False, "duplicate"
+            self._last_positions[agv_id] = (current_node, now)
+            return True, None
+
+    def reset(self, agv_id: int) -> None:
+        """Forget the sequence number of an AGV, e.g. after it announced a restart."""
+        with self._lock:
+            self._last_sequences.pop(agv_id, None)
+            self._last_positions.pop(agv_id, None)
+
+    def reset_all(self) -> None:
+        """Forget the sequence numbers of all AGVs, e.g. after taking over as leader."""
+        with self._lock:
+            self._last_sequences.clear()
+            self._last_positions.clear()
+
+
+def decode_messages(
+    payload: bytes, sequence_tracker: Optional[SequenceTracker] = None
+) -> List[Dict]:
+    """
+    Decode a message from AGVs in either frame version into a list of reports.
+
+    Args:
+        payload (bytes): Raw byte array received from MQTT broker
+        sequence_tracker (Optional[SequenceTracker]): If given, duplicated and
+            out-of-order reports are dropped and counted (reports without sequence
+            number only when they repeat the last reported node)
+
+    Returns:
+        List[Dict]: Decoded reports, a version 1 frame always yields exactly one
+
+    Raises:
+        ValueError: If message format is invalid
+    """
+    if is_batch_frame(bytearray(payload)):
+        reports = decode_batch_message(payload)
+    else:
+        reports = [decode_message(payload)]
+
+    if sequence_tracker is None:
+        return reports
+
+    accepted_reports = []
+    for report in reports:
+        accepted, reason = sequence_tracker.accept(
+            report["agv_id"],
+            report.get("sequence"),
+            current_node=report["current_node"],
+        )
+        if accepted:
+            accepted_reports.append(report)
+        else:
+            FRAMES_DROPPED.inc(reason=reason)
+    return accepted_reports
+
+
 def decode_message(payload: bytes) -> dict:
     """
     Decode byte array message from AGV into JSON format.
@@ -145,6 +424,13 @@ def decode_message(payload: bytes) -> dict:
     try:
         data = bytearray(payload)
 
+        if is_batch_frame(data):
+            # Version 2 frames with a single report are accepted here as well
+            reports = decode_batch_message(payload)
+            if len(reports) != 1:
+                raise ValueError("Batch frame carries more than one report")
+            return reports[0]
+
         if not validate_frame(data):
             # Extract payload data using little-endian byte order
             raise ValueError("Invalid frame format")
@@ -0,0 +1,47 @@
+"""
+Shared layout constants of the data frames exchanged between the server and AGVs.
+
+Version 1 (legacy) frames have a fixed layout per message type:
+    FRAME_START | FRAME_LENGTH | MESSAGE_TYPE | payload | CRC | FRAME_END
+
+Version 2 frames have a variable-length body that carries one or more records,
+so several AGVs can be addressed with a single publish:
+    FRAME_START | MESSAGE_TYPE | PROTOCOL_VERSION | BODY_LENGTH (2) | body | CRC | FRAME_END
+    body = FIELD_FLAGS | RECORD_COUNT | records
+
+The byte following FRAME_START tells both versions apart: it is the frame length
+(0x09 or 0x0A) for version 1 frames and a version 2 message type otherwise.
+The CRC always covers every byte between FRAME_START and the CRC itself.
+"""
+
+FRAME_START = 0x7A
+FRAME_END = 0x7F
+
+# Version 1 message types
+LEGACY_UPLINK_MESSAGE_TYPE = 0x02  # AGV to server: position report
+LEGACY_DOWNLINK_MESSAGE_TYPE = 0x03  # Server to AGV: motion command
+
+# Version 2 message types
+BATCH_UPLINK_MESSAGE_TYPE = 0x12  # AGV to server: one or more position reports
+BATCH_DOWNLINK_MESSAGE_TYPE = 0x13  # Server to AGV: one or more motion commands
+
+PROTOCOL_VERSION = 0x02
+
+# Optional record fields, announced once per frame in FIELD_FLAGS
+FLAG_RESERVATION_HORIZON = 0x01  # Downlink: 1 byte reservation horizon
+FLAG_SEQUENCE_NUMBER = 0x02  # Both directions: 2 byte sequence number
+
+# FRAME_START + MESSAGE_TYPE + PROTOCOL_VERSION + BODY_LENGTH (2)
+BATCH_HEADER_LENGTH = 5
+# CRC + FRAME_END
+BATCH_TRAILER_LENGTH = 2
+# RECORD_COUNT is a single byte
+MAX_RECORDS_PER_FRAME = 0xFF
+# RESERVATION_HORIZON is a single byte in both versions
+MAX_RESERVATION_HORIZON = 0xFF
+
+# Fixed part of the records
+UPLINK_RECORD_LENGTH = 4  # AGV_ID (2) + CURRENT_NODE (2)
+DOWNLINK_RECORD_LENGTH = 6  # AGV_ID (2) + MOTION_STATE + RESERVED_NODE (2) + DIRECTION
+
+SEQUENCE_NUMBER_MODULO = 0x10000
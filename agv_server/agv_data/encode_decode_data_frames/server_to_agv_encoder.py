@@ -1,4 +1,13 @@
+from typing import Dict, List
 from .calculate_crc import calculate_crc
+from .frame_format import (
+    BATCH_DOWNLINK_MESSAGE_TYPE,
+    FLAG_RESERVATION_HORIZON,
+    FLAG_SEQUENCE_NUMBER,
+    MAX_RECORDS_PER_FRAME,
+    PROTOCOL_VERSION,
+    SEQUENCE_NUMBER_MODULO,
+)
 
 """
 Encoder for messages sent from server to AGVs via MQTT.
@@ -8,12 +17,17 @@ Converts JSON format instructions into byte array messages.
 FRAME_START = 0x7A
 # Include frame start, frame length, frame end, CRC, and all other fields
 FRAME_LENGTH = 0x09
+# Frame length when the reservation horizon byte is appended after direction_change
+FRAME_LENGTH_WITH_HORIZON = 0x0A
 MESSAGE_TYPE = 0x03
 FRAME_END = 0x7F
 
 
 def encode_message(
-    motion_state: int, reserved_node: int, direction_change: int
+    motion_state: int,
+    reserved_node: int,
+    direction_change: int,
+    reservation_horizon: int = 1,
 ) -> bytes:
     """
     Encode server message into byte array format.
@@ -24,6 +38,10 @@ def encode_message(
         direction_change (int): Direction change instruction
                               (0=GO_STRAIGHT, 1=TURN_AROUND,
                                2=TURN_LEFT, 3=TURN_RIGHT)
+        reservation_horizon (int): Number of consecutive nodes reserved for the AGV,
+                              starting with reserved_node. The AGV may keep moving through
+                              them without waiting for the server. A horizon of 1 produces
+                              the original 9-byte frame, larger horizons add one byte.
 
     Returns:
         bytes: Encoded message as byte array
@@ -38,14 +56,17 @@ def encode_message(
         reserved_node_value = reserved_node if reserved_node is not None else 0
         reserved_node_bytes = reserved_node_value.to_bytes(2, byteorder="little")
         direction_change_bytes = direction_change.to_bytes(1, byteorder="little")
+        has_horizon = reservation_horizon > 1
 
         # Prepare data for CRC calculation (without CRC field itself)
         data_for_crc = bytearray()
-        data_for_crc.append(FRAME_LENGTH)
+        data_for_crc.append(FRAME_LENGTH_WITH_HORIZON if has_horizon else FRAME_LENGTH)
         data_for_crc.append(MESSAGE_TYPE)
         data_for_crc.extend(motion_state_bytes)
         data_for_crc.extend(reserved_node_bytes)
         data_for_crc.extend(direction_change_bytes)
+        if has_horizon:
+            data_for_crc.extend(reservation_horizon.to_bytes(1, byteorder="little"))
 
         crc = calculate_crc(data_for_crc)
         crc_bytes = crc.to_bytes(1, byteorder="little")
@@ -63,3 +84,78 @@ def encode_message(
 
     except Exception as e:
         raise ValueError(f"Failed to encode message: {str(e)}")
+
+
+def encode_batch_message(commands: List[Dict]) -> bytes:
+    """
+    Encode one or more AGV commands into a single version 2 frame.
+
+    Each command is a dict with agv_id, motion_state, reserved_node and direction_change,
+    and optionally reservation_horizon and sequence. The optional fields are announced
+    in the frame's field flags and are then present in every record of the frame.
+
+    Args:
+        commands (List[Dict]): Commands to encode, at most 255 per frame
+
+    Returns:
+        bytes: Encoded message as byte array
+
+    Raises:
+        ValueError: If input parameters are invalid
+    """
+    try:
+        if not commands:
+            raise ValueError("At least one command is required")
+        if len(commands) > MAX_RECORDS_PER_FRAME:
+            raise ValueError(
+                f"At most {MAX_RECORDS_PER_FRAME} commands fit in one frame"
+            )
+
+        field_flags = 0
+        if any(command.get("reservation_horizon", 1) > 1 for command in commands):
+            field_flags |= FLAG_RESERVATION_HORIZON
+        if any(command.get("sequence") is not None for command in commands):
+            field_flags |= FLAG_SEQUENCE_NUMBER
+
+        body = bytearray()
+        body.append(field_flags)
+        body.append(len(commands))
+        for command in commands:
+            reserved_node = command.get("reserved_node")
+            body.extend(command["agv_id"].to_bytes(2, byteorder="little"))
+            body.extend(command["motion_state"].to_bytes(1, byteorder="little"))
+            body.extend(
+                (reserved_node if reserved_node is not None else 0).to_bytes(
+                    2, byteorder="little"
+                )
+            )
+            body.extend(command["direction_change"].to_bytes(1, byteorder="little"))
+            if field_flags & FLAG_RESERVATION_HORIZON:
+                body.extend(
+                    command.get("reservation_horizon", 1).to_bytes(
+                        1, byteorder="little"
+                    )
+                )
+            if field_flags & FLAG_SEQUENCE_NUMBER:
+                sequence = (command.get("sequence") or 0) % SEQUENCE_NUMBER_MODULO
+                body.extend(sequence.to_bytes(2, byteorder="little"))
+
+        # Prepare data for CRC calculation (without frame markers and CRC field)
+        data_for_crc = bytearray()
+        data_for_crc.append(BATCH_DOWNLINK_MESSAGE_TYPE)
+        data_for_crc.append(PROTOCOL_VERSION)
+        data_for_crc.extend(len(body).to_bytes(2, byteorder="little"))
+        data_for_crc.extend(body)
+
+        crc = calculate_crc(data_for_crc)
+
+        frame = bytearray()
+        frame.append(FRAME_START)
+        frame.extend(data_for_crc)
+        frame.append(crc)
+        frame.append(FRAME_END)
+
+        return bytes(frame)
+
+    except Exception as e:
+        raise ValueError(f"Failed to encode batch message: {str(e)}")
@@ -0,0 +1,516 @@
+"""
+Headless discrete-event fleet simulator.
+
+Drives the same DSPA pipeline that handles MQTT position reports
+(process_agv_position_report) in-process, without a broker, so changes to
+Algorithms 1-4 can be benchmarked on synthetic fleets. Simulated AGVs drive to
+the node they were told to reserve, report their position on arrival and re-report
+their position periodically while they are told to wait.
+
+The simulator writes to the configured database, run it against a throwaway
+database (see the simulate_fleet management command).
+"""
+
+import contextlib
+import datetime
+import heapq
+import itertools
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from map_data.constants import MapConstants
+from map_data.models import Connection, Direction
+from map_data.services.map_service import MapService
+from order_data.models import Order
+
+from .apply_main_algorithms.apply_main_algorithms import (
+    DEADLOCKS_RESOLVED,
+    process_agv_position_report,
+)
+from .models import Agv
+from .prepositioning import REPOSITIONS, Prepositioner
+from .rerouting import REROUTES, set_clock
+
+# Event kinds, ordered so that simultaneous events are processed deterministically
+ORDER_ARRIVAL = 0
+AGV_REPORT = 1
+PREPOSITION = 2
+
+
+@contextlib.contextmanager
+def simulation_database():
+    """
+    Run the enclosed code against a throwaway test database that is destroyed
+    afterwards. WebSocket broadcasts go to an in-memory channel layer, so no Redis
+    is needed.
+    """
+    old_database_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+    try:
+        with override_settings(
+            CHANNEL_LAYERS={
+                "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+            }
+        ):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+def build_grid_map(rows: int, cols: int, distance: int = 1) -> Tuple[str, str]:
+    """
+    Generate a rectangular grid map in the CSV matrix format used by map imports.
+    Node 1 is the south-west corner, node numbers grow eastwards then northwards.
+
+    Args:
+        rows: Number of node rows
+        cols: Number of node columns
+        distance: Distance between neighbouring nodes
+
+    Returns:
+        Tuple[str, str]: Connection-and-distance CSV and direction CSV
+    """
+    node_count = rows * cols
+    no_connection = str(MapConstants.NO_CONNECTION)
+    connection_rows = []
+    direction_rows = []
+
+    for index in range(node_count):
+        row, col = divmod(index, cols)
+        connection_row = [no_connection] * node_count
+        direction_row = [no_connection] * node_count
+        connection_row[index] = "0"
+        direction_row[index] = "0"
+
+        neighbours = [
+            (row + 1, col, Direction.NORTH),
+            (row, col + 1, Direction.EAST),
+            (row - 1, col, Direction.SOUTH),
+            (row, col - 1, Direction.WEST),
+        ]
+        for neighbour_row, neighbour_col, direction in neighbours:
+            if 0 <= neighbour_row < rows and 0 <= neighbour_col < cols:
+                neighbour_index = neighbour_row * cols + neighbour_col
+                connection_row[neighbour_index] = str(distance)
+                direction_row[neighbour_index] = str(direction)
+
+        connection_rows.append(",".join(connection_row))
+        direction_rows.append(",".join(direction_row))
+
+    return "\n".join(connection_rows), "\n".join(direction_rows)
+
+
+class FleetSimulator:
+    """
+    Discrete-event simulation of a fleet of AGVs executing synthetic orders.
+
+    Simulated time advances from event to event, so results only depend on the seed
+    and the algorithms under test, not on how fast the host is. Decision latency is
+    the wall-clock time the server-side pipeline takes for each position report.
+    """
+
+    def __init__(
+        self,
+        agv_count: int,
+        order_count: int,
+        seed: int = 0,
+        algorithm: str = "dijkstra",
+        speed: float = 1.0,
+        order_interval: float = 10.0,
+        wait_poll_interval: float = 1.0,
+        stall_timeout: float = 300.0,
+        max_simulated_seconds: float = 86400.0,
+        staging_node_count: int = 0,
+    ):
+        """
+        Args:
+            agv_count: Number of synthetic AGVs
+            order_count: Number of synthetic orders
+            seed: Seed for every random choice of the simulation
+            algorithm: Pathfinding algorithm used by the task dispatcher
+            speed: Distance units an AGV travels per simulated second
+            order_interval: Mean simulated seconds between two order arrivals
+            wait_poll_interval: Simulated seconds between position reports of waiting AGVs
+            stall_timeout: Simulated seconds without any AGV moving after which the
+                fleet is considered deadlocked and the simulation stops
+            max_simulated_seconds: Upper bound of simulated time
+            staging_node_count: Number of nodes kept free of orders for idle AGVs to
+                wait on when PREPOSITIONING is enabled
+        """
+        self.agv_count = agv_count
+        self.order_count = order_count
+        self.random = random.Random(seed)
+        self.algorithm = algorithm
+        self.speed = speed
+        self.order_interval = order_interval
+        self.wait_poll_interval = wait_poll_interval
+        self.stall_timeout = stall_timeout
+        self.max_simulated_seconds = max_simulated_seconds
+        self.staging_node_count = staging_node_count
+
+        self.distances: Dict[Tuple[int, int], float] = {}
+        self.task_dispatcher = None
+        self.staging_nodes: List[int] = []
+
+        self._events: List[Tuple[float, int, int, int, Optional[int]]] = []
+        self._event_counter = itertools.count()
+        self._now = 0.0
+
+        self._in_flight: Dict[int, int] = {}
+        self._poll_pending: set = set()
+        self._waiting_since: Dict[int, float] = {}
+        self._assigned_orders: Dict[int, int] = {}
+        self._pending_orders: List[int] = []
+        self._order_arrivals: Dict[int, Tuple[float, int]] = {}
+        self._repositioning: set = set()
+        self._last_progress = 0.0
+
+        self.decision_latencies: List[float] = []
+        self.total_wait_seconds = 0.0
+        self.orders_completed = 0
+        self.pickup_seconds: List[float] = []
+        self.stalled_agvs: List[int] = []
+
+    # === Setup ===
+
+    def load_map(self, connections_csv: str, directions_csv: str) -> None:
+        """Import a map from CSV matrices, replacing any existing map."""
+        for response in (
+            MapService.import_connections(connections_csv),
+            MapService.import_directions(directions_csv),
+        ):
+            if not response["success"]:
+                raise ValueError(response["message"])
+
+    def setup_fleet(self) -> None:
+        """Create the synthetic AGVs and orders and schedule the order arrivals."""
+        from .main_algorithms.algorithm1.algorithm1 import TaskDispatcher
+
+        self.distances = {
+            (connection["node1"], connection["node2"]): connection["distance"]
+            for connection in Connection.objects.values("node1", "node2", "distance")
+        }
+        nodes = sorted(Direction.objects.values_list("node1", flat=True).distinct())
+        if len(nodes) < 3:
+            raise ValueError("The map needs at least 3 nodes to simulate orders")
+
+        # Spread parking nodes over the map, several AGVs share one only if needed
+        shuffled_nodes = list(nodes)
+        self.random.shuffle(shuffled_nodes)
+        parking_nodes = [
+            shuffled_nodes[index % len(shuffled_nodes)]
+            for index in range(self.agv_count)
+        ]
+        for agv_id, parking_node in enumerate(parking_nodes, start=1):
+            Agv.objects.create(
+                agv_id=agv_id,
+                preferred_parking_node=parking_node,
+                current_node=parking_node,
+            )
+
+        # Staging nodes come from the nodes left after parking, orders avoid them
+        free_nodes = shuffled_nodes[len(set(parking_nodes)) :]
+        self.staging_nodes = free_nodes[: self.staging_node_count]
+        task_nodes = [
+            node
+            for node in nodes
+            if node not in set(parking_nodes) and node not in set(self.staging_nodes)
+        ]
+        if len(task_nodes) < 2:
+            task_nodes = nodes
+
+        arrival_time = 0.0
+        for order_id in range(1, self.order_count + 1):
+            arrival_time += self.random.expovariate(1 / self.order_interval)
+            storage_node, workstation_node = self.random.sample(task_nodes, 2)
+            # Orders are due at their arrival, so recent demand can be read from them
+            due_at = self._get_epoch() + datetime.timedelta(seconds=arrival_time)
+            Order.objects.create(
+                order_id=order_id,
+                order_date=due_at.date(),
+                start_time=due_at.time(),
+                parking_node=self.random.choice(parking_nodes),
+                storage_node=storage_node,
+                workstation_node=workstation_node,
+            )
+            self._order_arrivals[order_id] = (arrival_time, storage_node)
+            self._push(arrival_time, ORDER_ARRIVAL, order_id)
+
+        self.task_dispatcher = TaskDispatcher()
+        if settings.PREPOSITIONING:
+            self._push(settings.PREPOSITIONING_INTERVAL_SECONDS, PREPOSITION, 0)
+
+    # === Event loop ===
+
+    def run(self) -> Dict:
+        """
+        Run the simulation until every order is completed, the fleet stalls or the
+        simulated time runs out.
+
+        Returns:
+            Dict: Simulation report, see build_report
+        """
+        deadlocks_before = self._get_deadlock_counts()
+        reroutes_before = REROUTES.get(outcome="rerouted")
+        repositions_before = REPOSITIONS.get()
+        wall_start = time.perf_counter()
+        # Waiting times for rerouting and recent demand are measured in simulated time
+        epoch = self._get_epoch()
+        set_clock(lambda: epoch + datetime.timedelta(seconds=self._now))
+        try:
+            self._run_events()
+        finally:
+            set_clock(None)
+
+        wall_seconds = time.perf_counter() - wall_start
+        deadlocks = {
+            kind: count - deadlocks_before[kind]
+            for kind, count in self._get_deadlock_counts().items()
+        }
+        reroutes = int(REROUTES.get(outcome="rerouted") - reroutes_before)
+        repositions = int(REPOSITIONS.get() - repositions_before)
+        return self.build_report(wall_seconds, deadlocks, reroutes, repositions)
+
+    @staticmethod
+    def _get_epoch() -> datetime.datetime:
+        """Simulated time 0: midnight of the current day, orders are due from there."""
+        return timezone.make_aware(
+            datetime.datetime.combine(timezone.localdate(), datetime.time())
+        )
+
+    def _run_events(self) -> None:
+        while self._events:
+            event_time, _, kind, subject, node = heapq.heappop(self._events)
+            if event_time > self.max_simulated_seconds:
+                break
+            self._now = event_time
+
+            if kind == ORDER_ARRIVAL:
+                self._handle_order_arrival(subject)
+            elif kind == PREPOSITION:
+                self._handle_preposition()
+            else:
+                self._handle_agv_report(subject, node)
+
+            if self.orders_completed == self.order_count:
+                break
+            if self._is_stalled():
+                self.stalled_agvs = sorted(self._assigned_orders)
+                break
+
+    def _push(self, event_time: float, kind: int, subject: int, node=None) -> None:
+        heapq.heappush(
+            self._events, (event_time, next(self._event_counter), kind, subject, node)
+        )
+
+    def _handle_order_arrival(self, order_id: int) -> None:
+        """Assign an arriving order, or keep it pending until an AGV becomes idle."""
+        if not self.task_dispatcher.assign_single_order(order_id, self.algorithm):
+            self._pending_orders.append(order_id)
+            return
+
+        agv = Agv.objects.get(active_order_id=order_id)
+        self._assigned_orders[agv.agv_id] = order_id
+        # The AGV starts by reporting where it stands
+        self._push(self._now, AGV_REPORT, agv.agv_id, agv.current_node)
+
+    def _handle_preposition(self) -> None:
+        """Send idle AGVs towards recent demand, like the prepositioning loop."""
+        affected_agvs = Prepositioner(
+            self.task_dispatcher, self.staging_nodes
+        ).reposition_idle_agvs()
+        commands = {agv.agv_id: agv for agv in affected_agvs}
+        for agv in commands.values():
+            if agv.active_order_id is None and agv.next_node is not None:
+                self._repositioning.add(agv.agv_id)
+            self._apply_command(agv)
+        self._push(self._now + settings.PREPOSITIONING_INTERVAL_SECONDS, PREPOSITION, 0)
+
+    def _handle_agv_report(self, agv_id: int, node: int) -> None:
+        """Feed one position report to the control pipeline and apply its commands."""
+        if self._in_flight.pop(agv_id, None) is not None:
+            self._last_progress = self._now
+        self._poll_pending.discard(agv_id)
+        self._record_pickup(agv_id, node)
+
+        started = time.perf_counter()
+        affected_agvs = process_agv_position_report(agv_id, node)
+        self.decision_latencies.append(time.perf_counter() - started)
+
+        # Later entries carry the most recent command of an AGV
+        commands = {agv.agv_id: agv for agv in affected_agvs}
+        for agv in commands.values():
+            self._apply_command(agv)
+
+        reporting_agv = commands.get(agv_id)
+        if (
+            reporting_agv is not None
+            and agv_id in self._assigned_orders
+            and reporting_agv.active_order_id != self._assigned_orders[agv_id]
+        ):
+            chained_order_id = reporting_agv.active_order_id
+            if chained_order_id in self._pending_orders:
+                # The AGV took a pending order at the workstation (ORDER_CHAINING)
+                self._pending_orders.remove(chained_order_id)
+            self._complete_order(agv_id)
+            if chained_order_id is not None:
+                self._assigned_orders[agv_id] = chained_order_id
+        elif (
+            reporting_agv is not None
+            and agv_id in self._repositioning
+            and reporting_agv.next_node is None
+        ):
+            # Arrived at the staging node, the AGV can take pending orders now
+            self._repositioning.discard(agv_id)
+            self._offer_pending_orders()
+
+    def _record_pickup(self, agv_id: int, node: int) -> None:
+        """Record the time from an order's arrival until its AGV reached the storage node."""
+        order_id = self._assigned_orders.get(agv_id)
+        if order_id not in self._order_arrivals:
+            return
+        arrival_time, storage_node = self._order_arrivals[order_id]
+        if node == storage_node:
+            self.pickup_seconds.append(self._now - arrival_time)
+            del self._order_arrivals[order_id]
+
+    def _apply_command(self, agv: Agv) -> None:
+        """Act on the command an AGV received, like the AGV firmware would."""
+        if agv.agv_id in self._in_flight:
+            # Already driving to a reserved node, the AGV reports again on arrival
+            return
+
+        if agv.motion_state == Agv.MOVING and agv.reserved_node not in (
+            None,
+            agv.current_node,
+        ):
+            self._stop_waiting(agv.agv_id)
+            travel_time = (
+                self.distances.get((agv.current_node, agv.reserved_node), 1)
+                / self.speed
+            )
+            self._in_flight[agv.agv_id] = agv.reserved_node
+            self._push(
+                self._now + travel_time, AGV_REPORT, agv.agv_id, agv.reserved_node
+            )
+        elif agv.active_order_id is not None or agv.next_node is not None:
+            self._waiting_since.setdefault(agv.agv_id, self._now)
+            if agv.agv_id not in self._poll_pending:
+                self._poll_pending.add(agv.agv_id)
+                self._push(
+                    self._now + self.wait_poll_interval,
+                    AGV_REPORT,
+                    agv.agv_id,
+                    agv.current_node,
+                )
+        else:
+            self._stop_waiting(agv.agv_id)
+
+    def _stop_waiting(self, agv_id: int) -> None:
+        waiting_since = self._waiting_since.pop(agv_id, None)
+        if waiting_since is not None:
+            self.total_wait_seconds += self._now - waiting_since
+
+    def _complete_order(self, agv_id: int) -> None:
+        """Record a completed order and offer pending orders to the idle AGV."""
+        self._assigned_orders.pop(agv_id)
+        self._stop_waiting(agv_id)
+        self.orders_completed += 1
+        self._last_progress = self._now
+        self._offer_pending_orders()
+
+    def _offer_pending_orders(self) -> None:
+        """Offer the orders no AGV could take yet to the idle AGVs."""
+        pending_orders, self._pending_orders = self._pending_orders, []
+        for order_id in pending_orders:
+            self._handle_order_arrival(order_id)
+
+    def _is_stalled(self) -> bool:
+        """Check if AGVs have orders but none of them moved for stall_timeout."""
+        return (
+            bool(self._assigned_orders)
+            and not self._in_flight
+            and self._now - self._last_progress > self.stall_timeout
+        )
+
+    @staticmethod
+    def _get_deadlock_counts() -> Dict[str, float]:
+        return {
+            kind: DEADLOCKS_RESOLVED.get(kind=kind) for kind in ("heading_on", "loop")
+        }
+
+    # === Reporting ===
+
+    def build_report(
+        self,
+        wall_seconds: float,
+        deadlocks: Dict[str, float],
+        reroutes: int = 0,
+        repositions: int = 0,
+    ) -> Dict:
+        """
+        Summarize the simulation run.
+
+        Args:
+            wall_seconds: Wall-clock duration of the run
+            deadlocks: Number of resolved deadlocks by kind
+            reroutes: Number of waiting AGVs that were rerouted
+            repositions: Number of idle AGVs sent to a staging node
+
+        Returns:
+            Dict: Throughput, decision latency, waiting and deadlock figures
+        """
+        latencies = sorted(self.decision_latencies)
+        decision_seconds = sum(latencies)
+        simulated_hours = self._now / 3600
+
+        return {
+            "agvs": self.agv_count,
+            "orders": self.order_count,
+            "orders_completed": self.orders_completed,
+            "simulated_seconds": round(self._now, 3),
+            "wall_seconds": round(wall_seconds, 3),
+            "orders_per_hour": (
+                round(self.orders_completed / simulated_hours, 2)
+                if simulated_hours
+                else 0.0
+            ),
+            "decisions": len(latencies),
+            "decisions_per_second": (
+                round(len(latencies) / decision_seconds, 2) if decision_seconds else 0.0
+            ),
+            "decision_latency_p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+            "decision_latency_p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+            "total_wait_seconds": round(self.total_wait_seconds, 3),
+            "mean_wait_per_order_seconds": (
+                round(self.total_wait_seconds / self.orders_completed, 3)
+                if self.orders_completed
+                else 0.0
+            ),
+            "mean_time_to_pickup_seconds": (
+                round(sum(self.pickup_seconds) / len(self.pickup_seconds), 3)
+                if self.pickup_seconds
+                else 0.0
+            ),
+            "heading_on_deadlocks": int(deadlocks["heading_on"]),
+            "loop_deadlocks": int(deadlocks["loop"]),
+            "reroutes": reroutes,
+            "repositions": repositions,
+            "stalled_agvs": self.stalled_agvs,
+        }
+
+
+def _percentile(sorted_values: List[float], quantile: float) -> float:
+    """Nearest-rank percentile of an already sorted list, 0 if it is empty."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(quantile * len(sorted_values)) - 1)
+    return sorted_values[rank]
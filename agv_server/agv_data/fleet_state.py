@@ -0,0 +1,357 @@
+"""
+Fleet state shared between server processes.
+
+"database" (default) keeps the Agv table as the only source of truth, which is
+enough while a single process runs the control loop. "redis" additionally keeps
+node reservations, the AGVs on every node's remaining path (the refcounts behind
+common nodes) and the queue of scheduled orders in Redis. Every change that
+touches several keys runs as a Lua script, so concurrent server processes can
+never both reserve the same node or dispatch the same order.
+"""
+
+import datetime
+import logging
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DATABASE_BACKEND = "database"
+REDIS_BACKEND = "redis"
+
+
+class DatabaseFleetState:
+    """Single-process fleet state, everything is decided from the Agv table."""
+
+    # Whether other server processes see the state of this store
+    is_shared = False
+
+    def try_reserve(self, agv_id: int, nodes: Iterable[int]) -> bool:
+        """
+        Atomically replace the nodes reserved by an AGV, unless another AGV holds one.
+
+        Args:
+            agv_id: ID of the reserving AGV
+            nodes: Nodes the AGV wants to hold (reserved node and segment)
+
+        Returns:
+            bool: True if the AGV now holds exactly these nodes
+        """
+        return True
+
+    def sync_reservation(self, agv_id: int, nodes: Iterable[int]) -> None:
+        """Record the nodes an AGV holds after its reservation was saved."""
+
+    def set_path(self, agv_id: int, nodes: Iterable[int]) -> None:
+        """Record the remaining path of an AGV after it was saved."""
+
+    def get_shared_nodes(self, agv_id: int, nodes: List[int]) -> Optional[List[int]]:
+        """
+        Get the nodes that are also on the remaining path of another AGV.
+
+        Returns:
+            Optional[List[int]]: Shared nodes in the given order, None if the store
+            does not track paths and the caller has to compare paths itself
+        """
+        return None
+
+    def schedule_order(
+        self, order_id: int, algorithm: str, run_at: datetime.datetime
+    ) -> None:
+        """Queue an order for assignment at run_at."""
+        raise NotImplementedError("Orders are scheduled in-process by TaskDispatcher")
+
+    def pop_due_orders(
+        self, now: Optional[datetime.datetime] = None
+    ) -> List[Tuple[int, str]]:
+        """Atomically take the (order_id, algorithm) of every order that is due."""
+        return []
+
+    def clear_scheduled_orders(self) -> None:
+        """Drop every queued order."""
+
+    def rebuild(self, agvs: Iterable) -> None:
+        """
+        Reload the reservations and paths of the given AGVs from their rows, e.g.
+        after a restart. Entries of other AGVs (other shards) are kept.
+        """
+
+    def reset(self) -> None:
+        """Drop all reservations and paths."""
+
+
+# KEYS: [1] owner hash (node -> agv_id), [2] set of nodes held by the AGV
+# ARGV: [1] agv_id, [2..] nodes to hold
+TRY_RESERVE_SCRIPT = """
+for i = 2, #ARGV do
+    local owner = redis.call('HGET', KEYS[1], ARGV[i])
+    if owner and owner ~= ARGV[1] then
+        return 0
+    end
+end
+for _, node in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    if redis.call('HGET', KEYS[1], node) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], node)
+    end
+end
+redis.call('DEL', KEYS[2])
+for i = 2, #ARGV do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[1])
+    redis.call('SADD', KEYS[2], ARGV[i])
+end
+return 1
+"""
+
+# Same as TRY_RESERVE_SCRIPT without the ownership check: the database already
+# holds the reservation, so Redis has to follow it.
+SYNC_RESERVATION_SCRIPT = """
+for _, node in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    if redis.call('HGET', KEYS[1], node) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], node)
+    end
+end
+redis.call('DEL', KEYS[2])
+for i = 2, #ARGV do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[1])
+    redis.call('SADD', KEYS[2], ARGV[i])
+end
+return 1
+"""
+
+# Replaces the reservations of several AGVs in one step, so no other process sees
+# their nodes free in between. Owner entries of other AGVs are kept.
+# KEYS: [1] owner hash (node -> agv_id)
+# ARGV: [1] key prefix of the per-AGV reserved sets, then per AGV: agv_id, node
+#       count, nodes
+REBUILD_RESERVATIONS_SCRIPT = """
+local nodes_by_agv = {}
+local i = 2
+while i <= #ARGV do
+    local count = tonumber(ARGV[i + 1])
+    local nodes = {}
+    for j = 1, count do
+        nodes[j] = ARGV[i + 1 + j]
+    end
+    nodes_by_agv[ARGV[i]] = nodes
+    i = i + 2 + count
+end
+local owners = redis.call('HGETALL', KEYS[1])
+for j = 1, #owners, 2 do
+    if nodes_by_agv[owners[j + 1]] then
+        redis.call('HDEL', KEYS[1], owners[j])
+    end
+end
+for agv_id, nodes in pairs(nodes_by_agv) do
+    local reserved_key = ARGV[1] .. agv_id .. ':reserved'
+    redis.call('DEL', reserved_key)
+    for _, node in ipairs(nodes) do
+        redis.call('HSET', KEYS[1], node, agv_id)
+        redis.call('SADD', reserved_key, node)
+    end
+end
+return 1
+"""
+
+# KEYS: [1] set of path nodes of the AGV
+# ARGV: [1] agv_id, [2] key prefix of the per-node AGV sets, [3..] path nodes
+SET_PATH_SCRIPT = """
+for _, node in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('SREM', ARGV[2] .. node, ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV do
+    redis.call('SADD', ARGV[2] .. ARGV[i], ARGV[1])
+    redis.call('SADD', KEYS[1], ARGV[i])
+end
+return 1
+"""
+
+# KEYS: [1] scheduled orders sorted set (member "order_id:algorithm", score timestamp)
+# ARGV: [1] current timestamp
+POP_DUE_ORDERS_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+class RedisFleetState(DatabaseFleetState):
+    """Fleet state shared by all server processes through Redis."""
+
+    is_shared = True
+
+    def __init__(self, redis_client, key_prefix: str):
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self._try_reserve = redis_client.register_script(TRY_RESERVE_SCRIPT)
+        self._sync_reservation = redis_client.register_script(SYNC_RESERVATION_SCRIPT)
+        self._set_path = redis_client.register_script(SET_PATH_SCRIPT)
+        self._rebuild_reservations = redis_client.register_script(
+            REBUILD_RESERVATIONS_SCRIPT
+        )
+        self._pop_due_orders = redis_client.register_script(POP_DUE_ORDERS_SCRIPT)
+
+    # === Keys ===
+
+    @property
+    def _owners_key(self) -> str:
+        return f"{self.key_prefix}:reservation_owners"
+
+    @property
+    def _agv_prefix(self) -> str:
+        return f"{self.key_prefix}:agv:"
+
+    def _reserved_key(self, agv_id: int) -> str:
+        return f"{self._agv_prefix}{agv_id}:reserved"
+
+    def _path_key(self, agv_id: int) -> str:
+        return f"{self._agv_prefix}{agv_id}:path"
+
+    @property
+    def _node_agvs_prefix(self) -> str:
+        return f"{self.key_prefix}:node_agvs:"
+
+    @property
+    def _scheduled_orders_key(self) -> str:
+        return f"{self.key_prefix}:scheduled_orders"
+
+    # === Reservations ===
+
+    def try_reserve(self, agv_id: int, nodes: Iterable[int]) -> bool:
+        reserved = self._try_reserve(
+            keys=[self._owners_key, self._reserved_key(agv_id)],
+            args=[agv_id, *_unique(nodes)],
+        )
+        return bool(reserved)
+
+    def sync_reservation(self, agv_id: int, nodes: Iterable[int]) -> None:
+        self._sync_reservation(
+            keys=[self._owners_key, self._reserved_key(agv_id)],
+            args=[agv_id, *_unique(nodes)],
+        )
+
+    # === Common node refcounts ===
+
+    def set_path(self, agv_id: int, nodes: Iterable[int]) -> None:
+        self._set_path(
+            keys=[self._path_key(agv_id)],
+            args=[agv_id, self._node_agvs_prefix, *_unique(nodes)],
+        )
+
+    def get_shared_nodes(self, agv_id: int, nodes: List[int]) -> Optional[List[int]]:
+        if not nodes:
+            return []
+        pipeline = self.redis.pipeline(transaction=False)
+        for node in nodes:
+            pipeline.scard(f"{self._node_agvs_prefix}{node}")
+            pipeline.sismember(f"{self._node_agvs_prefix}{node}", agv_id)
+        replies = pipeline.execute()
+
+        shared_nodes = []
+        for index, node in enumerate(nodes):
+            agv_count, includes_self = replies[2 * index], replies[2 * index + 1]
+            if agv_count - int(bool(includes_self)) > 0:
+                shared_nodes.append(node)
+        return shared_nodes
+
+    # === Scheduled orders ===
+
+    def schedule_order(
+        self, order_id: int, algorithm: str, run_at: datetime.datetime
+    ) -> None:
+        self.redis.zadd(
+            self._scheduled_orders_key, {f"{order_id}:{algorithm}": run_at.timestamp()}
+        )
+
+    def pop_due_orders(
+        self, now: Optional[datetime.datetime] = None
+    ) -> List[Tuple[int, str]]:
+        now = now or datetime.datetime.now()
+        due = self._pop_due_orders(
+            keys=[self._scheduled_orders_key], args=[now.timestamp()]
+        )
+        orders = []
+        for member in due:
+            order_id, algorithm = member.decode().split(":", 1)
+            orders.append((int(order_id), algorithm))
+        return orders
+
+    def clear_scheduled_orders(self) -> None:
+        self.redis.delete(self._scheduled_orders_key)
+
+    # === Maintenance ===
+
+    def rebuild(self, agvs: Iterable) -> None:
+        # Nothing is wiped: a shard taking over must not free the nodes of AGVs
+        # other shards control, not even for a moment
+        agvs = list(agvs)
+        args = [self._agv_prefix]
+        for agv in agvs:
+            nodes = reservation_nodes(agv)
+            args.extend([agv.agv_id, len(nodes), *nodes])
+        self._rebuild_reservations(keys=[self._owners_key], args=args)
+        for agv in agvs:
+            self.set_path(agv.agv_id, agv.remaining_path or [])
+        logger.info(f"Rebuilt shared fleet state of {len(agvs)} AGVs from the database")
+
+    def reset(self) -> None:
+        keys = list(self.redis.scan_iter(match=f"{self.key_prefix}:*"))
+        keys = [key for key in keys if key != self._scheduled_orders_key.encode()]
+        if keys:
+            self.redis.delete(*keys)
+
+
+def _unique(nodes: Iterable[int]) -> List[int]:
+    """Drop missing and repeated nodes, keeping the order."""
+    return list(dict.fromkeys(node for node in nodes if node is not None))
+
+
+def reservation_nodes(agv) -> List[int]:
+    """Get the nodes an AGV holds: its reserved node followed by its segment."""
+    return _unique([agv.reserved_node, *(agv.reserved_segment or [])])
+
+
+_fleet_state = None
+_fleet_state_lock = threading.Lock()
+
+
+def get_fleet_state() -> DatabaseFleetState:
+    """Get the fleet state store configured by FLEET_STATE_BACKEND."""
+    global _fleet_state
+    with _fleet_state_lock:
+        if _fleet_state is None:
+            _fleet_state = create_fleet_state(settings.FLEET_STATE_BACKEND)
+        return _fleet_state
+
+
+def create_fleet_state(backend: str) -> DatabaseFleetState:
+    """
+    Create a fleet state store.
+
+    Args:
+        backend: "database" or "redis"
+
+    Returns:
+        DatabaseFleetState: The store
+
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    if backend == DATABASE_BACKEND:
+        return DatabaseFleetState()
+    if backend == REDIS_BACKEND:
+        import redis
+
+        return RedisFleetState(
+            redis.Redis(
+                host=settings.FLEET_STATE_REDIS_HOST,
+                port=settings.FLEET_STATE_REDIS_PORT,
+                db=settings.FLEET_STATE_REDIS_DB,
+            ),
+            key_prefix=settings.FLEET_STATE_KEY_PREFIX,
+        )
+    raise ValueError(f"Unknown fleet state backend: {backend}")
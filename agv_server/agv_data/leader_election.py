@@ -0,0 +1,266 @@
+"""
+Leader election for the MQTT consumer.
+
+Only one server process may subscribe to AGV reports and run control decisions,
+otherwise every report is handled once per process. Every process runs a
+LeaderElector; the one that holds the leader lock runs the consumer, the others
+stand by and retry. The lock is either a Redis key with a TTL that the leader keeps
+renewing, or a Postgres session-level advisory lock that lives as long as the
+leader's database connection. A standby takes over at most
+MQTT_LEADER_LOCK_TTL_SECONDS plus one renew interval after the leader stopped
+renewing.
+"""
+
+import logging
+import threading
+import uuid
+import zlib
+from typing import Callable, Optional
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+from .zones import is_sharded
+
+logger = logging.getLogger(__name__)
+
+NO_ELECTION = "none"
+REDIS_ELECTION = "redis"
+POSTGRES_ELECTION = "postgres"
+
+LEADER_TRANSITIONS = REGISTRY.counter(
+    "agv_mqtt_leader_transitions_total",
+    "Times this process became or stopped being the MQTT consumer leader",
+    label_names=("event",),
+)
+
+
+class LocalLeaderLock:
+    """Lock without contention, for deployments with a single server process."""
+
+    def acquire(self) -> bool:
+        """Try to take the lock, True if this process holds it now."""
+        return True
+
+    def renew(self) -> bool:
+        """Extend the lock, False if it was lost in the meantime."""
+        return True
+
+    def release(self) -> None:
+        """Give the lock up so a standby can take over right away."""
+
+
+# Only the holder may extend or delete the key
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLeaderLock(LocalLeaderLock):
+    """Redis key holding a random token, set with NX and kept alive with PEXPIRE."""
+
+    def __init__(self, redis_client, name: str, ttl_seconds: float):
+        self.redis = redis_client
+        self.name = name
+        self.ttl_ms = int(ttl_seconds * 1000)
+        self.token = uuid.uuid4().hex
+        self._renew = redis_client.register_script(RENEW_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def acquire(self) -> bool:
+        return bool(self.redis.set(self.name, self.token, nx=True, px=self.ttl_ms))
+
+    def renew(self) -> bool:
+        return bool(self._renew(keys=[self.name], args=[self.token, self.ttl_ms]))
+
+    def release(self) -> None:
+        self._release(keys=[self.name], args=[self.token])
+
+
+class PostgresAdvisoryLock(LocalLeaderLock):
+    """
+    Session-level advisory lock on the elector thread's database connection.
+    Postgres releases it when that connection dies, so no TTL is needed.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # Advisory locks are keyed by a 64-bit integer
+        self.lock_id = zlib.crc32(name.encode())
+        self._held = False
+
+    def acquire(self) -> bool:
+        from django.db import connection
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_id])
+            self._held = cursor.fetchone()[0]
+        return self._held
+
+    def renew(self) -> bool:
+        from django.db import connection
+
+        # The lock is held as long as the session that took it is alive
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' "
+                "AND classid = 0 AND objid = %s AND objsubid = 1 "
+                "AND pid = pg_backend_pid() AND granted)",
+                [self.lock_id],
+            )
+            self._held = cursor.fetchone()[0]
+        return self._held
+
+    def release(self) -> None:
+        from django.db import connection
+
+        if not self._held:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [self.lock_id])
+        self._held = False
+
+
+class LeaderElector:
+    """
+    Background thread that competes for the leader lock and runs the on_elected and
+    on_demoted callbacks when this process gains or loses leadership.
+    """
+
+    def __init__(
+        self,
+        lock: LocalLeaderLock,
+        on_elected: Callable[[], None],
+        on_demoted: Callable[[], None],
+        renew_interval: float,
+    ):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.renew_interval = renew_interval
+        self.is_leader = False
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start competing for leadership."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="mqtt_leader_elector"
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Step down and stop competing, so a standby can take over immediately."""
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._tick()
+            self._stop_event.wait(self.renew_interval)
+
+        if self.is_leader:
+            self._demote()
+            try:
+                self.lock.release()
+            except Exception:
+                logger.exception("Error releasing the MQTT leader lock")
+
+    def _tick(self) -> None:
+        try:
+            if self.is_leader:
+                if not self.lock.renew():
+                    logger.warning("Lost the MQTT leader lock")
+                    self._demote()
+            elif self.lock.acquire():
+                self._elect()
+        except Exception:
+            # Without a working lock the leadership can not be proven, so step down
+            logger.exception("Error in MQTT leader election")
+            if self.is_leader:
+                self._demote()
+
+    def _elect(self) -> None:
+        logger.info("Elected as MQTT consumer leader")
+        self.is_leader = True
+        LEADER_TRANSITIONS.inc(event="elected")
+        try:
+            self.on_elected()
+        except Exception:
+            logger.exception("Error starting as MQTT consumer leader")
+            self._demote()
+            self.lock.release()
+
+    def _demote(self) -> None:
+        logger.info("Stepping down as MQTT consumer leader")
+        self.is_leader = False
+        LEADER_TRANSITIONS.inc(event="demoted")
+        try:
+            self.on_demoted()
+        except Exception:
+            logger.exception("Error stopping as MQTT consumer leader")
+
+
+def create_leader_lock(election: str, name: str) -> LocalLeaderLock:
+    """
+    Create the leader lock of an election backend.
+
+    Args:
+        election: "none", "redis" or "postgres"
+        name: Name of the lock, shared by all competing processes
+
+    Returns:
+        LocalLeaderLock: The lock
+
+    Raises:
+        ValueError: If the election backend is unknown
+    """
+    if election == NO_ELECTION:
+        return LocalLeaderLock()
+    if election == REDIS_ELECTION:
+        import redis
+
+        return RedisLeaderLock(
+            redis.Redis(
+                host=settings.FLEET_STATE_REDIS_HOST,
+                port=settings.FLEET_STATE_REDIS_PORT,
+                db=settings.FLEET_STATE_REDIS_DB,
+            ),
+            name=name,
+            ttl_seconds=settings.MQTT_LEADER_LOCK_TTL_SECONDS,
+        )
+    if election == POSTGRES_ELECTION:
+        return PostgresAdvisoryLock(name)
+    raise ValueError(f"Unknown leader election backend: {election}")
+
+
+def create_leader_elector(
+    on_elected: Callable[[], None], on_demoted: Callable[[], None]
+) -> LeaderElector:
+    """Create the elector configured by the MQTT_LEADER_* settings."""
+    lock_name = settings.MQTT_LEADER_LOCK_NAME
+    if is_sharded():
+        # One leader per shard, the shards themselves run side by side
+        lock_name = f"{lock_name}:shard{settings.CONTROL_LOOP_SHARD}"
+
+    return LeaderElector(
+        lock=create_leader_lock(settings.MQTT_LEADER_ELECTION, lock_name),
+        on_elected=on_elected,
+        on_demoted=on_demoted,
+        # Renew well within the TTL so a slow renewal does not lose the lock
+        renew_interval=settings.MQTT_LEADER_LOCK_TTL_SECONDS / 3,
+    )
@@ -6,19 +6,36 @@ and shared points identification.
 """
 
 import schedule
-import time
 import datetime
 import threading
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Set, Tuple
+from django.conf import settings
 from django.db.models import QuerySet
+from django.utils import timezone
 from order_data.models import Order
 from map_data.models import Direction, Connection
 from ...models import Agv
 from ...constants import ErrorMessages
+from ...fleet_state import get_fleet_state
+from ...pathfinding.distance_table import DistanceTable
 from ...pathfinding.factory import PathfindingFactory
-from .common_nodes import CommonNodesCalculator
+from ...pathfinding.k_shortest import AlternativePaths, YenKShortestPaths
+from .common_nodes import (
+    CommonNodesCalculator,
+    coalesce_common_nodes_recalculation,
+    run_after_common_nodes_recalculation,
+)
 from .order_processor import OrderProcessor
 
+# Tag of every scheduled order assignment job, so they can be cleared without
+# touching other jobs of the shared default scheduler
+ORDER_JOB_TAG = "order"
+
+# AGV_ASSIGNMENT_MODE values: only idle AGVs of the order's parking node, or the
+# idle AGV closest to the storage node, which returns to its own parking node
+PARKING_ASSIGNMENT = "parking"
+NEAREST_ASSIGNMENT = "nearest"
+
 
 class TaskDispatcher:
     """
@@ -31,10 +48,88 @@ class TaskDispatcher:
         """Initialize TaskDispatcher with required data"""
         self.nodes, self.connections = self._validate_map_data()
         self.common_nodes_calculator = CommonNodesCalculator(self.connections)
+        # Distances to storage nodes for ranking idle AGVs, filled on demand
+        self.distance_table = DistanceTable(self.connections)
         self.order_processor = None  # Initialized in dispatch_tasks with algorithm
-        # Scheduling attributes
-        self.scheduler_running = False
-        self.scheduler_thread = None
+        # Pathfinding engines by algorithm name, built once for this map
+        self._pathfinding_algorithms = {}
+        # k shortest paths between order stations, built on first use
+        self._alternative_paths = None
+        self._alternative_paths_lock = threading.Lock()
+        # The dispatcher is shared by request and scheduler threads (see dispatcher_service)
+        self._assignment_lock = threading.RLock()
+
+    @property
+    def assignment_lock(self) -> threading.RLock:
+        """Lock held while orders are assigned, also by order chaining."""
+        return self._assignment_lock
+
+    def get_pathfinding_algorithm(self, algorithm: str):
+        """
+        Get the pathfinding engine of an algorithm, built on first use.
+
+        Args:
+            algorithm (str): The pathfinding algorithm name
+
+        Returns:
+            BasePathfinding: The engine for this dispatcher's map
+
+        Raises:
+            ValueError: If the algorithm is not supported
+        """
+        if algorithm not in self._pathfinding_algorithms:
+            self._pathfinding_algorithms[algorithm] = PathfindingFactory.get_algorithm(
+                algorithm, self.nodes, self.connections
+            )
+        return self._pathfinding_algorithms[algorithm]
+
+    def get_alternative_paths(self) -> Optional[AlternativePaths]:
+        """
+        Get the k shortest paths cache of this map. On first use the alternatives
+        between the stations of every order are computed up front.
+
+        Returns:
+            Optional[AlternativePaths]: The cache, None if ALTERNATIVE_PATHS_K is
+            below 2
+        """
+        if settings.ALTERNATIVE_PATHS_K < 2:
+            return None
+        with self._alternative_paths_lock:
+            if self._alternative_paths is None:
+                self._alternative_paths = AlternativePaths(
+                    YenKShortestPaths(self.nodes, self.connections),
+                    k=settings.ALTERNATIVE_PATHS_K,
+                    max_detour_ratio=settings.ALTERNATIVE_PATHS_MAX_DETOUR_RATIO,
+                )
+                self._alternative_paths.precompute(self._get_station_pairs())
+            return self._alternative_paths
+
+    def _get_alternative_paths_for(self, algorithm: str) -> Optional[AlternativePaths]:
+        """
+        Alternatives are ranked by distance like Dijkstra, so they only stand in for
+        the "dijkstra" algorithm; other algorithms optimize other costs.
+        """
+        if algorithm != "dijkstra":
+            return None
+        return self.get_alternative_paths()
+
+    @staticmethod
+    def _get_station_pairs() -> Set[Tuple[int, int]]:
+        """Get the (start, end) node pairs of the legs of every order."""
+        pairs = set()
+        for parking_node, storage_node, workstation_node in (
+            Order.objects.values_list(
+                "parking_node", "storage_node", "workstation_node"
+            ).distinct()
+        ):
+            pairs.update(
+                {
+                    (parking_node, storage_node),
+                    (storage_node, workstation_node),
+                    (workstation_node, parking_node),
+                }
+            )
+        return pairs
 
     def _validate_map_data(self) -> tuple[list, list]:
         """
@@ -61,31 +156,108 @@ class TaskDispatcher:
             raise ValueError(ErrorMessages.INVALID_MAP_DATA)
         return nodes, connections
 
-    def _find_idle_agv_for_task(self, parking_node: int) -> Optional[Agv]:
+    def _find_idle_agv_for_task(
+        self,
+        parking_node: int,
+        storage_node: Optional[int] = None,
+        exclude_agv_ids: Set[int] = frozenset(),
+    ) -> Optional[Agv]:
         """
         Find an idle AGV that can handle a task with the given parking node.
         According to Algorithm 1 line 4, we need to find an AGV that:
         1. Is idle (SA^i = 0)
         2. Has preferred_parking_node matching the task's parking_node
 
+        With AGV_ASSIGNMENT_MODE "nearest" the second condition is relaxed, see
+        _find_nearest_idle_agv.
+
         Args:
             parking_node (int): The parking node required for the task
+            storage_node (Optional[int]): The storage node of the task, needed to
+                rank AGVs in "nearest" mode
+            exclude_agv_ids (Set[int]): AGVs already picked for other tasks
 
         Returns:
             Optional[Agv]: An idle AGV that can handle the task, or None if no suitable AGV found
         """
         try:
+            if (
+                settings.AGV_ASSIGNMENT_MODE == NEAREST_ASSIGNMENT
+                and storage_node is not None
+            ):
+                return self._find_nearest_idle_agv(
+                    parking_node, storage_node, exclude_agv_ids
+                )
+
             # Find an idle AGV with matching preferred parking node
-            agv = Agv.objects.filter(
-                motion_state=Agv.IDLE,
-                preferred_parking_node=parking_node,
-                active_order__isnull=True,  # Ensure AGV is truly idle
-            ).first()
+            agv = (
+                Agv.objects.filter(
+                    motion_state=Agv.IDLE,
+                    preferred_parking_node=parking_node,
+                    active_order__isnull=True,  # Ensure AGV is truly idle
+                )
+                .exclude(agv_id__in=exclude_agv_ids)
+                .first()
+            )
             return agv
         except Exception as e:
             print(f"Error finding idle AGV: {str(e)}")
             return None
 
+    def _find_nearest_idle_agv(
+        self, parking_node: int, storage_node: int, exclude_agv_ids: Set[int]
+    ) -> Optional[Agv]:
+        """
+        Find the idle AGV with the shortest path from where it stands to the storage
+        node, whatever its parking node. Ties go to an AGV of the order's parking node.
+
+        Returns:
+            Optional[Agv]: The closest idle AGV, None if no idle AGV can reach the
+            storage node
+        """
+        idle_agvs = Agv.objects.filter(
+            motion_state=Agv.IDLE, active_order__isnull=True
+        ).exclude(agv_id__in=exclude_agv_ids)
+        # The graph is undirected, so the distances from the storage node are the
+        # distances to it
+        distances = self.distance_table.get_distances(storage_node)
+
+        def rank(agv: Agv) -> Tuple[float, bool, int]:
+            return (
+                distances.get(self._get_agv_location(agv), float("inf")),
+                agv.preferred_parking_node != parking_node,
+                agv.agv_id,
+            )
+
+        nearest_agv = min(idle_agvs, key=rank, default=None)
+        if nearest_agv is None or rank(nearest_agv)[0] == float("inf"):
+            return None
+        return nearest_agv
+
+    @staticmethod
+    def _get_agv_location(agv: Agv) -> Optional[int]:
+        """Node an idle AGV stands on, its parking node until it first reported."""
+        if agv.current_node is not None:
+            return agv.current_node
+        return agv.preferred_parking_node
+
+    def _get_route_ends(self, order: Order, agv: Agv) -> Tuple[int, int]:
+        """
+        Get the nodes an AGV's route for an order starts and ends at: the order's
+        parking node, or in "nearest" mode where the AGV stands and its own parking
+        node.
+        """
+        if settings.AGV_ASSIGNMENT_MODE == NEAREST_ASSIGNMENT:
+            return self._get_agv_location(agv), agv.preferred_parking_node
+        return order.parking_node, order.parking_node
+
+    @staticmethod
+    def _get_previous_node(agv: Agv, start_node: int) -> Optional[int]:
+        """Node the AGV arrived at start_node from, None if it does not stand there."""
+        if agv.current_node != start_node or agv.previous_node == start_node:
+            return None
+        return agv.previous_node
+
     def dispatch_tasks(self, algorithm: str = "dijkstra") -> List[Dict]:
         """
         Main implementation of Algorithm 1: Task Dispatching of the Central Controller.
@@ -100,22 +272,29 @@ class TaskDispatcher:
         Raises:
             ValueError: If there are no orders or if the pathfinding algorithm is invalid.
         """
+        with self._assignment_lock:
+            return self._dispatch_tasks(algorithm)
+
+    def _dispatch_tasks(self, algorithm: str) -> List[Dict]:
+        """Dispatch tasks while holding the assignment lock, see dispatch_tasks."""
         # Read input data and create task list T (line 2)
         tasks = list(Order.objects.filter(active_agv__isnull=True))
         if not tasks:
             raise ValueError(ErrorMessages.NO_ORDERS)
 
         # Initialize pathfinding algorithm and order processor
-        pathfinding_algorithm = PathfindingFactory.get_algorithm(
-            algorithm, self.nodes, self.connections
-        )
+        pathfinding_algorithm = self.get_pathfinding_algorithm(algorithm)
         if not pathfinding_algorithm:
             raise ValueError(ErrorMessages.INVALID_ALGORITHM)
 
-        self.order_processor = OrderProcessor(pathfinding_algorithm)
+        self.order_processor = OrderProcessor(
+            pathfinding_algorithm, self._get_alternative_paths_for(algorithm)
+        )
 
         # First, generate all order processing data in memory
         orders_data_list = []
+        # AGVs picked in this batch, they stay idle until the batch is saved
+        picked_agv_ids = set()
 
         # For each task in the task list T (line 3)
         for task in tasks:
@@ -125,18 +304,28 @@ class TaskDispatcher:
 
             try:
                 # Find an idle AGV for this task (line 4)
-                assigned_agv = self._find_idle_agv_for_task(task.parking_node)
+                assigned_agv = self._find_idle_agv_for_task(
+                    task.parking_node, task.storage_node, picked_agv_ids
+                )
                 if not assigned_agv:
                     print(
                         f"No idle AGV available for task {task.order_id} at parking node {task.parking_node}"
                     )
+                    self._mark_order_pending(task)
                     continue
 
                 # Generate order data for task (without CP calculation yet)
-                order_data = self.order_processor.process_order(task)
+                start_node, return_node = self._get_route_ends(task, assigned_agv)
+                order_data = self.order_processor.process_order(
+                    task,
+                    start_node,
+                    return_node,
+                    self._get_previous_node(assigned_agv, start_node),
+                )
                 if order_data:
                     # Add AGV assignment to order data
                     order_data["assigned_agv"] = assigned_agv
+                    picked_agv_ids.add(assigned_agv.agv_id)
                     orders_data_list.append(order_data)
 
                     # Update AGV state to waiting (according to Algorithm 2 in paper)
@@ -233,55 +422,33 @@ class TaskDispatcher:
         Returns:
             bool: True if assignment was successful, False otherwise
         """
+        with self._assignment_lock:
+            return self._assign_single_order(order_id, algorithm)
+
+    def _assign_single_order(self, order_id: str, algorithm: str) -> bool:
+        """Assign a single order while holding the assignment lock, see assign_single_order."""
         try:
             # Validate order and find AGV
             order, available_agv = self._validate_order_assignment(order_id)
             if not order or not available_agv:
                 return False
 
-            # Setup pathfinding algorithm if not already initialized
-            if (
-                not self.order_processor
-                or self.order_processor.pathfinding_algorithm.__class__.__name__.lower()
-                != algorithm
-            ):
-                pathfinding_algorithm = PathfindingFactory.get_algorithm(
-                    algorithm, self.nodes, self.connections
-                )
-                if not pathfinding_algorithm:
-                    print(f"Invalid pathfinding algorithm: {algorithm}")
-                    return False
-                # Process and assign the order
-                self.order_processor = OrderProcessor(pathfinding_algorithm)
+            # Setup pathfinding algorithm, the engine is cached per algorithm
+            pathfinding_algorithm = self.get_pathfinding_algorithm(algorithm)
+            if not pathfinding_algorithm:
+                print(f"Invalid pathfinding algorithm: {algorithm}")
+                return False
+            # Process and assign the order
+            self.order_processor = OrderProcessor(
+                pathfinding_algorithm, self._get_alternative_paths_for(algorithm)
+            )
             success = self._process_and_assign_order(order, available_agv)
             if success:
-                # Send notification with common nodes information
-                try:
-                    from ...views import send_order_assignment_notification
-
-                    # Refresh AGV from database to get updated common_nodes
-                    available_agv.refresh_from_db()
-                    message = f"Successfully assigned order {order_id} to AGV {available_agv.agv_id}"
-                    additional_data = {
-                        "common_nodes_calculated": True,
-                        "common_nodes_count": len(available_agv.common_nodes)
-                        if available_agv.common_nodes
-                        else 0,
-                        "adjacent_common_nodes_count": len(
-                            available_agv.adjacent_common_nodes
-                        )
-                        if available_agv.adjacent_common_nodes
-                        else 0,
-                        "remaining_path_length": len(available_agv.remaining_path)
-                        if available_agv.remaining_path
-                        else 0,
-                    }
-                    send_order_assignment_notification(
-                        order_id, available_agv.agv_id, message, additional_data
-                    )
-                except ImportError:
-                    # Handle case where notification function is not available
-                    pass
+                # Send notification with common nodes information, in a batch only
+                # once they were recalculated for the whole batch
+                run_after_common_nodes_recalculation(
+                    lambda: self._send_assignment_notification(order_id, available_agv)
+                )
                 print(
                     f"Successfully assigned order {order_id} to AGV {available_agv.agv_id}"
                 )
@@ -293,6 +460,32 @@ class TaskDispatcher:
             print(f"Error assigning order {order_id}: {str(e)}")
             return False
 
+    @staticmethod
+    def _send_assignment_notification(order_id: str, agv: Agv) -> None:
+        """Notify clients of an assigned order with the AGV's current common nodes."""
+        try:
+            from ...views import send_order_assignment_notification
+
+            # Refresh AGV from database to get updated common_nodes
+            agv.refresh_from_db()
+            message = f"Successfully assigned order {order_id} to AGV {agv.agv_id}"
+            additional_data = {
+                "common_nodes_calculated": True,
+                "common_nodes_count": len(agv.common_nodes) if agv.common_nodes else 0,
+                "adjacent_common_nodes_count": len(agv.adjacent_common_nodes)
+                if agv.adjacent_common_nodes
+                else 0,
+                "remaining_path_length": len(agv.remaining_path)
+                if agv.remaining_path
+                else 0,
+            }
+            send_order_assignment_notification(
+                order_id, agv.agv_id, message, additional_data
+            )
+        except ImportError:
+            # Handle case where notification function is not available
+            pass
+
     def _validate_order_assignment(
         self, order_id: str
     ) -> Tuple[Optional[Order], Optional[Agv]]:
@@ -316,11 +509,14 @@ class TaskDispatcher:
                 return None, None
 
             # Find an available AGV for this order
-            available_agv = self._find_idle_agv_for_task(order.parking_node)
+            available_agv = self._find_idle_agv_for_task(
+                order.parking_node, order.storage_node
+            )
             if not available_agv:
                 print(
                     f"No available AGV for order {order_id} at parking node {order.parking_node}"
                 )
+                self._mark_order_pending(order)
                 return None, None
 
             return order, available_agv
@@ -347,7 +543,10 @@ class TaskDispatcher:
                 return False
 
             # Process the order
-            order_data = self.order_processor.process_order(order)
+            start_node, return_node = self._get_route_ends(order, agv)
+            order_data = self.order_processor.process_order(
+                order, start_node, return_node, self._get_previous_node(agv, start_node)
+            )
             if not order_data:
                 print(f"Failed to process order {order.order_id}")
                 return False
@@ -363,6 +562,8 @@ class TaskDispatcher:
             agv.direction_change = Agv.GO_STRAIGHT
             # Recalculate common nodes for all AGVs (including the newly assigned AGV)
             agv.save()
+            if order.pending_since is not None:
+                Order.objects.filter(order_id=order.order_id).update(pending_since=None)
             active_agvs_count = Agv.objects.filter(active_order__isnull=False).count()
 
             if active_agvs_count > 1:
@@ -387,6 +588,18 @@ class TaskDispatcher:
             print(f"Error processing and assigning order {order.order_id}: {str(e)}")
             return False
 
+    @staticmethod
+    def _mark_order_pending(order: Order) -> None:
+        """
+        Remember that no idle AGV could take the order, so an AGV finishing at a
+        workstation can chain it (see order_chaining).
+        """
+        if order.pending_since is None:
+            order.pending_since = timezone.now()
+            Order.objects.filter(
+                order_id=order.order_id, pending_since__isnull=True
+            ).update(pending_since=order.pending_since)
+
     # Scheduling-related methods
     def get_unassigned_orders(self) -> QuerySet[Order]:
         """
@@ -473,9 +686,25 @@ class TaskDispatcher:
             algorithm: The algorithm to use
         """
 
+        fleet_state = get_fleet_state()
+        if fleet_state.is_shared:
+            # Queue in Redis, whichever server process pops the order first assigns it
+            fleet_state.schedule_order(
+                order.order_id, algorithm, self.calculate_schedule_datetime(order)
+            )
+            print(
+                f"Scheduled order {order.order_id} at {order.start_time.strftime('%H:%M:%S')} in the shared fleet state"
+            )
+            return
+
         def create_assignment_function(order_id_val, algorithm_val):
             def assign_order():
-                self.assign_single_order(order_id_val, algorithm_val)
+                # Assign with the dispatcher of the map that is current when the job runs
+                from ...dispatcher_service import get_dispatcher_service
+
+                get_dispatcher_service().assign_scheduled_order(
+                    order_id_val, algorithm_val
+                )
                 return schedule.CancelJob  # Remove job after execution
 
             return assign_order
@@ -487,7 +716,7 @@ class TaskDispatcher:
             .day.at(order.start_time.strftime("%H:%M:%S"))
             .do(assignment_function)
         )
-        job.tag(f"order_{order.order_id}")
+        job.tag(ORDER_JOB_TAG, f"order_{order.order_id}")
 
         print(
             f"Scheduled order {order.order_id} at {order.start_time.strftime('%H:%M:%S')}"
@@ -509,62 +738,41 @@ class TaskDispatcher:
         scheduled_orders = []
         immediate_orders = []
 
-        for order in unassigned_orders:
-            available_agv = self._find_idle_agv_for_task(order.parking_node)
-
-            if not available_agv:
-                print(
-                    f"No available AGV for order {order.order_id} at parking node {order.parking_node}"
+        # Each immediate assignment only marks common nodes stale, they are
+        # recalculated once for the whole batch
+        with coalesce_common_nodes_recalculation():
+            for order in unassigned_orders:
+                available_agv = self._find_idle_agv_for_task(
+                    order.parking_node, order.storage_node
                 )
-                continue
 
-            schedule_datetime = self.calculate_schedule_datetime(order)
+                schedule_datetime = self.calculate_schedule_datetime(order)
 
-            if self.is_order_scheduled_for_future(schedule_datetime):
-                # Schedule for future assignment
-                self.schedule_order_assignment(order, algorithm)
-                scheduled_order_info = self.create_scheduled_order_info(
-                    order, available_agv, schedule_datetime
-                )
-                scheduled_orders.append(scheduled_order_info)
-            else:
-                # Assign immediately
-                success = self.assign_single_order(order.order_id, algorithm)
-                if success:
-                    immediate_order_info = self.create_immediate_order_info(
-                        order, available_agv
-                    )
-                    immediate_orders.append(immediate_order_info)
+                if not available_agv:
                     print(
-                        f"Assigned order {order.order_id} to AGV {available_agv.agv_id} immediately (scheduled time already passed)"
+                        f"No available AGV for order {order.order_id} at parking node {order.parking_node}"
                     )
+                    if not self.is_order_scheduled_for_future(schedule_datetime):
+                        self._mark_order_pending(order)
+                    continue
 
-        return scheduled_orders, immediate_orders
-
-    def start_scheduler_if_needed(self, scheduled_orders: List[Dict]) -> None:
-        """
-        Start the scheduler thread if there are scheduled orders and it's not already running.
+                if self.is_order_scheduled_for_future(schedule_datetime):
+                    # Schedule for future assignment
+                    self.schedule_order_assignment(order, algorithm)
+                    scheduled_order_info = self.create_scheduled_order_info(
+                        order, available_agv, schedule_datetime
+                    )
+                    scheduled_orders.append(scheduled_order_info)
+                else:
+                    # Assign immediately
+                    success = self.assign_single_order(order.order_id, algorithm)
+                    if success:
+                        immediate_order_info = self.create_immediate_order_info(
+                            order, available_agv
+                        )
+                        immediate_orders.append(immediate_order_info)
+                        print(
+                            f"Assigned order {order.order_id} to AGV {available_agv.agv_id} immediately (scheduled time already passed)"
+                        )
 
-        Args:
-            scheduled_orders: List of scheduled orders
-        """
-        if not self.scheduler_running and scheduled_orders:
-            if self.scheduler_thread and self.scheduler_thread.is_alive():
-                # Reuse existing thread
-                pass
-            else:
-                # Create a new thread
-                self.scheduler_thread = threading.Thread(
-                    target=self._run_scheduler,
-                    daemon=True,
-                    name="task_dispatcher_scheduler_thread",
-                )
-                self.scheduler_thread.start()
-
-    def _run_scheduler(self) -> None:
-        """Run the scheduler in a background thread"""
-        self.scheduler_running = True
-        while self.scheduler_running:
-            schedule.run_pending()
-            time.sleep(1)
-        print("Task dispatcher scheduler thread stopped")
+        return scheduled_orders, immediate_orders
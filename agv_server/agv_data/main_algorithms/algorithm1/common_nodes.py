@@ -5,9 +5,36 @@ This module implements the shared points calculation aspects of Algorithm 1
 from the research paper.
 """
 
-from typing import List, Dict, Set
+import contextlib
+import logging
+import threading
+from collections import Counter
+from typing import Callable, List, Dict, Optional, Set
+
+from django.conf import settings
+from django.db.models import Q
+
 from map_data.models import Connection
-from ...models import Agv
+from ...fleet_state import get_fleet_state
+from ...metrics import REGISTRY, stage_timer
+from ...models import REMAINING_PATH, ROUTE_FIELDS, ROUTE_LEFT, Agv
+
+logger = logging.getLogger(__name__)
+
+RECALCULATIONS = REGISTRY.counter(
+    "agv_common_nodes_recalculations_total",
+    "Requested recalculations of all AGVs' common nodes, run or coalesced",
+    label_names=("outcome",),
+)
+
+# Per-thread state of coalesce_common_nodes_recalculation()
+_coalescing = threading.local()
+
+_recalculations_since_summary = 0
+_summary_lock = threading.Lock()
+
+_calculator: Optional["CommonNodesCalculator"] = None
+_calculator_lock = threading.Lock()
 
 
 class CommonNodesCalculator:
@@ -18,16 +45,85 @@ class CommonNodesCalculator:
     in the DSPA algorithm, handling CP and SCP calculations.
     """
 
-    def __init__(self, connections):
+    def __init__(
+        self,
+        connections,
+        horizon_nodes: Optional[int] = None,
+        horizon_seconds: Optional[float] = None,
+        speed: Optional[float] = None,
+    ):
         """
         Initialize the CommonNodesCalculator: with map connections.
 
         Args:
             connections (List[Dict]): List of connection dictionaries with node1, node2, and distance
+            horizon_nodes: Only the next horizon_nodes nodes of every path count as
+                shared (0 for the whole path, None for COMMON_NODES_HORIZON_NODES)
+            horizon_seconds: Only the nodes reached within horizon_seconds count as
+                shared (0 for no time limit, None for COMMON_NODES_HORIZON_SECONDS)
+            speed: Distance units an AGV travels per second (None for AGV_SPEED)
         """
         self.connections = connections
         # Build adjacency map for sequential shared points calculation
         self.adjacent_points = self._build_adjacency_map()
+        # Distance of every connection, in both directions, for the time horizon
+        self.distances = {}
+        for conn in connections:
+            self.distances[(conn["node1"], conn["node2"])] = conn["distance"]
+            self.distances[(conn["node2"], conn["node1"])] = conn["distance"]
+        self._horizon_nodes = horizon_nodes
+        self._horizon_seconds = horizon_seconds
+        self._speed = speed
+
+    @property
+    def horizon_nodes(self) -> int:
+        if self._horizon_nodes is not None:
+            return self._horizon_nodes
+        return settings.COMMON_NODES_HORIZON_NODES
+
+    @property
+    def horizon_seconds(self) -> float:
+        if self._horizon_seconds is not None:
+            return self._horizon_seconds
+        return settings.COMMON_NODES_HORIZON_SECONDS
+
+    @property
+    def speed(self) -> float:
+        if self._speed is not None:
+            return self._speed
+        return settings.AGV_SPEED
+
+    @property
+    def has_horizon(self) -> bool:
+        """Whether only the start of every path is compared instead of the whole path."""
+        return self.horizon_nodes > 0 or self.horizon_seconds > 0
+
+    def get_horizon_window(self, path: List[int]) -> List[int]:
+        """
+        Get the start of a remaining path that lies within the look-ahead horizon:
+        at most horizon_nodes nodes, and only nodes reached within horizon_seconds
+        at the AGV speed. The first node is always included.
+
+        Args:
+            path (List[int]): Remaining path, starting with the next node
+
+        Returns:
+            List[int]: The nodes of the path inside the horizon
+        """
+        if not path or not self.has_horizon:
+            return path or []
+
+        window = path[: self.horizon_nodes] if self.horizon_nodes > 0 else path
+        if self.horizon_seconds <= 0:
+            return window
+
+        max_distance = self.horizon_seconds * self.speed
+        travelled = 0
+        for index in range(1, len(window)):
+            travelled += self.distances.get((window[index - 1], window[index]), 0)
+            if travelled > max_distance:
+                return window[:index]
+        return window
 
     def _build_adjacency_map(self) -> Dict[int, Set[int]]:
         """
@@ -55,6 +151,9 @@ class CommonNodesCalculator:
         For an active AGV r_i, CP^i consists of an ordered sequence of points shared with other AGVs:
         CP^i = {v_x : v_x ∈ Π_i, v_x ∈ Π_j, j ≠ i}
 
+        With a look-ahead horizon, Π_i and Π_j are cut to their horizon windows, so
+        nodes the AGVs pass far apart in time are not shared.
+
         Args:
             current_path (List[int]): The path to calculate common nodes for (Π_i)
             other_paths (List[List[int]]): List of other remaining paths to compare against (Π_j, j ≠ i)
@@ -68,10 +167,14 @@ class CommonNodesCalculator:
         # Create a set of all points in other paths for O(1) lookup
         all_other_path_points = set()
         for path in other_paths:
-            all_other_path_points.update(path)
+            all_other_path_points.update(self.get_horizon_window(path))
 
         # Return points that exist in both current path and other paths, maintaining original order
-        return [point for point in current_path if point in all_other_path_points]
+        return [
+            point
+            for point in self.get_horizon_window(current_path)
+            if point in all_other_path_points
+        ]
 
     def calculate_sequential_common_nodes(self, common_nodes: List[int]) -> List[int]:
         """
@@ -116,24 +219,32 @@ def update_common_nodes(agv: Agv) -> None:
     Args:
         agv (Agv): The AGV to update shared points for
     """
-    # Get all other AGVs' remaining paths
-    other_paths = []
-    other_agvs = Agv.objects.filter(active_order__isnull=False).exclude(
-        agv_id=agv.agv_id
+    calculator = get_common_nodes_calculator()
+    # The shared fleet state counts the AGVs on every node, no need to load all paths
+    common_nodes = (
+        None
+        if calculator.has_horizon
+        else get_fleet_state().get_shared_nodes(agv.agv_id, agv.remaining_path)
     )
 
-    for other_agv in other_agvs:
-        if other_agv.remaining_path:
-            other_paths.append(other_agv.remaining_path)
+    if common_nodes is None:
+        # Get all other AGVs' remaining paths
+        other_paths = list(
+            Agv.objects.filter(ROUTE_LEFT)
+            .exclude(agv_id=agv.agv_id)
+            .values_list(REMAINING_PATH, flat=True)
+        )
 
-    # Calculate shared points
-    common_nodes = calculate_common_nodes(agv.remaining_path, other_paths)
+        # Calculate shared points
+        common_nodes = calculator.calculate_common_nodes(
+            agv.remaining_path, other_paths
+        )
 
     # Update AGV's common_nodes field
     agv.common_nodes = common_nodes
 
     # Calculate sequential shared points
-    sequential_common_nodes = calculate_sequential_common_nodes(common_nodes)
+    sequential_common_nodes = calculator.calculate_sequential_common_nodes(common_nodes)
 
     # Update AGV's adjacent_common_nodes field
     agv.adjacent_common_nodes = sequential_common_nodes
@@ -217,69 +328,101 @@ def calculate_sequential_common_nodes(common_nodes: List[int]) -> List[int]:
 
 def recalculate_all_common_nodes(log_summary: bool = False) -> None:
     """
-    Recalculate common nodes and adjacent common nodes for all AGVs with active orders.
+    Recalculate common nodes and adjacent common nodes for all AGVs with a route left.
     This function should be called whenever a new order is assigned to an AGV,
     as it may affect the common nodes of all other active AGVs.
 
+    With COMMON_NODES_HORIZON_NODES or COMMON_NODES_HORIZON_SECONDS set, only the
+    horizon window at the start of every path is compared.
+
+    Inside a coalesce_common_nodes_recalculation() block the common nodes are only
+    marked stale and recalculated once when the outermost block exits.
+
     Args:
-        log_summary: Whether to log a detailed summary after recalculation
+        log_summary: Whether to log a summary after recalculation (sampled, see
+            COMMON_NODES_SUMMARY_SAMPLE_EVERY)
     """
-    try:
-        # Get all AGVs with active orders
-        active_agvs = Agv.objects.filter(active_order__isnull=False)
-
-        if not active_agvs.exists():
-            return
+    if getattr(_coalescing, "depth", 0) > 0:
+        _coalescing.stale = True
+        _coalescing.log_summary = _coalescing.log_summary or log_summary
+        RECALCULATIONS.inc(outcome="coalesced")
+        return
 
-        # Get connections for adjacency calculations
-        connections = []
-        for conn in Connection.objects.values():
-            connections.append(
-                {
-                    "node1": int(conn["node1"]),
-                    "node2": int(conn["node2"]),
-                    "distance": conn["distance"],
-                }
+    try:
+        with stage_timer("recalculate_common_nodes"):
+            # AGVs with a route left, and those whose stale common nodes are cleared
+            active_agvs = list(
+                Agv.objects.filter(
+                    ROUTE_LEFT
+                    | Q(common_nodes__len__gt=0)
+                    | Q(adjacent_common_nodes__len__gt=0)
+                ).only(
+                    "agv_id",
+                    *ROUTE_FIELDS,
+                    "common_nodes",
+                    "adjacent_common_nodes",
+                )
             )
 
-        # Initialize the common nodes calculator
-        calculator = CommonNodesCalculator(connections)
-
-        # For each active AGV, recalculate its common nodes
-        for agv in active_agvs:
-            if not agv.remaining_path:
-                agv.common_nodes = []
-                agv.adjacent_common_nodes = []
+            if not active_agvs:
+                return
+
+            calculator = get_common_nodes_calculator()
+            # The shared fleet state counts whole paths, not horizon windows
+            fleet_state = None if calculator.has_horizon else get_fleet_state()
+
+            # Number of AGVs whose remaining path (window) contains each node, counted
+            # once for the whole fleet instead of comparing every pair of paths
+            windows = {
+                agv.agv_id: calculator.get_horizon_window(agv.remaining_path)
+                for agv in active_agvs
+            }
+            node_agv_counts = Counter()
+            for window in windows.values():
+                node_agv_counts.update(set(window))
+
+            # For each active AGV, recalculate its common nodes
+            updated_count = 0
+            for agv in active_agvs:
+                common_nodes = []
+                adjacent_common_nodes = []
+                if agv.remaining_path:
+                    common_nodes = (
+                        fleet_state.get_shared_nodes(agv.agv_id, agv.remaining_path)
+                        if fleet_state
+                        else None
+                    )
+                    if common_nodes is None:
+                        # Nodes on the path of at least one other active AGV
+                        common_nodes = [
+                            node
+                            for node in windows[agv.agv_id]
+                            if node_agv_counts[node] > 1
+                        ]
+                    adjacent_common_nodes = (
+                        calculator.calculate_sequential_common_nodes(common_nodes)
+                    )
+
+                # Unchanged AGVs are neither saved nor broadcast again
+                if (
+                    agv.common_nodes == common_nodes
+                    and agv.adjacent_common_nodes == adjacent_common_nodes
+                ):
+                    continue
+                agv.common_nodes = common_nodes
+                agv.adjacent_common_nodes = adjacent_common_nodes
                 agv.save(update_fields=["common_nodes", "adjacent_common_nodes"])
-                continue
-
-            # Get all other active AGVs' remaining paths
-            other_paths = []
-            other_agvs = active_agvs.exclude(agv_id=agv.agv_id)
+                updated_count += 1
 
-            for other_agv in other_agvs:
-                if other_agv.remaining_path:
-                    other_paths.append(other_agv.remaining_path)
-
-            # Calculate common nodes and adjacent common nodes
-            common_nodes = calculator.calculate_common_nodes(
-                agv.remaining_path, other_paths
-            )
-            adjacent_common_nodes = calculator.calculate_sequential_common_nodes(
-                common_nodes
-            )
-            # Update the AGV
-            agv.common_nodes = common_nodes
-            agv.adjacent_common_nodes = adjacent_common_nodes
-            agv.save(update_fields=["common_nodes", "adjacent_common_nodes"])
-
-        print(
-            f"Successfully recalculated common nodes for {active_agvs.count()} active AGVs"
+        RECALCULATIONS.inc(outcome="run")
+        logger.debug(
+            f"Recalculated common nodes for {len(active_agvs)} active AGVs, "
+            f"{updated_count} changed"
         )
 
         # Log summary if requested
-        if log_summary:
-            log_common_nodes_summary()
+        if log_summary and _should_sample_summary():
+            log_common_nodes_summary(active_agvs)
 
     except Exception as e:
         print(f"Error recalculating common nodes for all AGVs: {str(e)}")
@@ -288,37 +431,234 @@ def recalculate_all_common_nodes(log_summary: bool = False) -> None:
         traceback.print_exc()
 
 
-def log_common_nodes_summary() -> None:
+def update_common_nodes_for_path_change(agv: Agv, old_path: List[int]) -> None:
+    """
+    Update common nodes after the remaining path of one AGV changed (e.g. it was
+    rerouted, or moved on with a look-ahead horizon), touching only the AGVs whose
+    path shares a node that was added or dropped instead of recalculating the whole
+    fleet.
+
+    With a look-ahead horizon the paths are cut to their horizon windows. Only the
+    window of this AGV changed, the windows of the other AGVs stay the same.
+
+    Args:
+        agv: The AGV whose path changed, with its new remaining path already saved
+        old_path: Remaining path of the AGV before it changed
+    """
+    with stage_timer("update_common_nodes_delta"):
+        calculator = get_common_nodes_calculator()
+        new_window = calculator.get_horizon_window(agv.remaining_path or [])
+        old_window = calculator.get_horizon_window(old_path)
+        changed_nodes = set(old_window) ^ set(new_window)
+        lookup_nodes = set(new_window) | changed_nodes
+        if not lookup_nodes:
+            return
+
+        # Every AGV that may share a node of the new window or a changed node
+        other_agvs = list(
+            Agv.objects.alias(remaining=REMAINING_PATH)
+            .filter(
+                ROUTE_LEFT,
+                route__overlap=list(lookup_nodes),
+                remaining__overlap=list(lookup_nodes),
+            )
+            .exclude(agv_id=agv.agv_id)
+            .only("agv_id", *ROUTE_FIELDS, "common_nodes", "adjacent_common_nodes")
+        )
+        other_windows = {
+            other_agv.agv_id: calculator.get_horizon_window(
+                other_agv.remaining_path or []
+            )
+            for other_agv in other_agvs
+        }
+        other_window_nodes = {
+            agv_id: set(window) for agv_id, window in other_windows.items()
+        }
+
+        nodes_of_others = set().union(*other_window_nodes.values())
+        _save_common_nodes_if_changed(
+            agv, [node for node in new_window if node in nodes_of_others], calculator
+        )
+
+        new_window_nodes = set(new_window)
+        for other_agv in other_agvs:
+            affected_nodes = other_window_nodes[other_agv.agv_id] & changed_nodes
+            if not affected_nodes:
+                continue
+
+            common_nodes = set(other_agv.common_nodes or [])
+            for node in affected_nodes:
+                # Still shared if this AGV or any third AGV passes the node
+                if node in new_window_nodes or any(
+                    node in window_nodes
+                    for agv_id, window_nodes in other_window_nodes.items()
+                    if agv_id != other_agv.agv_id
+                ):
+                    common_nodes.add(node)
+                else:
+                    common_nodes.discard(node)
+
+            _save_common_nodes_if_changed(
+                other_agv,
+                [
+                    node
+                    for node in other_windows[other_agv.agv_id]
+                    if node in common_nodes
+                ],
+                calculator,
+            )
+
+
+def _save_common_nodes_if_changed(
+    agv: Agv, common_nodes: List[int], calculator: CommonNodesCalculator
+) -> None:
+    adjacent_common_nodes = calculator.calculate_sequential_common_nodes(common_nodes)
+    if (
+        agv.common_nodes == common_nodes
+        and agv.adjacent_common_nodes == adjacent_common_nodes
+    ):
+        return
+    agv.common_nodes = common_nodes
+    agv.adjacent_common_nodes = adjacent_common_nodes
+    agv.save(update_fields=["common_nodes", "adjacent_common_nodes"])
+
+
+def get_node_loads(exclude_agv_id: Optional[int] = None) -> Counter:
+    """
+    Count the AGVs whose remaining path passes every node.
+
+    Args:
+        exclude_agv_id: AGV whose own path is not counted
+
+    Returns:
+        Counter: Number of AGV paths by node
+    """
+    node_loads = Counter()
+    for remaining_path in (
+        Agv.objects.filter(ROUTE_LEFT)
+        .exclude(agv_id=exclude_agv_id)
+        .values_list(REMAINING_PATH, flat=True)
+    ):
+        node_loads.update(set(remaining_path or []))
+    return node_loads
+
+
+def get_common_nodes_calculator() -> CommonNodesCalculator:
+    """Get a calculator for the current map, built on first use."""
+    global _calculator
+    with _calculator_lock:
+        if _calculator is None:
+            connections = [
+                {"node1": int(node1), "node2": int(node2), "distance": distance}
+                for node1, node2, distance in Connection.objects.values_list(
+                    "node1", "node2", "distance"
+                )
+            ]
+            _calculator = CommonNodesCalculator(connections)
+        return _calculator
+
+
+def reset_common_nodes_calculator() -> None:
+    """Drop the cached calculator, e.g. after the map data changed."""
+    global _calculator
+    with _calculator_lock:
+        _calculator = None
+
+
+def is_horizon_enabled() -> bool:
+    """Check if common nodes are limited to a look-ahead horizon of every path."""
+    return (
+        settings.COMMON_NODES_HORIZON_NODES > 0
+        or settings.COMMON_NODES_HORIZON_SECONDS > 0
+    )
+
+
+@contextlib.contextmanager
+def coalesce_common_nodes_recalculation():
+    """
+    Defer common node recalculations of the current thread, e.g. during a batch of
+    order assignments or a scheduler tick. Calls to recalculate_all_common_nodes()
+    inside the block only mark the common nodes stale; if any did, the common nodes
+    are recalculated once when the outermost block exits, also after an exception.
+    """
+    depth = getattr(_coalescing, "depth", 0)
+    if depth == 0:
+        _coalescing.stale = False
+        _coalescing.log_summary = False
+        _coalescing.callbacks = []
+    _coalescing.depth = depth + 1
+    try:
+        yield
+    finally:
+        _coalescing.depth = depth
+        if depth == 0:
+            if _coalescing.stale:
+                _coalescing.stale = False
+                recalculate_all_common_nodes(log_summary=_coalescing.log_summary)
+            callbacks, _coalescing.callbacks = _coalescing.callbacks, []
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Error running a deferred common nodes callback")
+
+
+def run_after_common_nodes_recalculation(callback: Callable[[], None]) -> None:
+    """
+    Run a callback that reads common nodes once they are up to date: right away, or
+    inside a coalesce_common_nodes_recalculation() block after its recalculation.
+    """
+    if getattr(_coalescing, "depth", 0) > 0:
+        _coalescing.callbacks.append(callback)
+        return
+    callback()
+
+
+def _should_sample_summary() -> bool:
+    """Check if this recalculation's summary is logged, one in every N."""
+    global _recalculations_since_summary
+    sample_every = max(1, settings.COMMON_NODES_SUMMARY_SAMPLE_EVERY)
+    with _summary_lock:
+        _recalculations_since_summary += 1
+        if _recalculations_since_summary < sample_every:
+            return False
+        _recalculations_since_summary = 0
+        return True
+
+
+def log_common_nodes_summary(active_agvs: Optional[List[Agv]] = None) -> None:
     """
     Log a summary of common nodes for all active AGVs.
     Useful for debugging and monitoring the path planning system.
+
+    Args:
+        active_agvs: AGVs with active orders that are already loaded, queried if not
+            given
     """
     try:
-        active_agvs = Agv.objects.filter(active_order__isnull=False)
+        if active_agvs is None:
+            active_agvs = list(Agv.objects.filter(ROUTE_LEFT))
 
-        if not active_agvs.exists():
-            print("No active AGVs found for common nodes summary")
+        if not active_agvs:
+            logger.info("No active AGVs found for common nodes summary")
             return
 
-        print(f"\n=== Common Nodes Summary for {active_agvs.count()} Active AGVs ===")
+        agvs_with_common_nodes = sum(1 for agv in active_agvs if agv.common_nodes)
+        total_common_nodes = sum(len(agv.common_nodes or []) for agv in active_agvs)
+        logger.info(
+            f"Common nodes summary: {len(active_agvs)} active AGVs, "
+            f"{agvs_with_common_nodes} share nodes, {total_common_nodes} common nodes"
+        )
 
+        # The per-AGV detail is only built when debug logging is enabled
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         for agv in active_agvs:
-            common_count = len(agv.common_nodes) if agv.common_nodes else 0
-            adjacent_count = (
-                len(agv.adjacent_common_nodes) if agv.adjacent_common_nodes else 0
+            logger.debug(
+                f"AGV {agv.agv_id}: Path Length={len(agv.remaining_path or [])}, "
+                f"Common nodes={agv.common_nodes or []}, "
+                f"Adjacent common={agv.adjacent_common_nodes or []}"
             )
-            path_length = len(agv.remaining_path) if agv.remaining_path else 0
-
-            print(
-                f"AGV {agv.agv_id}: Path Length={path_length}, Common Nodes={common_count}, Adjacent Common={adjacent_count}"
-            )
-
-            if agv.common_nodes:
-                print(f"  Common nodes: {agv.common_nodes}")
-            if agv.adjacent_common_nodes:
-                print(f"  Adjacent common nodes: {agv.adjacent_common_nodes}")
-
-        print("=" * 50)
 
     except Exception as e:
         print(f"Error generating common nodes summary: {str(e)}")
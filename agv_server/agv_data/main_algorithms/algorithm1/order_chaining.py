@@ -0,0 +1,202 @@
+"""
+Order chaining for the DSPA task dispatcher.
+
+Orders are bound to a parking node, and only an idle AGV of that parking node takes
+them. Under load an order often finds no idle AGV and stays pending while the AGV
+it waits for is still out. With ORDER_CHAINING, an AGV that reaches the workstation
+of its order takes the oldest pending order of its parking node right away: the
+route continues from the workstation to the next storage node instead of driving
+back to parking first. With AGV_ASSIGNMENT_MODE "nearest" the pending orders of
+every parking node qualify, the AGV still returns to its own parking node.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from order_data.models import Order
+from ...metrics import REGISTRY
+from ...models import ROUTE_FIELDS, Agv
+from .common_nodes import get_common_nodes_calculator, recalculate_all_common_nodes
+from .algorithm1 import NEAREST_ASSIGNMENT, TaskDispatcher
+
+logger = logging.getLogger(__name__)
+
+ORDERS_CHAINED = REGISTRY.counter(
+    "agv_orders_chained_total",
+    "Pending orders an AGV took at a workstation instead of returning to parking",
+)
+
+
+class OrderChainer:
+    """Splices the next pending order into the route of an AGV at its workstation."""
+
+    def __init__(self, agv: Agv):
+        self.agv = agv
+
+    def chain_next_order(self) -> bool:
+        """
+        Take the oldest pending order of the AGV's parking node that is reached
+        sooner from the workstation than through the parking node.
+
+        The dispatcher's assignment lock keeps the scheduler of this process from
+        assigning the order meanwhile. If another process assigned it first, the
+        AGV keeps its delivered order and returns to parking.
+
+        Returns:
+            bool: True if the AGV continues with a new order, its delivered order is
+            then complete
+        """
+        if not settings.ORDER_CHAINING or not self.agv.active_order:
+            return False
+
+        # Imported here, the dispatcher service imports this package
+        from ...dispatcher_service import get_dispatcher_service
+
+        delivered_order_id = self.agv.active_order.order_id
+        try:
+            dispatcher = get_dispatcher_service().get_dispatcher()
+            with dispatcher.assignment_lock:
+                chain = self._find_chain(dispatcher)
+                if chain is None or not self._claim_and_start(*chain):
+                    return False
+        except Exception:
+            logger.exception(f"Error chaining an order to AGV {self.agv.agv_id}")
+            return False
+
+        order = self.agv.active_order
+        ORDERS_CHAINED.inc()
+        logger.info(
+            f"AGV {self.agv.agv_id} completed order {delivered_order_id} and chained "
+            f"order {order.order_id}, remaining path: {self.agv.remaining_path}"
+        )
+        recalculate_all_common_nodes(log_summary=True)
+        return True
+
+    def _claim_and_start(
+        self, order: Order, outbound_path: List[int], inbound_path: List[int]
+    ) -> bool:
+        """
+        Claim a pending order by clearing its pending_since and put it on the AGV.
+        If saving the AGV fails, e.g. because another process assigned the order,
+        the claim is rolled back and the AGV is reloaded.
+
+        Returns:
+            bool: True if the AGV took the order
+        """
+        pending_since = order.pending_since
+        try:
+            with transaction.atomic():
+                # Another AGV or the scheduler may take the order at the same time
+                if not Order.objects.filter(
+                    order_id=order.order_id,
+                    pending_since__isnull=False,
+                    active_agv__isnull=True,
+                ).update(pending_since=None):
+                    return False
+                self._start_order(order, outbound_path, inbound_path)
+        except Exception:
+            # Usually an IntegrityError, another process assigned the order first
+            logger.exception(
+                f"AGV {self.agv.agv_id} could not chain order {order.order_id}"
+            )
+            # The transaction restored pending_since, only the instance is stale
+            self.agv.refresh_from_db()
+            order.pending_since = pending_since
+            return False
+        return True
+
+    def _find_chain(
+        self, dispatcher: TaskDispatcher
+    ) -> Optional[Tuple[Order, List[int], List[int]]]:
+        """
+        Returns:
+            Optional[Tuple[Order, List[int], List[int]]]: The order with its outbound
+            path from the current node and its inbound path, None if no pending order
+            pays off
+        """
+        engine = dispatcher.get_pathfinding_algorithm("dijkstra")
+        workstation_node = self.agv.current_node
+        parking_node = self.agv.preferred_parking_node
+        return_cost = self._get_path_cost(self.agv.inbound_path)
+
+        pending_orders = Order.objects.filter(
+            active_agv__isnull=True, pending_since__isnull=False
+        )
+        if settings.AGV_ASSIGNMENT_MODE != NEAREST_ASSIGNMENT:
+            # Only AGVs of an order's parking node may take it
+            pending_orders = pending_orders.filter(parking_node=parking_node)
+        pending_orders = pending_orders.order_by("pending_since")[
+            : settings.ORDER_CHAINING_CANDIDATES
+        ]
+        for order in pending_orders:
+            path_to_storage = engine.find_shortest_path(
+                workstation_node, order.storage_node
+            )
+            path_from_parking = engine.find_shortest_path(
+                parking_node, order.storage_node
+            )
+            if not path_to_storage or not path_from_parking:
+                continue
+            # Driving to the storage node directly must beat the detour via parking
+            chained_cost = self._get_path_cost(path_to_storage)
+            via_parking_cost = return_cost + self._get_path_cost(path_from_parking)
+            if chained_cost >= via_parking_cost:
+                continue
+
+            path_to_workstation = engine.find_shortest_path(
+                order.storage_node, order.workstation_node
+            )
+            path_to_parking = engine.find_shortest_path(
+                order.workstation_node, parking_node
+            )
+            if not path_to_workstation or not path_to_parking:
+                continue
+            return order, path_to_storage + path_to_workstation[1:], path_to_parking
+
+        return None
+
+    def _start_order(
+        self, order: Order, outbound_path: List[int], inbound_path: List[int]
+    ) -> None:
+        """Replace the delivered order with the chained one, like update_agv_with_order."""
+        agv = self.agv
+        agv.active_order = order
+        agv.initial_path = outbound_path + inbound_path[1:]
+        agv.outbound_path = outbound_path
+        agv.inbound_path = inbound_path
+        agv.set_route(agv.initial_path, end=len(outbound_path))
+        # The route starts at the workstation the AGV stands on
+        agv.advance_route()
+        agv.journey_phase = Agv.OUTBOUND
+        agv.next_node = agv.remaining_path[0] if agv.remaining_path else None
+        agv.reserved_node = None
+        agv.reserved_segment = []
+        # Backup nodes were allocated for the shared nodes of the delivered order
+        agv.spare_flag = False
+        agv.backup_nodes = {}
+        agv.save(
+            update_fields=[
+                "active_order",
+                "initial_path",
+                "outbound_path",
+                "inbound_path",
+                *ROUTE_FIELDS,
+                "journey_phase",
+                "next_node",
+                "reserved_node",
+                "reserved_segment",
+                "spare_flag",
+                "backup_nodes",
+            ]
+        )
+
+    @staticmethod
+    def _get_path_cost(path: List[int]) -> float:
+        distances = get_common_nodes_calculator().distances
+        return sum(
+            distances.get((node, next_node), 0)
+            for node, next_node in zip(path, path[1:])
+        )
@@ -3,9 +3,12 @@ Order processing module for the DSPA algorithm.
 This replaces the schedule generator module from the schedule_generate app.
 """
 
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Mapping, Optional, Tuple
 from order_data.models import Order
 from ...models import Agv
+from ...pathfinding.k_shortest import AlternativePaths, pick_least_loaded
+from ...pathfinding.turn_penalized import TurnPenalizedDijkstra
+from .common_nodes import get_node_loads
 
 
 class OrderProcessor:
@@ -13,16 +16,57 @@ class OrderProcessor:
     Processes orders to generate paths and update AGV information.
     """
 
-    def __init__(self, pathfinding_algorithm_instance):
+    def __init__(
+        self,
+        pathfinding_algorithm_instance,
+        alternative_paths: Optional[AlternativePaths] = None,
+    ):
         """
         Initialize the processor with a pathfinding algorithm.
 
         Args:
-            pathfinding_algorithm_instance: Instance of a pathfinding algorithm"""
+            pathfinding_algorithm_instance: Instance of a pathfinding algorithm
+            alternative_paths: Precomputed k shortest paths; if given, every leg takes
+                the alternative that the fewest active AGVs' paths pass"""
         self.pathfinding_algorithm = pathfinding_algorithm_instance
+        self.alternative_paths = alternative_paths
+
+    def _find_path(
+        self, start: int, end: int, node_loads: Mapping[int, int]
+    ) -> List[int]:
+        """Find the path of one leg of an order, empty if there is none."""
+        if self.alternative_paths is None:
+            return self.pathfinding_algorithm.find_shortest_path(start, end)
+        return (
+            pick_least_loaded(self.alternative_paths.get_paths(start, end), node_loads)
+            or []
+        )
+
+    def _find_legs(
+        self, waypoints: List[int], previous_node: Optional[int]
+    ) -> List[List[int]]:
+        """Find the path of every leg between consecutive waypoints."""
+        if self.alternative_paths is None and isinstance(
+            self.pathfinding_algorithm, TurnPenalizedDijkstra
+        ):
+            # Legs are chained so turning around at a waypoint is charged
+            return self.pathfinding_algorithm.find_shortest_path_chain(
+                waypoints, previous_node
+            )
+
+        # Load of every node, to balance the legs over the alternative paths
+        node_loads = get_node_loads() if self.alternative_paths else {}
+        return [
+            self._find_path(start, end, node_loads)
+            for start, end in zip(waypoints, waypoints[1:])
+        ]
 
     def _compute_path(
-        self, order: Order
+        self,
+        order: Order,
+        start_node: Optional[int] = None,
+        return_node: Optional[int] = None,
+        previous_node: Optional[int] = None,
     ) -> Tuple[Optional[List[int]], Optional[List[int]]]:
         """
         Compute shortest path for an order using the pathfinding algorithm.
@@ -30,6 +74,12 @@ class OrderProcessor:
 
         Args:
             order (Order): The order to compute path for.
+            start_node (Optional[int]): Where the AGV starts, the order's parking
+                node if None
+            return_node (Optional[int]): Where the AGV returns to, the order's
+                parking node if None
+            previous_node (Optional[int]): The node the AGV arrived at start_node
+                from, for pathfinding that charges turns
 
         Returns:
             Tuple[Optional[List[int]], Optional[List[int]]]: Tuple of computed paths:
@@ -37,24 +87,21 @@ class OrderProcessor:
              inbound_path from workstation → parking)
             None for either path if it could not be computed.
         """
-        # Find path from parking to storage
-        path_to_storage = self.pathfinding_algorithm.find_shortest_path(
-            order.parking_node, order.storage_node
-        )
-
-        # Find path from storage to workstation
-        path_to_workstation = self.pathfinding_algorithm.find_shortest_path(
-            order.storage_node, order.workstation_node
-        )
-
-        # Find path from workstation back to parking
-        path_to_parking = self.pathfinding_algorithm.find_shortest_path(
-            order.workstation_node, order.parking_node
+        if start_node is None:
+            start_node = order.parking_node
+        if return_node is None:
+            return_node = order.parking_node
+
+        # Find the paths parking → storage → workstation → parking
+        legs = self._find_legs(
+            [start_node, order.storage_node, order.workstation_node, return_node],
+            previous_node,
         )
 
         # Check if all paths were found successfully
-        if not all([path_to_storage, path_to_workstation, path_to_parking]):
+        if len(legs) != 3 or not all(legs):
             return None, None
+        path_to_storage, path_to_workstation, path_to_parking = legs
 
         # Combine outbound path: parking → storage → workstation
         # Remove duplicate storage_node when connecting to workstation path
@@ -65,18 +112,32 @@ class OrderProcessor:
 
         return outbound_path, inbound_path
 
-    def process_order(self, order: Order) -> Optional[Dict]:
+    def process_order(
+        self,
+        order: Order,
+        start_node: Optional[int] = None,
+        return_node: Optional[int] = None,
+        previous_node: Optional[int] = None,
+    ) -> Optional[Dict]:
         """
         Process an order to generate path data without updating database.
 
         Args:
             order (Order): The order to process.
+            start_node (Optional[int]): Where the AGV starts, the order's parking
+                node if None
+            return_node (Optional[int]): Where the AGV returns to, the order's
+                parking node if None
+            previous_node (Optional[int]): The node the AGV arrived at start_node
+                from, for pathfinding that charges turns
 
         Returns:
             Optional[Dict]: Generated order data dictionary or None if path not found
         """
         # Find shortest route paths for outbound and return journeys
-        outbound_path, inbound_path = self._compute_path(order)
+        outbound_path, inbound_path = self._compute_path(
+            order, start_node, return_node, previous_node
+        )
         if not outbound_path or not inbound_path:
             return None
 
@@ -119,8 +180,10 @@ class OrderProcessor:
             order = Order.objects.get(order_id=order_data["order_id"])
             agv.active_order = order
             agv.initial_path = order_data["initial_path"]
-            # Initially the outbound path
-            agv.remaining_path = order_data["remaining_path"]
+            # The whole route, the remaining path is initially its outbound part
+            agv.set_route(
+                order_data["initial_path"], end=len(order_data["outbound_path"])
+            )
             agv.common_nodes = order_data["common_nodes"]
             agv.adjacent_common_nodes = order_data["adjacent_common_nodes"]
             agv.journey_phase = Agv.OUTBOUND  # Start with the outbound journey
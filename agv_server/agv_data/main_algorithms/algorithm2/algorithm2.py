@@ -1,5 +1,14 @@
-from typing import Optional, List
-from ...models import Agv
+from typing import Optional, List, Dict, Tuple
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.db import models
+from django.db.models import F, Func, Q, Value
+from ...fleet_state import get_fleet_state
+from ...models import REMAINING_PATH, ROUTE_FIELDS, Agv
+from ...rerouting import get_time
+from ..algorithm1.order_chaining import OrderChainer
+from ...encode_decode_data_frames.frame_format import MAX_RESERVATION_HORIZON
+from ...zones import ZONE_HANDOFFS, get_zone_map, is_sharded
 import logging
 
 logger = logging.getLogger(__name__)
@@ -29,18 +38,17 @@ class PositionManager:
     def _should_remove_current_node_from_path(self, current_node: int) -> bool:
         """Check if current node should be removed from remaining path."""
         return (
-            self.agv.remaining_path
-            and len(self.agv.remaining_path) > 0
-            and current_node == self.agv.remaining_path[0]
+            not self.agv.has_finished_route_phase()
+            and current_node == self.agv.route[self.agv.route_cursor]
         )
 
     def _remove_current_node_from_path(self, current_node: int) -> None:
-        """Remove current node from remaining path."""
+        """Remove current node from remaining path by moving the route cursor past it."""
         logger.debug(
             f"AGV {self.agv.agv_id} reached node {current_node}, removing from remaining path"
         )
-        self.agv.remaining_path = self.agv.remaining_path[1:]
-        self.agv.save(update_fields=["remaining_path"])
+        self.agv.advance_route()
+        self.agv.save(update_fields=["route_cursor"])
 
     def _update_next_node(self) -> None:
         """Update next node based on remaining path."""
@@ -63,10 +71,34 @@ class SharedNodesManager:
 
     def update_shared_nodes(self, current_node: int) -> None:
         """Update common nodes and adjacent common nodes when reaching a node."""
+        from ..algorithm1.common_nodes import is_horizon_enabled
+
+        if is_horizon_enabled():
+            self._refresh_horizon_common_nodes(current_node)
+            return
+
         self._remove_from_shared_nodes(current_node, "common_nodes")
         self._remove_from_shared_nodes(current_node, "adjacent_common_nodes")
         self._cleanup_insufficient_adjacent_nodes()
 
+    def _refresh_horizon_common_nodes(self, current_node: int) -> None:
+        """
+        Update the common nodes between this AGV's horizon window and the other
+        AGVs after it moved. The window slides along the path, so nodes can also
+        become shared, which removing the reached node can not express. The windows
+        of the other AGVs did not move, so only their pairs with this AGV change.
+        """
+        if self.agv.previous_node == current_node:
+            # Still on the same node, no window moved
+            return
+
+        from ..algorithm1.common_nodes import update_common_nodes_for_path_change
+
+        # Before the move the remaining path started with the reached node
+        update_common_nodes_for_path_change(
+            self.agv, [current_node, *self.agv.remaining_path]
+        )
+
     def _remove_from_shared_nodes(self, node: int, field_name: str) -> None:
         """Remove node from shared node lists of this and other AGVs if appropriate."""
         self._remove_from_current_agv(node, field_name)
@@ -83,24 +115,43 @@ class SharedNodesManager:
     def _remove_from_other_agvs_if_needed(self, node: int, field_name: str) -> None:
         """Remove node from other AGVs if only one or no other AGV has this node."""
         filter_kwargs = {f"{field_name}__contains": [node]}
-        other_agvs_with_node = Agv.objects.filter(**filter_kwargs).exclude(
-            agv_id=self.agv.agv_id
+        # Two rows are enough to know whether more than one other AGV has the node
+        other_agv_ids = list(
+            Agv.objects.filter(**filter_kwargs)
+            .exclude(agv_id=self.agv.agv_id)
+            .values_list("agv_id", flat=True)[:2]
         )
 
-        if other_agvs_with_node.count() <= 1:
-            for other_agv in other_agvs_with_node:
-                other_shared_nodes = getattr(other_agv, field_name)
-                if node in other_shared_nodes:
-                    other_shared_nodes.remove(node)
-                    setattr(other_agv, field_name, other_shared_nodes)
-                    other_agv.save(update_fields=[field_name])
+        if len(other_agv_ids) == 1:
+            Agv.objects.filter(agv_id__in=other_agv_ids).update(
+                **{
+                    field_name: Func(
+                        F(field_name),
+                        Value(node),
+                        function="array_remove",
+                        output_field=ArrayField(models.IntegerField()),
+                    )
+                }
+            )
+            Agv.broadcast_updates(other_agv_ids, update_fields=[field_name])
 
     def _cleanup_insufficient_adjacent_nodes(self) -> None:
         """Clear adjacent_common_nodes for all AGVs if they have less than 2 nodes."""
-        for agv in Agv.objects.all():
-            if len(agv.adjacent_common_nodes) < 2:
-                agv.adjacent_common_nodes = []
-                agv.save(update_fields=["adjacent_common_nodes"])
+        # Only lists with exactly one node change, empty lists are already cleared
+        agv_ids = list(
+            Agv.objects.filter(adjacent_common_nodes__len=1).values_list(
+                "agv_id", flat=True
+            )
+        )
+        if not agv_ids:
+            return
+
+        Agv.objects.filter(agv_id__in=agv_ids, adjacent_common_nodes__len=1).update(
+            adjacent_common_nodes=[]
+        )
+        if self.agv.agv_id in agv_ids:
+            self.agv.adjacent_common_nodes = []
+        Agv.broadcast_updates(agv_ids, update_fields=["adjacent_common_nodes"])
 
 
 class JourneyPhaseManager:
@@ -112,6 +163,7 @@ class JourneyPhaseManager:
     def check_journey_phase_transition(self, current_node: int) -> None:
         """Check if the AGV should transition between journey phases or complete order."""
         if not self.agv.active_order:
+            self._finish_reposition_if_arrived()
             return
 
         if self.agv.journey_phase == Agv.OUTBOUND:
@@ -119,21 +171,46 @@ class JourneyPhaseManager:
         elif self.agv.journey_phase == Agv.INBOUND:
             self._handle_inbound_phase(current_node)
 
+    def _finish_reposition_if_arrived(self) -> None:
+        """
+        An idle AGV sent to a staging node (see prepositioning) drives a route
+        without an order, it is idle again once it got there.
+        """
+        if self.agv.route and self.agv.has_finished_route_phase():
+            logger.info(
+                f"AGV {self.agv.agv_id} reached staging node {self.agv.current_node}"
+            )
+            self._reset_agv_to_idle()
+            self._recalculate_common_nodes()
+
     def _handle_outbound_phase(self, current_node: int) -> None:
         """Handle outbound to inbound transition."""
         workstation_node = self.agv.active_order.workstation_node
 
         if current_node == workstation_node and self._is_outbound_journey_complete():
+            # With order chaining the AGV may continue with a pending order instead
+            if OrderChainer(self.agv).chain_next_order():
+                return
             self._transition_to_inbound_journey()
 
     def _handle_inbound_phase(self, current_node: int) -> None:
         """Handle inbound phase validation and order completion."""
         self._validate_inbound_remaining_path(current_node)
 
-        parking_node = self.agv.active_order.parking_node
+        parking_node = self._get_return_node()
         if current_node == parking_node and self._is_inbound_journey_complete():
             self._complete_order_journey()
 
+    def _get_return_node(self) -> int:
+        """
+        Get the parking node the AGV returns to: the end of its inbound path, which is
+        its own parking node when it was not assigned by the order's parking node
+        (AGV_ASSIGNMENT_MODE "nearest").
+        """
+        if self.agv.inbound_path:
+            return self.agv.inbound_path[-1]
+        return self.agv.active_order.parking_node
+
     def _is_inbound_journey_complete(self) -> bool:
         """
         Check if the inbound journey is complete.
@@ -141,13 +218,10 @@ class JourneyPhaseManager:
         Returns:
             True if remaining path is empty or AGV is at parking node
         """
-        if not self.agv.remaining_path or len(self.agv.remaining_path) == 0:
+        if self.agv.has_finished_route_phase():
             return True
 
-        if (
-            self.agv.active_order
-            and self.agv.current_node == self.agv.active_order.parking_node
-        ):
+        if self.agv.active_order and self.agv.current_node == self._get_return_node():
             return True
 
         return False
@@ -157,9 +231,9 @@ class JourneyPhaseManager:
         Check if the outbound journey is complete.
 
         Returns:
-            True if remaining path matches inbound path or is empty at workstation
+            True if every node of the outbound part of the route was visited
         """
-        if not self.agv.remaining_path or len(self.agv.remaining_path) == 0:
+        if self.agv.has_finished_route_phase():
             logger.debug(
                 f"AGV {self.agv.agv_id} outbound journey complete: no remaining path"
             )
@@ -171,24 +245,8 @@ class JourneyPhaseManager:
             )
             return True
 
-        if self.agv.remaining_path == self.agv.inbound_path:
-            logger.debug(
-                f"AGV {self.agv.agv_id} outbound journey complete: remaining path matches inbound path"
-            )
-            return True
-
-        if (
-            len(self.agv.remaining_path) <= len(self.agv.inbound_path)
-            and self.agv.remaining_path
-            == self.agv.inbound_path[: len(self.agv.remaining_path)]
-        ):
-            logger.debug(
-                f"AGV {self.agv.agv_id} outbound journey complete: remaining path is subset of inbound path"
-            )
-            return True
-
         logger.debug(
-            f"AGV {self.agv.agv_id} outbound journey not complete. Remaining: {self.agv.remaining_path}, Inbound: {self.agv.inbound_path}"
+            f"AGV {self.agv.agv_id} outbound journey not complete. Route cursor {self.agv.route_cursor} of {self.agv.route_end}"
         )
         return False
 
@@ -206,35 +264,36 @@ class JourneyPhaseManager:
 
     def _is_at_parking_node(self, current_node: int) -> bool:
         """Check if AGV is at the parking node."""
-        return (
-            self.agv.active_order and current_node == self.agv.active_order.parking_node
-        )
+        return self.agv.active_order and current_node == self._get_return_node()
 
     def _clear_remaining_path_at_parking(self) -> None:
         """Clear remaining path when AGV reaches parking node."""
-        if self.agv.remaining_path:
+        if not self.agv.has_finished_route_phase():
             logger.info(
                 f"AGV {self.agv.agv_id} has reached parking node, clearing remaining path for order completion"
             )
-            self.agv.remaining_path = []
+            self.agv.clear_route()
             self.agv.next_node = None
             self.agv.reserved_node = None
+            self.agv.reserved_segment = []
             self.agv.save(
-                update_fields=["remaining_path", "next_node", "reserved_node"]
+                update_fields=[
+                    *ROUTE_FIELDS,
+                    "next_node",
+                    "reserved_node",
+                    "reserved_segment",
+                ]
             )
 
     def _should_fix_remaining_path(self) -> bool:
         """Check if remaining path needs correction."""
-        if not self.agv.remaining_path:
+        if self.agv.has_finished_route_phase():
             logger.warning(
                 f"AGV {self.agv.agv_id} in inbound phase but has no remaining path"
             )
             return True
 
-        if (
-            len(self.agv.remaining_path) > len(self.agv.inbound_path)
-            or not self._is_valid_inbound_remaining_path()
-        ):
+        if not self._is_valid_inbound_remaining_path():
             logger.warning(
                 f"AGV {self.agv.agv_id} in inbound phase but remaining path doesn't match inbound structure"
             )
@@ -246,13 +305,13 @@ class JourneyPhaseManager:
         """Fix the remaining path for inbound journey."""
         logger.info(f"Fixing remaining path for AGV {self.agv.agv_id} in inbound phase")
 
-        self.agv.remaining_path = self.agv.inbound_path.copy()
+        self.agv.set_route(self.agv.inbound_path)
 
         if self._should_remove_current_node_from_remaining_path(current_node):
             logger.info(
                 f"AGV {self.agv.agv_id} is at node {current_node}, removing from remaining path"
             )
-            self.agv.remaining_path = self.agv.remaining_path[1:]
+            self.agv.advance_route()
 
         self._update_next_and_reserved_nodes()
 
@@ -265,9 +324,8 @@ class JourneyPhaseManager:
     ) -> bool:
         """Check if current node should be removed from remaining path."""
         return (
-            self.agv.remaining_path
-            and len(self.agv.remaining_path) > 0
-            and current_node == self.agv.remaining_path[0]
+            not self.agv.has_finished_route_phase()
+            and current_node == self.agv.route[self.agv.route_cursor]
         )
 
     def _update_next_and_reserved_nodes(self) -> None:
@@ -278,21 +336,28 @@ class JourneyPhaseManager:
             self.agv.next_node = None
 
         self.agv.reserved_node = None
-        self.agv.save(update_fields=["remaining_path", "next_node", "reserved_node"])
+        self.agv.reserved_segment = []
+        self.agv.save(
+            update_fields=[
+                *ROUTE_FIELDS,
+                "next_node",
+                "reserved_node",
+                "reserved_segment",
+            ]
+        )
 
     def _is_valid_inbound_remaining_path(self) -> bool:
-        """Check if the current remaining path is a valid subset of the inbound path."""
-        if not self.agv.inbound_path or not self.agv.remaining_path:
+        """
+        Check if the inbound phase runs to the end of the route and the route ends at
+        the end of the inbound path (the parking node).
+        """
+        if not self.agv.inbound_path or not self.agv.route:
             return False
 
-        for i in range(len(self.agv.inbound_path)):
-            if (
-                len(self.agv.remaining_path) <= len(self.agv.inbound_path) - i
-                and self.agv.remaining_path
-                == self.agv.inbound_path[i : i + len(self.agv.remaining_path)]
-            ):
-                return True
-        return False
+        return (
+            self.agv.route_end == len(self.agv.route)
+            and self.agv.route[-1] == self.agv.inbound_path[-1]
+        )
 
     def _transition_to_inbound_journey(self) -> None:
         """Transition AGV from outbound to inbound journey phase."""
@@ -312,20 +377,25 @@ class JourneyPhaseManager:
     def _set_inbound_journey_state(self) -> None:
         """Set the AGV state for inbound journey."""
         self.agv.journey_phase = Agv.INBOUND
-        self.agv.remaining_path = self.agv.inbound_path.copy()
+        # The inbound path follows the workstation in the route, whose cursor is
+        # already past the workstation
+        if not self.agv.start_next_route_phase():
+            self.agv.set_route(self.agv.inbound_path)
 
-        if self._should_remove_current_node_from_remaining_path(self.agv.current_node):
-            logger.info(
-                f"AGV {self.agv.agv_id} is already at workstation node {self.agv.current_node}, removing from remaining path"
-            )
-            self.agv.remaining_path = self.agv.remaining_path[1:]
+            if self._should_remove_current_node_from_remaining_path(
+                self.agv.current_node
+            ):
+                logger.info(
+                    f"AGV {self.agv.agv_id} is already at workstation node {self.agv.current_node}, removing from remaining path"
+                )
+                self.agv.advance_route()
 
         self._update_next_and_reserved_nodes()
 
         self.agv.save(
             update_fields=[
                 "journey_phase",
-                "remaining_path",
+                *ROUTE_FIELDS,
                 "next_node",
                 "reserved_node",
             ]
@@ -357,7 +427,7 @@ class JourneyPhaseManager:
         # Clear order-related data
         self.agv.active_order = None
         self.agv.initial_path = []
-        self.agv.remaining_path = []
+        self.agv.clear_route()
         self.agv.outbound_path = []
         self.agv.inbound_path = []
         self.agv.common_nodes = []
@@ -368,6 +438,7 @@ class JourneyPhaseManager:
         self.agv.motion_state = Agv.IDLE
         self.agv.next_node = None
         self.agv.reserved_node = None
+        self.agv.reserved_segment = []
         self.agv.direction_change = Agv.TURN_AROUND
 
         # Clear deadlock-related flags
@@ -375,12 +446,13 @@ class JourneyPhaseManager:
         self.agv.backup_nodes = {}
         self.agv.waiting_for_deadlock_resolution = False
         self.agv.deadlock_partner_agv_id = None
+        self.agv.waiting_since = None
 
         self.agv.save(
             update_fields=[
                 "active_order",
                 "initial_path",
-                "remaining_path",
+                *ROUTE_FIELDS,
                 "outbound_path",
                 "inbound_path",
                 "common_nodes",
@@ -389,11 +461,13 @@ class JourneyPhaseManager:
                 "motion_state",
                 "next_node",
                 "reserved_node",
+                "reserved_segment",
                 "direction_change",
                 "spare_flag",
                 "backup_nodes",
                 "waiting_for_deadlock_resolution",
                 "deadlock_partner_agv_id",
+                "waiting_since",
             ]
         )
 
@@ -410,34 +484,159 @@ class JourneyPhaseManager:
             logger.error(f"Failed to recalculate common nodes: {str(e)}")
 
 
+class LookAheadSafetyChecker:
+    """
+    Proactive deadlock avoidance over the next k nodes of every AGV's remaining path.
+
+    Every node is treated as a single-capacity resource. A reservation of next_node is
+    only granted if, afterwards, there still is an order in which all AGVs sharing the
+    corridor can advance through their look-ahead windows (banker's algorithm safety check).
+    """
+
+    def __init__(self, agv: Agv, horizon: int):
+        self.agv = agv
+        self.horizon = horizon
+
+    def is_reservation_safe(self) -> bool:
+        """Check whether reserving next_node keeps the shared corridor deadlock free."""
+        if self.horizon <= 0 or not self.agv.next_node or self.agv.current_node is None:
+            return True
+
+        own_window = self._build_window(self.agv.current_node, self.agv.remaining_path)
+        corridor_windows = self._get_corridor_windows(own_window[0])
+        if not corridor_windows:
+            return True
+
+        corridor_windows[self.agv.agv_id] = own_window
+        if not self._is_safe_state(corridor_windows):
+            # A deadlock is already unavoidable without this reservation, refusing it
+            # does not help. Leave it to the deadlock resolution of Algorithm 3.
+            return True
+
+        nodes, leaves_horizon = own_window
+        corridor_windows[self.agv.agv_id] = (nodes[1:], leaves_horizon)
+        if self._is_safe_state(corridor_windows):
+            return True
+
+        logger.info(
+            f"AGV {self.agv.agv_id} reservation of node {self.agv.next_node} refused: "
+            f"head-on or loop deadlock would become unavoidable within {self.horizon} nodes"
+        )
+        return False
+
+    def _build_window(
+        self, current_node: int, remaining_path: List[int]
+    ) -> Tuple[List[int], bool]:
+        """
+        Build the look-ahead window of an AGV.
+
+        Returns:
+            Tuple[List[int], bool]: (current node followed by the next k nodes,
+            whether the remaining path continues beyond the window)
+        """
+        remaining_path = remaining_path or []
+        nodes = [current_node] + list(remaining_path[: self.horizon])
+        return nodes, len(remaining_path) > self.horizon
+
+    def _get_corridor_windows(
+        self, own_nodes: List[int]
+    ) -> Dict[int, Tuple[List[int], bool]]:
+        """Get the look-ahead windows of other AGVs that overlap with this AGV's window."""
+        own_window_nodes = set(own_nodes)
+        windows = {}
+
+        # Only AGVs standing in or heading through this window can overlap with it
+        other_agvs = (
+            Agv.objects.exclude(agv_id=self.agv.agv_id)
+            .annotate(remaining=REMAINING_PATH)
+            .filter(current_node__isnull=False)
+            .filter(
+                Q(current_node__in=own_window_nodes)
+                | Q(
+                    route__overlap=list(own_window_nodes),
+                    remaining__overlap=list(own_window_nodes),
+                )
+            )
+            .values_list("agv_id", "current_node", "remaining")
+        )
+        for agv_id, current_node, remaining_path in other_agvs:
+            window = self._build_window(current_node, remaining_path)
+            if own_window_nodes.intersection(window[0]):
+                windows[agv_id] = window
+
+        return windows
+
+    @staticmethod
+    def _is_safe_state(windows: Dict[int, Tuple[List[int], bool]]) -> bool:
+        """
+        Check if every AGV can drive through its window in some order.
+
+        Like the banker's algorithm, an AGV can finish when every node it still needs is
+        not held by another AGV. An AGV whose path continues beyond the horizon releases
+        its node once it leaves the window; an AGV whose path ends inside the window
+        keeps holding its destination.
+        """
+        held = {agv_id: nodes[0] for agv_id, (nodes, _) in windows.items()}
+        pending = [agv_id for agv_id, (nodes, _) in windows.items() if len(nodes) > 1]
+        # Try AGVs that leave the corridor first, they only ever release nodes
+        pending.sort(key=lambda agv_id: (not windows[agv_id][1], agv_id))
+
+        progress = True
+        while pending and progress:
+            progress = False
+            for agv_id in pending:
+                nodes, leaves_horizon = windows[agv_id]
+                held_by_others = {
+                    node for other_id, node in held.items() if other_id != agv_id
+                }
+                if held_by_others.intersection(nodes[1:]):
+                    continue
+
+                if leaves_horizon:
+                    held.pop(agv_id)
+                else:
+                    held[agv_id] = nodes[-1]
+                pending.remove(agv_id)
+                progress = True
+                break
+
+        return not pending
+
+
 class MovementDecisionManager:
     """Handles movement decision logic for AGVs."""
 
     def __init__(self, agv: Agv):
         self.agv = agv
+        self.lookahead_checker = LookAheadSafetyChecker(
+            agv, settings.CONTROL_POLICY_LOOKAHEAD_NODES
+        )
+        self._lookahead_result = None
 
     def can_move_freely(self) -> bool:
         """Check if AGV can move without any restrictions."""
         if not self.agv.next_node:
             return False
 
-        reserved_nodes = self._get_reserved_nodes_by_others()
+        if not self.is_lookahead_safe():
+            return False
+
+        next_node_reserved = self._are_nodes_reserved_by_others([self.agv.next_node])
 
         # Condition 1: Next node not reserved and not in adjacent common nodes
         if (
-            self.agv.next_node not in reserved_nodes
+            not next_node_reserved
             and self.agv.next_node not in self.agv.adjacent_common_nodes
         ):
             return True
 
         # Condition 2: Next node in adjacent common nodes but safe to move
         if (
-            self.agv.next_node not in reserved_nodes
+            not next_node_reserved
             and self.agv.next_node in self.agv.adjacent_common_nodes
         ):
-            reserved_by_non_spare = self._get_reserved_nodes_by_others(spare_flag=False)
-            adjacent_nodes_blocked = any(
-                node in reserved_by_non_spare for node in self.agv.adjacent_common_nodes
+            adjacent_nodes_blocked = self._are_nodes_reserved_by_others(
+                self.agv.adjacent_common_nodes, spare_flag=False
             )
             return not adjacent_nodes_blocked
 
@@ -448,26 +647,53 @@ class MovementDecisionManager:
         if not self.agv.next_node:
             return False
 
-        reserved_nodes = self._get_reserved_nodes_by_others()
-        return self.agv.next_node not in reserved_nodes
+        if not self.is_lookahead_safe():
+            return False
+
+        return not self._are_nodes_reserved_by_others([self.agv.next_node])
+
+    def is_lookahead_safe(self) -> bool:
+        """Check if reserving next node passes the look-ahead deadlock avoidance check."""
+        decision_key = (self.agv.current_node, self.agv.next_node)
+        if self._lookahead_result is None or self._lookahead_result[0] != decision_key:
+            self._lookahead_result = (
+                decision_key,
+                self.lookahead_checker.is_reservation_safe(),
+            )
+        return self._lookahead_result[1]
 
     def can_move_with_backup(self) -> bool:
         """Check if AGV can move after backup node allocation."""
         if not self.agv.next_node or not self.agv.backup_nodes:
             return False
 
-        reserved_nodes = self._get_reserved_nodes_by_others()
-        reserved_by_non_spare = self._get_reserved_nodes_by_others(spare_flag=False)
+        if self.agv.next_node not in self.agv.adjacent_common_nodes:
+            return False
 
-        adjacent_nodes_blocked = any(
-            node in reserved_by_non_spare for node in self.agv.adjacent_common_nodes
+        return not self._are_nodes_reserved_by_others(
+            [self.agv.next_node]
+        ) and self._are_nodes_reserved_by_others(
+            self.agv.adjacent_common_nodes, spare_flag=False
         )
 
-        return (
-            self.agv.next_node not in reserved_nodes
-            and self.agv.next_node in self.agv.adjacent_common_nodes
-            and adjacent_nodes_blocked
-        )
+    def _are_nodes_reserved_by_others(
+        self, nodes: List[int], spare_flag: Optional[bool] = None
+    ) -> bool:
+        """
+        Check if other AGVs reserved any of the nodes, optionally filtered by spare_flag.
+        Runs as a single EXISTS query on the reserved_node index and the GIN index of
+        reserved_segment.
+        """
+        if not nodes:
+            return False
+
+        other_agvs = Agv.objects.exclude(agv_id=self.agv.agv_id)
+        if spare_flag is not None:
+            other_agvs = other_agvs.filter(spare_flag=spare_flag)
+
+        return other_agvs.filter(
+            Q(reserved_node__in=nodes) | Q(reserved_segment__overlap=nodes)
+        ).exists()
 
     def _get_reserved_nodes_by_others(
         self, spare_flag: Optional[bool] = None
@@ -478,9 +704,88 @@ class MovementDecisionManager:
         if spare_flag is not None:
             other_agvs = other_agvs.filter(spare_flag=spare_flag)
 
-        return [
-            agv.reserved_node for agv in other_agvs if agv.reserved_node is not None
-        ]
+        reserved_nodes = []
+        for reserved_node, reserved_segment in other_agvs.values_list(
+            "reserved_node", "reserved_segment"
+        ):
+            if reserved_node is not None:
+                reserved_nodes.append(reserved_node)
+            reserved_nodes.extend(reserved_segment)
+        return reserved_nodes
+
+
+class SegmentReservationManager:
+    """
+    Handles reservation of consecutive free nodes beyond the next node.
+
+    On single-occupancy corridors the AGV may reserve a run of nodes up to the
+    configured horizon, so it does not have to stop and ask the server at every node.
+    """
+
+    def __init__(self, agv: Agv, horizon: int):
+        self.agv = agv
+        # The horizon sent to the AGV is a single byte
+        self.horizon = min(horizon, MAX_RESERVATION_HORIZON)
+
+    def plan_segment(self) -> List[int]:
+        """
+        Get the nodes after next_node that can be reserved together with it.
+
+        A node is only added to the segment if it is not a common node of this AGV and
+        no other AGV has it in its remaining path, position or reservations. The segment
+        stops at the first node that does not satisfy this.
+
+        Returns:
+            List[int]: Consecutive nodes following next_node in the remaining path
+        """
+        if self.horizon <= 1 or not self.agv.next_node:
+            return []
+
+        remaining_path = self.agv.remaining_path or []
+        if not remaining_path or remaining_path[0] != self.agv.next_node:
+            return []
+
+        common_nodes = set(self.agv.common_nodes)
+        if self.agv.next_node in common_nodes:
+            return []
+
+        candidates = remaining_path[1 : self.horizon]
+        if not candidates:
+            return []
+
+        claimed_nodes = self._get_nodes_claimed_by_others(candidates)
+        segment = []
+        for node in candidates:
+            if node in claimed_nodes or node in common_nodes:
+                break
+            segment.append(node)
+
+        return segment
+
+    def _get_nodes_claimed_by_others(self, candidates: List[int]) -> set:
+        """Get nodes that other AGVs occupy, reserved or still have to visit."""
+        claimed_nodes = set()
+        # Only AGVs claiming one of the candidates matter, found through the indexes
+        other_agvs = (
+            Agv.objects.exclude(agv_id=self.agv.agv_id)
+            .annotate(remaining=REMAINING_PATH)
+            .filter(
+                Q(current_node__in=candidates)
+                | Q(reserved_node__in=candidates)
+                | Q(route__overlap=candidates, remaining__overlap=candidates)
+                | Q(reserved_segment__overlap=candidates)
+            )
+            .values_list(
+                "current_node", "reserved_node", "remaining", "reserved_segment"
+            )
+        )
+        for current_node, reserved_node, remaining_path, reserved_segment in other_agvs:
+            claimed_nodes.update(remaining_path or [])
+            claimed_nodes.update(reserved_segment or [])
+            claimed_nodes.update(
+                node for node in (current_node, reserved_node) if node is not None
+            )
+        return claimed_nodes
 
 
 class StateManager:
@@ -488,33 +793,95 @@ class StateManager:
 
     def __init__(self, agv: Agv):
         self.agv = agv
+        self.segment_manager = SegmentReservationManager(
+            agv, settings.CONTROL_POLICY_RESERVATION_HORIZON
+        )
+
+    def set_moving_state(self) -> bool:
+        """
+        Set AGV to moving state without backup nodes.
+
+        Returns:
+            bool: False if another server process reserved the nodes first, the AGV
+            is then set to waiting instead
+        """
+        reserved_segment = self.segment_manager.plan_segment()
+        if not self._try_reserve([self.agv.next_node, *reserved_segment]):
+            return False
 
-    def set_moving_state(self) -> None:
-        """Set AGV to moving state without backup nodes."""
         self.agv.motion_state = Agv.MOVING
         self.agv.spare_flag = False
         self.agv.backup_nodes = {}
         self.agv.reserved_node = self.agv.next_node
+        self.agv.reserved_segment = reserved_segment
+        self.agv.waiting_since = None
         self.agv.save(
             update_fields=[
                 "motion_state",
                 "spare_flag",
                 "backup_nodes",
                 "reserved_node",
+                "reserved_segment",
+                "waiting_since",
             ]
         )
+        return True
+
+    def set_moving_with_backup_state(self) -> bool:
+        """
+        Set AGV to moving state with backup nodes.
+
+        Returns:
+            bool: False if another server process reserved the next node first, the
+            AGV is then set to waiting instead
+        """
+        if not self._try_reserve([self.agv.next_node]):
+            return False
 
-    def set_moving_with_backup_state(self) -> None:
-        """Set AGV to moving state with backup nodes."""
         self.agv.motion_state = Agv.MOVING
         self.agv.spare_flag = True
         self.agv.reserved_node = self.agv.next_node
-        self.agv.save(update_fields=["motion_state", "spare_flag", "reserved_node"])
+        self.agv.reserved_segment = []
+        self.agv.waiting_since = None
+        self.agv.save(
+            update_fields=[
+                "motion_state",
+                "spare_flag",
+                "reserved_node",
+                "reserved_segment",
+                "waiting_since",
+            ]
+        )
+        return True
+
+    def _try_reserve(self, nodes: List[int]) -> bool:
+        """Claim nodes in the shared fleet state, waiting if another AGV got them first."""
+        if is_sharded():
+            zone_map = get_zone_map()
+            if zone_map.get_zone(self.agv.next_node) != zone_map.get_zone(
+                self.agv.current_node
+            ):
+                # Handoff: the reservation in the shared fleet state is atomic across
+                # shards, the next zone's shard takes over with the AGV's next report
+                ZONE_HANDOFFS.inc()
+
+        if get_fleet_state().try_reserve(self.agv.agv_id, nodes):
+            return True
+        logger.info(
+            f"AGV {self.agv.agv_id} lost the reservation of {nodes} to another server process"
+        )
+        self.set_waiting_state()
+        return False
 
     def set_waiting_state(self) -> None:
-        """Set AGV to waiting state."""
+        """Set AGV to waiting state, keeping the time it started waiting."""
         self.agv.motion_state = Agv.WAITING
-        self.agv.save(update_fields=["motion_state"])
+        self.agv.reserved_segment = []
+        if self.agv.waiting_since is None:
+            self.agv.waiting_since = get_time()
+        self.agv.save(
+            update_fields=["motion_state", "reserved_segment", "waiting_since"]
+        )
 
 
 class BackupNodeManager:
@@ -583,13 +950,13 @@ class ControlPolicy:
 
     # === State Management (Delegated to StateManager) ===
 
-    def set_moving_state(self) -> None:
-        """Set AGV to moving state without backup nodes."""
-        self.state_manager.set_moving_state()
+    def set_moving_state(self) -> bool:
+        """Set AGV to moving state without backup nodes, False if the reservation failed."""
+        return self.state_manager.set_moving_state()
 
-    def set_moving_with_backup_state(self) -> None:
-        """Set AGV to moving state with backup nodes."""
-        self.state_manager.set_moving_with_backup_state()
+    def set_moving_with_backup_state(self) -> bool:
+        """Set AGV to moving state with backup nodes, False if the reservation failed."""
+        return self.state_manager.set_moving_with_backup_state()
 
     def set_waiting_state(self) -> None:
         """Set AGV to waiting state."""
@@ -1,4 +1,4 @@
-from ...models import Agv
+from ...models import ROUTE_FIELDS, Agv
 import logging
 from ...direction_change.direction_to_turn import determine_direction_change
 
@@ -62,7 +62,8 @@ class DeadlockResolver:
     def reserve_current_position(self):
         """Reserve the current position of the AGV."""
         self.agv.reserved_node = self.agv.current_node
-        self.agv.save(update_fields=["reserved_node"])
+        self.agv.reserved_segment = []
+        self.agv.save(update_fields=["reserved_node", "reserved_segment"])
 
     def clear_deadlock_resolution_state(self):
         """Clear deadlock resolution tracking state."""
@@ -85,16 +86,17 @@ class DeadlockResolver:
         Returns:
             Agv: The other AGV in deadlock, or None if no deadlock exists
         """
-        other_agvs = Agv.objects.exclude(agv_id=self.agv.agv_id)
-
-        for other_agv in other_agvs:
-            if (
-                self.agv.next_node == other_agv.current_node
-                and self.agv.current_node == other_agv.next_node
-            ):
-                return other_agv
-
-        return None
+        if self.agv.next_node is None or self.agv.current_node is None:
+            return None
+
+        return (
+            Agv.objects.exclude(agv_id=self.agv.agv_id)
+            .filter(
+                current_node=self.agv.next_node,
+                next_node=self.agv.current_node,
+            )
+            .first()
+        )
 
     def _detect_loop_deadlock(self) -> bool:
         """
@@ -124,9 +126,11 @@ class DeadlockResolver:
 
         # Find AGVs whose current_node matches this AGV's next_node
         visited.add(start_agv.agv_id)
-        potential_next_agvs = Agv.objects.filter(
-            current_node=start_agv.next_node
-        ).exclude(agv_id=start_agv.agv_id)
+        potential_next_agvs = (
+            Agv.objects.filter(current_node=start_agv.next_node)
+            .exclude(agv_id=start_agv.agv_id)
+            .only("agv_id", "current_node", "next_node")
+        )
 
         for next_agv in potential_next_agvs:
             if self._find_deadlock_cycle(next_agv, visited.copy()):
@@ -159,19 +163,20 @@ class DeadlockResolver:
             f"Moving AGV {agv.agv_id} to backup node {backup_node} to resolve deadlock"
         )
         # Update AGV state for backup node movement and track deadlock resolution
-        new_path = [backup_node, agv.current_node] + agv.remaining_path
-        agv.remaining_path = new_path
+        agv.replace_remaining_path([backup_node, agv.current_node] + agv.remaining_path)
         agv.next_node = backup_node
         agv.reserved_node = backup_node
+        agv.reserved_segment = []
         agv.motion_state = Agv.MOVING
         agv.waiting_for_deadlock_resolution = True
         agv.deadlock_partner_agv_id = partner_agv_id
 
         agv.save(
             update_fields=[
-                "remaining_path",
+                *ROUTE_FIELDS,
                 "next_node",
                 "reserved_node",
+                "reserved_segment",
                 "motion_state",
                 "waiting_for_deadlock_resolution",
                 "deadlock_partner_agv_id",
@@ -186,7 +191,8 @@ class DeadlockResolver:
 
         agv.motion_state = Agv.MOVING
         agv.reserved_node = agv.next_node
+        agv.reserved_segment = []
 
-        agv.save(update_fields=["motion_state", "reserved_node"])
+        agv.save(update_fields=["motion_state", "reserved_node", "reserved_segment"])
 
         determine_direction_change(agv)
@@ -1,4 +1,4 @@
-from ...models import Agv
+from ...models import REMAINING_PATH, ROUTE_LEFT, Agv
 from map_data.models import Connection
 from django.db.models import Q
 
@@ -55,9 +55,12 @@ class BackupNodesAllocator:
             return backup_nodes
 
         occupied_nodes = self._get_nodes_occupied_by_others()
+        neighbours = self._get_directly_connected_nodes(self.agv.adjacent_common_nodes)
 
         for node in self.agv.adjacent_common_nodes:
-            backup_node = self._find_best_backup_for_node(node, occupied_nodes)
+            backup_node = self._find_best_backup_for_node(
+                neighbours.get(node, {}), occupied_nodes
+            )
             if backup_node is not None:
                 backup_nodes[str(node)] = backup_node
 
@@ -74,15 +77,18 @@ class BackupNodesAllocator:
         """
         occupied_nodes = set()
 
-        other_agvs = Agv.objects.exclude(agv_id=self.agv.agv_id)
+        remaining_paths = (
+            Agv.objects.exclude(agv_id=self.agv.agv_id)
+            .filter(ROUTE_LEFT)
+            .values_list(REMAINING_PATH, flat=True)
+        )
 
-        for agv in other_agvs:
-            if agv.remaining_path:
-                occupied_nodes.update(agv.remaining_path)
+        for remaining_path in remaining_paths:
+            occupied_nodes.update(remaining_path)
 
         return occupied_nodes
 
-    def _find_best_backup_for_node(self, node, occupied_nodes):
+    def _find_best_backup_for_node(self, neighbours, occupied_nodes):
         """
         Find the best backup node for a given node.
 
@@ -90,72 +96,39 @@ class BackupNodesAllocator:
         connected to the given node.
 
         Args:
-            node (int): The node to find a backup for
+            neighbours (dict): Distance to every node connected to the given node
             occupied_nodes (set): Set of nodes occupied by other AGVs
 
         Returns:
             int or None: The best backup node, or None if none available
         """
-        connected_nodes = self._get_directly_connected_nodes(node)
-        free_nodes = [n for n in connected_nodes if n not in occupied_nodes]
-
-        if not free_nodes:
-            return None
-
-        return self._find_closest_node(node, free_nodes)
-
-    def _get_directly_connected_nodes(self, node):
-        """
-        Get all nodes that are directly connected to the given node.
-
-        Args:
-            node (int): The node to find connections for
-
-        Returns:
-            list: List of directly connected node IDs
-        """
-        connections = Connection.objects.filter(Q(node1=node) | Q(node2=node))
-
-        connected_nodes = []
-        for connection in connections:
-            # Add the other node in each connection
-            other_node = (
-                connection.node2 if connection.node1 == node else connection.node1
-            )
-            connected_nodes.append(other_node)
+        free_nodes = [n for n in neighbours if n not in occupied_nodes]
 
-        return connected_nodes
+        # Ties go to the first free node in connection order
+        return min(free_nodes, key=neighbours.get, default=None)
 
-    def _find_closest_node(self, reference_node, candidate_nodes):
+    def _get_directly_connected_nodes(self, nodes):
         """
-        Find the closest node to the reference node from candidates.
-
-        Closeness is determined by the distance field in the Connection model.
+        Get the nodes directly connected to each of the given nodes, in one query.
 
         Args:
-            reference_node (int): The reference node
-            candidate_nodes (list): List of candidate nodes
+            nodes (list): The nodes to find connections for
 
         Returns:
-            int or None: The closest node ID, or None if no valid connection
+            dict: {node: {connected_node: distance}} for every given node with
+            connections
         """
-        if not candidate_nodes:
-            return None
-
-        if len(candidate_nodes) == 1:
-            return candidate_nodes[0]
-
-        closest_node = None
-        min_distance = float("inf")
-
-        for candidate in candidate_nodes:
-            connection = Connection.objects.filter(
-                Q(node1=reference_node, node2=candidate)
-                | Q(node1=candidate, node2=reference_node)
-            ).first()
-
-            if connection and connection.distance < min_distance:
-                min_distance = connection.distance
-                closest_node = candidate
-
-        return closest_node
+        nodes = set(nodes)
+        connections = Connection.objects.filter(
+            Q(node1__in=nodes) | Q(node2__in=nodes)
+        ).values_list("node1", "node2", "distance")
+
+        neighbours = {}
+        for node1, node2, distance in connections:
+            # Add the other node of each connection, for both ends that were asked for
+            if node1 in nodes:
+                neighbours.setdefault(node1, {}).setdefault(node2, distance)
+            if node2 in nodes:
+                neighbours.setdefault(node2, {}).setdefault(node1, distance)
+
+        return neighbours
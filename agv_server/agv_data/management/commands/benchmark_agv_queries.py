@@ -0,0 +1,220 @@
+import json
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from ...fleet_simulator import simulation_database
+from ...models import REMAINING_PATH, Agv
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the control loop's AGV table queries with and without the "
+        "GIN/B-tree indexes on a synthetic fleet in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--agvs", type=int, default=1000, help="Number of AGVs")
+        parser.add_argument(
+            "--nodes", type=int, default=2500, help="Number of map nodes"
+        )
+        parser.add_argument(
+            "--path-length", type=int, default=30, help="Nodes per remaining path"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=200, help="Runs of every query"
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the query plans with and without indexes",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print the report as JSON"
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+
+        with simulation_database():
+            self._create_fleet(rng, options)
+            queries = self._build_queries(options["nodes"])
+
+            with_indexes = self._time_queries(queries, rng, options)
+            with connection.schema_editor() as schema_editor:
+                for index in Agv._meta.indexes:
+                    schema_editor.remove_index(Agv, index)
+            without_indexes = self._time_queries(queries, rng, options)
+
+        report = {
+            name: {
+                "indexed_ms": with_indexes[name]["median_ms"],
+                "unindexed_ms": without_indexes[name]["median_ms"],
+                "speedup": (
+                    round(
+                        without_indexes[name]["median_ms"]
+                        / with_indexes[name]["median_ms"],
+                        2,
+                    )
+                    if with_indexes[name]["median_ms"]
+                    else None
+                ),
+            }
+            for name in queries
+        }
+        if options["explain"]:
+            for name in queries:
+                report[name]["indexed_plan"] = with_indexes[name]["plan"]
+                report[name]["unindexed_plan"] = without_indexes[name]["plan"]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'query':>24} {'indexed ms':>12} {'unindexed ms':>14} {'speedup':>9}"
+        )
+        for name, result in report.items():
+            self.stdout.write(
+                f"{name:>24} {result['indexed_ms']:>12} "
+                f"{result['unindexed_ms']:>14} {result['speedup']!s:>9}"
+            )
+            if options["explain"]:
+                self.stdout.write(f"  indexed:\n{result['indexed_plan']}")
+                self.stdout.write(f"  unindexed:\n{result['unindexed_plan']}")
+
+    @staticmethod
+    def _create_fleet(rng: random.Random, options: Dict) -> None:
+        """Create AGVs with random paths, reservations and common nodes."""
+        node_count = options["nodes"]
+        agvs = []
+        for agv_id in range(1, options["agvs"] + 1):
+            path = rng.sample(range(1, node_count + 1), options["path_length"])
+            is_moving = rng.random() < 0.5
+            agvs.append(
+                Agv(
+                    agv_id=agv_id,
+                    preferred_parking_node=path[0],
+                    current_node=path[0],
+                    next_node=path[1],
+                    reserved_node=path[1] if is_moving else None,
+                    reserved_segment=path[2 : rng.randint(2, 5)] if is_moving else [],
+                    motion_state=Agv.MOVING if is_moving else Agv.WAITING,
+                    spare_flag=rng.random() < 0.2,
+                    initial_path=path,
+                    route=path,
+                    route_cursor=1,
+                    route_end=len(path),
+                    common_nodes=rng.sample(path, 5),
+                    adjacent_common_nodes=path[1:3] if rng.random() < 0.3 else [],
+                )
+            )
+        Agv.objects.bulk_create(agvs, batch_size=500)
+
+    @staticmethod
+    def _build_queries(node_count: int) -> Dict[str, Callable]:
+        """The control loop's lookups of other AGVs, keyed by name."""
+
+        def reserved_by_others(agv_id: int, nodes: List[int]):
+            return (
+                Agv.objects.exclude(agv_id=agv_id)
+                .filter(Q(reserved_node__in=nodes) | Q(reserved_segment__overlap=nodes))
+                .exists()
+            )
+
+        def claimed_by_others(agv_id: int, nodes: List[int]):
+            return list(
+                Agv.objects.exclude(agv_id=agv_id)
+                .annotate(remaining=REMAINING_PATH)
+                .filter(
+                    Q(current_node__in=nodes)
+                    | Q(reserved_node__in=nodes)
+                    | Q(route__overlap=nodes, remaining__overlap=nodes)
+                    | Q(reserved_segment__overlap=nodes)
+                )
+                .values_list(
+                    "current_node",
+                    "reserved_node",
+                    "remaining",
+                    "reserved_segment",
+                )
+            )
+
+        def head_on(agv_id: int, nodes: List[int]):
+            return (
+                Agv.objects.exclude(agv_id=agv_id)
+                .filter(current_node=nodes[0], next_node=nodes[1])
+                .first()
+            )
+
+        def common_node_holders(agv_id: int, nodes: List[int]):
+            return list(
+                Agv.objects.exclude(agv_id=agv_id)
+                .filter(common_nodes__contains=nodes[:1])
+                .values_list("agv_id", flat=True)
+            )
+
+        def adjacent_common_nodes(agv_id: int, nodes: List[int]):
+            return list(
+                Agv.objects.exclude(agv_id=agv_id)
+                .filter(adjacent_common_nodes__overlap=nodes)
+                .values_list("agv_id", flat=True)
+            )
+
+        return {
+            "reserved_by_others": reserved_by_others,
+            "claimed_by_others": claimed_by_others,
+            "head_on": head_on,
+            "common_node_holders": common_node_holders,
+            "adjacent_common_nodes": adjacent_common_nodes,
+        }
+
+    @staticmethod
+    def _time_queries(
+        queries: Dict[str, Callable], rng: random.Random, options: Dict
+    ) -> Dict[str, Dict]:
+        """Run every query with random probe nodes and collect its median latency."""
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Agv._meta.db_table}")
+
+        results = {}
+        for name, query in queries.items():
+            timings = []
+            for _ in range(options["repeat"]):
+                agv_id = rng.randint(1, options["agvs"])
+                nodes = rng.sample(range(1, options["nodes"] + 1), 3)
+                started = time.perf_counter()
+                query(agv_id, nodes)
+                timings.append(time.perf_counter() - started)
+
+            plan = None
+            if options["explain"]:
+                plan = Command._explain(query, options)
+            results[name] = {
+                "median_ms": round(statistics.median(timings) * 1000, 3),
+                "plan": plan,
+            }
+        return results
+
+    @staticmethod
+    def _explain(query: Callable, options: Dict) -> str:
+        """Capture the plan of the query's SQL by running it under EXPLAIN."""
+        statements = []
+
+        def capture(execute, sql, params, many, context):
+            statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(capture):
+            query(1, [1, 2, 3])
+
+        sql, params = statements[-1]
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            return "\n".join(row[0] for row in cursor.fetchall())
@@ -0,0 +1,273 @@
+import json
+import math
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from ...encode_decode_data_frames.agv_to_server_decoder import (
+    FRAMES_DROPPED,
+    example_batch_frame_from_agv_to_server,
+)
+from ...encode_decode_data_frames.frame_format import (
+    BATCH_DOWNLINK_MESSAGE_TYPE,
+    BATCH_HEADER_LENGTH,
+    DOWNLINK_RECORD_LENGTH,
+    FLAG_RESERVATION_HORIZON,
+    FLAG_SEQUENCE_NUMBER,
+    SEQUENCE_NUMBER_MODULO,
+)
+from ...main_algorithms.algorithm1.common_nodes import (
+    coalesce_common_nodes_recalculation,
+)
+from ...fleet_simulator import FleetSimulator, simulation_database
+from ...models import Agv
+from ...mqtt_transport import MEMORY_TRANSPORT, InMemoryClient, default_broker
+from .simulate_fleet import add_map_arguments, algorithm_output, read_map
+
+
+def decode_downlink_commands(payload: bytes, topic: str) -> List[Tuple[int, int, int]]:
+    """
+    Extract (agv_id, motion_state, reserved_node) from a downlink frame of either
+    protocol version. Version 1 frames carry no AGV id, it is taken from the topic.
+    """
+    data = bytearray(payload)
+    if len(data) > 2 and data[1] == BATCH_DOWNLINK_MESSAGE_TYPE:
+        field_flags, record_count = data[BATCH_HEADER_LENGTH : BATCH_HEADER_LENGTH + 2]
+        record_length = DOWNLINK_RECORD_LENGTH
+        if field_flags & FLAG_RESERVATION_HORIZON:
+            record_length += 1
+        if field_flags & FLAG_SEQUENCE_NUMBER:
+            record_length += 2
+
+        commands = []
+        for index in range(record_count):
+            offset = BATCH_HEADER_LENGTH + 2 + index * record_length
+            commands.append(
+                (
+                    int.from_bytes(data[offset : offset + 2], byteorder="little"),
+                    data[offset + 2],
+                    int.from_bytes(data[offset + 3 : offset + 5], byteorder="little"),
+                )
+            )
+        return commands
+
+    agv_id = int(topic.rsplit("/", 1)[-1])
+    return [(agv_id, data[3], int.from_bytes(data[4:6], byteorder="little"))]
+
+
+class MqttLoadGenerator:
+    """
+    Simulated AGVs on the in-memory broker. Publishes position reports at a fixed
+    rate, follows the commands the server sends back and measures the time from a
+    report to the command it caused.
+    """
+
+    def __init__(
+        self,
+        positions: Dict[int, int],
+        uplink_topic: str,
+        downlink_topic: str,
+        rate: float,
+        reports_per_frame: int,
+    ):
+        self.positions = dict(positions)
+        self.uplink_topic = uplink_topic
+        self.rate = rate
+        self.reports_per_frame = reports_per_frame
+
+        self._sequences: Dict[int, int] = {agv_id: 0 for agv_id in positions}
+        self._sent_at: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self.frames_sent = 0
+        self.reports_sent = 0
+        self.commands_received = 0
+        self.latencies: List[float] = []
+
+        self.client = InMemoryClient(client_id="load_generator")
+        self.client.on_message = self._on_downlink
+        self.client.subscribe(f"{downlink_topic}/#")
+        self.client.loop_start()
+
+    def run(self, duration: float) -> None:
+        """Publish position reports round robin over all AGVs for duration seconds."""
+        agv_ids = sorted(self.positions)
+        frame_interval = self.reports_per_frame / self.rate
+        started = time.perf_counter()
+        next_frame_at = started
+        cursor = 0
+
+        while time.perf_counter() - started < duration:
+            batch = [
+                agv_ids[(cursor + offset) % len(agv_ids)]
+                for offset in range(min(self.reports_per_frame, len(agv_ids)))
+            ]
+            cursor += len(batch)
+            self._publish_reports(batch)
+
+            next_frame_at += frame_interval
+            delay = next_frame_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _publish_reports(self, agv_ids: List[int]) -> None:
+        reports = []
+        now = time.perf_counter()
+        with self._lock:
+            for agv_id in agv_ids:
+                self._sequences[agv_id] = (
+                    self._sequences[agv_id] + 1
+                ) % SEQUENCE_NUMBER_MODULO
+                reports.append(
+                    {
+                        "agv_id": agv_id,
+                        "current_node": self.positions[agv_id],
+                        "sequence": self._sequences[agv_id],
+                    }
+                )
+                self._sent_at.setdefault(agv_id, now)
+
+        topic_suffix = agv_ids[0] if len(agv_ids) == 1 else "batch"
+        self.client.publish(
+            f"{self.uplink_topic}/{topic_suffix}",
+            example_batch_frame_from_agv_to_server(reports),
+        )
+        self.frames_sent += 1
+        self.reports_sent += len(reports)
+
+    def _on_downlink(self, client, userdata, message) -> None:
+        received = time.perf_counter()
+        for agv_id, motion_state, reserved_node in decode_downlink_commands(
+            message.payload, message.topic
+        ):
+            with self._lock:
+                self.commands_received += 1
+                sent_at = self._sent_at.pop(agv_id, None)
+                if sent_at is not None:
+                    self.latencies.append(received - sent_at)
+                if motion_state == Agv.MOVING and reserved_node:
+                    self.positions[agv_id] = reserved_node
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the MQTT ingest path end to end (frame -> decision -> downlink) "
+        "on the in-memory broker against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--agvs", type=int, default=100, help="Number of AGVs")
+        parser.add_argument(
+            "--rate", type=float, default=1000.0, help="Position reports per second"
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10.0, help="Seconds to generate load"
+        )
+        parser.add_argument(
+            "--reports-per-frame",
+            type=int,
+            default=1,
+            help="Position reports batched into one version 2 frame",
+        )
+        parser.add_argument(
+            "--drain-timeout",
+            type=float,
+            default=30.0,
+            help="Seconds to wait for the server to work off its backlog",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        add_map_arguments(parser)
+        parser.add_argument(
+            "--json", action="store_true", help="Print the report as JSON"
+        )
+        parser.add_argument(
+            "--verbose-algorithms",
+            action="store_true",
+            help="Keep the algorithms' console output (slows the server down)",
+        )
+
+    def handle(self, *args, **options):
+        connections_csv, directions_csv = read_map(options)
+        simulator = FleetSimulator(
+            agv_count=options["agvs"], order_count=options["agvs"], seed=options["seed"]
+        )
+
+        with simulation_database(), override_settings(
+            MQTT_TRANSPORT=MEMORY_TRANSPORT
+        ), algorithm_output(options["verbose_algorithms"]):
+            simulator.load_map(connections_csv, directions_csv)
+            simulator.setup_fleet()
+            with coalesce_common_nodes_recalculation():
+                for order_id in range(1, options["agvs"] + 1):
+                    simulator.task_dispatcher.assign_single_order(order_id, "dijkstra")
+
+            # Imported late so the module-level client uses the in-memory transport
+            from ... import mqtt as server
+
+            server.start_consumer()
+            generator = MqttLoadGenerator(
+                positions=dict(Agv.objects.values_list("agv_id", "current_node")),
+                uplink_topic=server.MQTT_TOPIC_AGVDATA,
+                downlink_topic=server.MQTT_TOPIC_AGVROUTE,
+                rate=options["rate"],
+                reports_per_frame=options["reports_per_frame"],
+            )
+            dropped_before = FRAMES_DROPPED.get(
+                reason="duplicate"
+            ) + FRAMES_DROPPED.get(reason="stale")
+
+            started = time.perf_counter()
+            generator.run(options["duration"])
+            drain_deadline = time.perf_counter() + options["drain_timeout"]
+            while (
+                server.client.pending_count() and time.perf_counter() < drain_deadline
+            ):
+                time.sleep(0.05)
+            server.downlink_publisher.wait_until_idle(
+                max(0.0, drain_deadline - time.perf_counter())
+            )
+            elapsed = time.perf_counter() - started
+            backlog = server.client.pending_count()
+            server.stop_consumer()
+            generator.client.loop_stop()
+
+        dropped = (
+            FRAMES_DROPPED.get(reason="duplicate")
+            + FRAMES_DROPPED.get(reason="stale")
+            - dropped_before
+        )
+        report = self._build_report(generator, elapsed, backlog, dropped)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for key, value in report.items():
+            self.stdout.write(f"{key:>28}: {value}")
+
+    @staticmethod
+    def _build_report(
+        generator: MqttLoadGenerator, elapsed: float, backlog: int, dropped: float
+    ) -> Dict:
+        latencies = sorted(generator.latencies)
+
+        def percentile(quantile: float) -> float:
+            if not latencies:
+                return 0.0
+            index = max(0, math.ceil(quantile * len(latencies)) - 1)
+            return round(latencies[index] * 1000, 3)
+
+        return {
+            "frames_sent": generator.frames_sent,
+            "reports_sent": generator.reports_sent,
+            "elapsed_seconds": round(elapsed, 3),
+            "reports_per_second": round(generator.reports_sent / elapsed, 2),
+            "unprocessed_frames": backlog,
+            "frames_dropped": int(dropped),
+            "commands_received": generator.commands_received,
+            "commands_per_second": round(generator.commands_received / elapsed, 2),
+            "end_to_end_latency_p50_ms": percentile(0.50),
+            "end_to_end_latency_p99_ms": percentile(0.99),
+            "broker_messages": default_broker.published_count,
+        }
@@ -0,0 +1,323 @@
+import contextlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from ...fleet_simulator import FleetSimulator, build_grid_map, simulation_database
+from ...profiling import PROFILE_METRICS, disable_profiling, enable_profiling
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a headless discrete-event simulation of an AGV fleet against a "
+        "throwaway test database and report throughput and decision latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--agvs", type=int, default=10, help="Number of AGVs")
+        parser.add_argument("--orders", type=int, default=50, help="Number of orders")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        parser.add_argument(
+            "--algorithm", default="dijkstra", help="Pathfinding algorithm"
+        )
+        add_map_arguments(parser)
+        parser.add_argument(
+            "--speed", type=float, default=1.0, help="Distance units per second"
+        )
+        parser.add_argument(
+            "--order-interval",
+            type=float,
+            default=10.0,
+            help="Mean seconds between order arrivals",
+        )
+        parser.add_argument(
+            "--stall-timeout",
+            type=float,
+            default=300.0,
+            help="Seconds without movement after which the fleet counts as deadlocked",
+        )
+        parser.add_argument(
+            "--max-simulated-seconds",
+            type=float,
+            default=86400.0,
+            help="Upper bound of simulated time",
+        )
+        parser.add_argument(
+            "--profile-output",
+            help="Profile every decision and write collapsed stacks (flame graph input) to this file",
+        )
+        parser.add_argument(
+            "--profile-metric",
+            choices=PROFILE_METRICS,
+            default="queries",
+            help="Value of the collapsed stacks: SQL queries, rows fetched or self time in microseconds",
+        )
+        parser.add_argument(
+            "--compare-horizons",
+            help=(
+                "Run the same simulation once per common nodes look-ahead horizon and "
+                "compare throughput, e.g. 0,5,10,30s (N nodes, Ns seconds, 0 whole path)"
+            ),
+        )
+        parser.add_argument(
+            "--reroute-after",
+            type=float,
+            help=(
+                "Reroute AGVs that waited this many simulated seconds for a blocked "
+                "node (0 disables, default REROUTE_AFTER_WAIT_SECONDS)"
+            ),
+        )
+        parser.add_argument(
+            "--alternative-paths",
+            type=int,
+            help=(
+                "Precompute this many shortest paths per order leg and balance the "
+                "fleet over them (default ALTERNATIVE_PATHS_K)"
+            ),
+        )
+        parser.add_argument(
+            "--assignment-mode",
+            choices=("parking", "nearest"),
+            help="How idle AGVs are matched to orders (default AGV_ASSIGNMENT_MODE)",
+        )
+        parser.add_argument(
+            "--chain-orders",
+            action="store_true",
+            help="Let AGVs take pending orders at the workstation (ORDER_CHAINING)",
+        )
+        parser.add_argument(
+            "--preposition",
+            action="store_true",
+            help=(
+                "Send idle AGVs to staging nodes close to recent demand "
+                "(PREPOSITIONING, implies --assignment-mode nearest)"
+            ),
+        )
+        parser.add_argument(
+            "--staging-nodes",
+            type=int,
+            help=(
+                "Number of nodes kept free of orders for prepositioned AGVs "
+                "(default --agvs with --preposition, else 0)"
+            ),
+        )
+        parser.add_argument(
+            "--preposition-window",
+            type=float,
+            help=(
+                "Seconds of orders that count as recent demand "
+                "(default PREPOSITIONING_WINDOW_SECONDS)"
+            ),
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print the report as JSON"
+        )
+        parser.add_argument(
+            "--verbose-algorithms",
+            action="store_true",
+            help="Keep the algorithms' console output (slows the simulation down)",
+        )
+
+    def handle(self, *args, **options):
+        if options["preposition"] and options["assignment_mode"] == "parking":
+            raise CommandError("--preposition needs --assignment-mode nearest")
+        connections_csv, directions_csv = read_map(options)
+        if options["compare_horizons"]:
+            if options["profile_output"]:
+                raise CommandError(
+                    "--profile-output can not be combined with --compare-horizons"
+                )
+            self._compare_horizons(connections_csv, directions_csv, options)
+            return
+
+        with override_settings(**self._get_settings_overrides(options)):
+            with simulation_database(), algorithm_output(options["verbose_algorithms"]):
+                simulator = self._create_simulator(options)
+                simulator.load_map(connections_csv, directions_csv)
+                simulator.setup_fleet()
+                profiler = enable_profiling() if options["profile_output"] else None
+                try:
+                    report = simulator.run()
+                finally:
+                    if profiler:
+                        disable_profiling()
+
+        if profiler:
+            profiler.write_collapsed_stacks(
+                options["profile_output"], options["profile_metric"]
+            )
+            report["profile"] = profiler.summary()
+            report["query_budget_violations"] = profiler.budget_violations(
+                settings.CONTROL_QUERY_BUDGETS
+            )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        for key, value in report.items():
+            self.stdout.write(f"{key:>28}: {value}")
+        if report["stalled_agvs"]:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Fleet stalled, AGVs {report['stalled_agvs']} never finished their orders"
+                )
+            )
+
+    @staticmethod
+    def _get_settings_overrides(options) -> Dict:
+        overrides = {"AGV_SPEED": options["speed"]}
+        if options["reroute_after"] is not None:
+            overrides["REROUTE_AFTER_WAIT_SECONDS"] = options["reroute_after"]
+        if options["alternative_paths"] is not None:
+            overrides["ALTERNATIVE_PATHS_K"] = options["alternative_paths"]
+        if options["chain_orders"]:
+            overrides["ORDER_CHAINING"] = True
+        if options["assignment_mode"]:
+            overrides["AGV_ASSIGNMENT_MODE"] = options["assignment_mode"]
+        if options["preposition"]:
+            overrides["PREPOSITIONING"] = True
+            overrides["AGV_ASSIGNMENT_MODE"] = "nearest"
+        if options["preposition_window"] is not None:
+            overrides["PREPOSITIONING_WINDOW_SECONDS"] = options["preposition_window"]
+        return overrides
+
+    @staticmethod
+    def _create_simulator(options) -> FleetSimulator:
+        return FleetSimulator(
+            agv_count=options["agvs"],
+            order_count=options["orders"],
+            seed=options["seed"],
+            algorithm=options["algorithm"],
+            speed=options["speed"],
+            order_interval=options["order_interval"],
+            stall_timeout=options["stall_timeout"],
+            max_simulated_seconds=options["max_simulated_seconds"],
+            staging_node_count=get_staging_node_count(options),
+        )
+
+    def _compare_horizons(self, connections_csv, directions_csv, options):
+        """Run the simulation with the same seed once per horizon and tabulate it."""
+        results = []
+        for label, horizon_nodes, horizon_seconds in parse_horizons(
+            options["compare_horizons"]
+        ):
+            with override_settings(
+                **self._get_settings_overrides(options),
+                COMMON_NODES_HORIZON_NODES=horizon_nodes,
+                COMMON_NODES_HORIZON_SECONDS=horizon_seconds,
+            ):
+                with simulation_database(), algorithm_output(
+                    options["verbose_algorithms"]
+                ):
+                    simulator = self._create_simulator(options)
+                    simulator.load_map(connections_csv, directions_csv)
+                    simulator.setup_fleet()
+                    results.append({"horizon": label, **simulator.run()})
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'horizon':>10} {'completed':>10} {'orders/h':>10} {'wait/order s':>13} "
+            f"{'deadlocks':>10} {'p50 ms':>8} {'p99 ms':>8} {'stalled':>8}"
+        )
+        for result in results:
+            deadlocks = result["heading_on_deadlocks"] + result["loop_deadlocks"]
+            self.stdout.write(
+                f"{result['horizon']:>10} {result['orders_completed']:>10} "
+                f"{result['orders_per_hour']:>10} "
+                f"{result['mean_wait_per_order_seconds']:>13} {deadlocks:>10} "
+                f"{result['decision_latency_p50_ms']:>8} "
+                f"{result['decision_latency_p99_ms']:>8} "
+                f"{len(result['stalled_agvs']):>8}"
+            )
+
+
+def get_staging_node_count(options) -> int:
+    """
+    Get the number of nodes kept free of orders. Runs without --preposition keep
+    them only if --staging-nodes is given, so both runs of a comparison see the
+    same orders.
+    """
+    if options["staging_nodes"] is not None:
+        return options["staging_nodes"]
+    return options["agvs"] if options["preposition"] else 0
+
+
+def parse_horizons(value: str) -> List[Tuple[str, int, float]]:
+    """
+    Parse a comma separated list of horizons: "N" limits the common nodes to the
+    next N nodes of every path (0 for the whole path), "Ns" to N seconds of travel.
+
+    Returns:
+        List[Tuple[str, int, float]]: (label, horizon nodes, horizon seconds) per horizon
+    """
+    horizons = []
+    for item in value.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        try:
+            if item.endswith("s"):
+                horizon_seconds = float(item[:-1])
+                horizons.append((item, 0, horizon_seconds))
+            else:
+                horizon_nodes = int(item)
+                horizons.append((item if horizon_nodes else "whole", horizon_nodes, 0))
+        except ValueError:
+            raise CommandError(
+                f"Invalid horizon {item!r}, use a node count like 5 or seconds like 30s"
+            )
+    if not horizons:
+        raise CommandError("--compare-horizons needs at least one horizon")
+    return horizons
+
+
+def read_map(options):
+    """Read the map CSV files given in the options, or generate the grid map."""
+    if options["map_connections"] or options["map_directions"]:
+        if not (options["map_connections"] and options["map_directions"]):
+            raise CommandError(
+                "--map-connections and --map-directions must be given together"
+            )
+        with open(options["map_connections"]) as connections_file:
+            connections_csv = connections_file.read()
+        with open(options["map_directions"]) as directions_file:
+            directions_csv = directions_file.read()
+        return connections_csv, directions_csv
+
+    try:
+        rows, cols = (int(size) for size in options["grid"].lower().split("x"))
+    except ValueError:
+        raise CommandError("--grid must look like ROWSxCOLS, e.g. 10x10")
+    return build_grid_map(rows, cols)
+
+
+def add_map_arguments(parser):
+    """Add the map selection options shared by the simulation commands."""
+    parser.add_argument(
+        "--map-connections",
+        help="Connection-and-distance CSV file (e.g. sample-data/map-connection-and-distance.csv)",
+    )
+    parser.add_argument("--map-directions", help="Direction CSV file")
+    parser.add_argument(
+        "--grid",
+        default="10x10",
+        help="Generate a ROWSxCOLS grid map when no map CSV files are given",
+    )
+
+
+@contextlib.contextmanager
+def algorithm_output(verbose: bool):
+    """Silence the algorithms' print output unless verbose output was requested."""
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
@@ -0,0 +1,249 @@
+"""
+In-process metrics for the AGV control loop.
+
+Provides counters and latency histograms that are exported in the Prometheus
+text exposition format by the metrics endpoint.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+def _log_linear_buckets(
+    min_exponent: int = -5, max_exponent: int = 1, steps: Sequence[int] = range(1, 10)
+) -> List[float]:
+    """
+    Build HDR-style bucket bounds: every power of ten is split into linear steps,
+    so the relative error stays within one significant digit over the whole range.
+
+    Returns:
+        List[float]: Upper bounds from 10^min_exponent to 9 * 10^max_exponent seconds
+    """
+    return [
+        round(step * 10**exponent, -min_exponent + 1)
+        for exponent in range(min_exponent, max_exponent + 1)
+        for step in steps
+    ]
+
+
+DEFAULT_LATENCY_BUCKETS = _log_linear_buckets()
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple) -> str:
+    """Format label pairs as a Prometheus label set."""
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{value}"' for name, value in zip(label_names, label_values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """Monotonically increasing counter, optionally split by labels."""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increase the counter of the given label values."""
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Get the current value of the given label values."""
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        """Render the counter in Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Latency histogram with fixed HDR-style buckets, optionally split by labels."""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        # Per label set: [bucket counts..., +Inf count], sum, count
+        self._series: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        """Record one observation of the given label values."""
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def quantile(self, quantile: float, **labels) -> float:
+        """
+        Estimate a quantile of the given label values from the bucket counts.
+
+        Returns:
+            float: Upper bound of the bucket holding the quantile, 0 without observations
+        """
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None or series[2] == 0:
+                return 0.0
+            counts, count = list(series[0]), series[2]
+
+        rank = quantile * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= rank and bucket_count:
+                return (
+                    self.buckets[index] if index < len(self.buckets) else float("inf")
+                )
+        return float("inf")
+
+    def render(self) -> List[str]:
+        """Render the histogram in Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series_items = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._series.items()
+            )
+
+        for key, (counts, total, count) in series_items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of all metrics exported by this process."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        """Get or create a counter."""
+        return self._get_or_create(Counter, name, help_text, label_names)
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        """Get or create a latency histogram."""
+        return self._get_or_create(Histogram, name, help_text, label_names)
+
+    def _get_or_create(self, metric_class, name, help_text, label_names):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, help_text, label_names)
+            return self._metrics[name]
+
+    def render_prometheus(self) -> str:
+        """Render every registered metric in Prometheus text exposition format."""
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+STAGE_LATENCY = REGISTRY.histogram(
+    "agv_control_stage_seconds",
+    "Time spent in each stage of handling AGV position reports",
+    label_names=("stage",),
+)
+STAGE_FAILURES = REGISTRY.counter(
+    "agv_control_stage_failures_total",
+    "Exceptions raised in each stage of handling AGV position reports",
+    label_names=("stage",),
+)
+
+
+_stage_context = threading.local()
+_stage_observers: List[Callable[[Tuple[str, ...], float], None]] = []
+
+
+def current_stage_path() -> Tuple[str, ...]:
+    """Get the stages the current thread is in, outermost first."""
+    return tuple(getattr(_stage_context, "stack", ()))
+
+
+def add_stage_observer(observer: Callable[[Tuple[str, ...], float], None]) -> None:
+    """Call observer(stage_path, seconds) whenever a stage ends, e.g. for profiling."""
+    _stage_observers.append(observer)
+
+
+def remove_stage_observer(observer: Callable[[Tuple[str, ...], float], None]) -> None:
+    """Stop calling an observer added with add_stage_observer."""
+    if observer in _stage_observers:
+        _stage_observers.remove(observer)
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    """
+    Time a stage of the control loop and count its failures.
+
+    Exceptions are re-raised. An exception passing through nested stages is only
+    counted for the innermost stage it was raised in.
+
+    Args:
+        stage: Name of the stage, used as the stage label
+    """
+    if not hasattr(_stage_context, "stack"):
+        _stage_context.stack = []
+    _stage_context.stack.append(stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        if not getattr(e, "_counted_stage_failure", False):
+            e._counted_stage_failure = True
+            STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_path = current_stage_path()
+        _stage_context.stack.pop()
+        STAGE_LATENCY.observe(elapsed, stage=stage)
+        for observer in list(_stage_observers):
+            observer(stage_path, elapsed)
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-19 09:12
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("agv_data", "0019_alter_agv_journey_phase"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agv",
+            name="reserved_segment",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.IntegerField(),
+                default=list,
+                help_text="Consecutive free nodes reserved beyond reserved_node, so the AGV can traverse a corridor without stopping at every node",
+                size=None,
+            ),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.7 on 2026-10-19 10:05
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("agv_data", "0020_agv_reserved_segment"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["remaining_path"], name="agv_remaining_path_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["common_nodes"], name="agv_common_nodes_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["adjacent_common_nodes"], name="agv_adj_common_nodes_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["reserved_segment"], name="agv_reserved_segment_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=models.Index(fields=["current_node"], name="agv_current_node_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=models.Index(fields=["next_node"], name="agv_next_node_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=models.Index(fields=["reserved_node"], name="agv_reserved_node_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=models.Index(fields=["motion_state"], name="agv_motion_state_idx"),
+        ),
+    ]
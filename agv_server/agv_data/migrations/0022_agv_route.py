@@ -0,0 +1,92 @@
+# Generated by Django 5.1.7 on 2026-10-19 14:20
+
+import agv_data.models
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+OUTBOUND = 0
+
+
+def populate_routes(apps, schema_editor):
+    """Turn every stored remaining path into a route with the cursor at its start."""
+    Agv = apps.get_model("agv_data", "Agv")
+    agvs = list(Agv.objects.all())
+    for agv in agvs:
+        remaining_path = list(agv.remaining_path or [])
+        inbound_path = list(agv.inbound_path or [])
+        agv.route = remaining_path
+        agv.route_cursor = 0
+        agv.route_end = len(remaining_path)
+        # On the outbound journey the inbound path follows the workstation
+        if (
+            agv.journey_phase == OUTBOUND
+            and remaining_path
+            and inbound_path
+            and remaining_path[-1] == inbound_path[0]
+        ):
+            agv.route = remaining_path + inbound_path[1:]
+    Agv.objects.bulk_update(agvs, ["route", "route_cursor", "route_end"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("agv_data", "0021_agv_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agv",
+            name="route",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.IntegerField(),
+                default=list,
+                help_text="Nodes the AGV drives for its order: outbound path followed by the inbound path. Only replaced when the AGV is rerouted, progress is tracked by route_cursor.",
+                size=None,
+            ),
+        ),
+        migrations.AddField(
+            model_name="agv",
+            name="route_cursor",
+            field=models.IntegerField(
+                default=0, help_text="Index in route of the next node to visit"
+            ),
+        ),
+        migrations.AddField(
+            model_name="agv",
+            name="route_end",
+            field=models.IntegerField(
+                default=0,
+                help_text="Index in route after the last node of the current journey phase",
+            ),
+        ),
+        migrations.RunPython(populate_routes, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name="agv",
+            name="agv_remaining_path_gin",
+        ),
+        migrations.RemoveField(
+            model_name="agv",
+            name="remaining_path",
+        ),
+        migrations.AddField(
+            model_name="agv",
+            name="remaining_path",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=agv_data.models.RouteSlice(
+                    models.F("route"), models.F("route_cursor"), models.F("route_end")
+                ),
+                help_text="Pi_i: Remaining points to be visited by AGV i, route[route_cursor:route_end] computed by the database. Name in research paper: residual path",
+                output_field=django.contrib.postgres.fields.ArrayField(
+                    base_field=models.IntegerField(), size=None
+                ),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["remaining_path"], name="agv_remaining_path_gin"
+            ),
+        ),
+    ]
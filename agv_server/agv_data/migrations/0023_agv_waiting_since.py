@@ -0,0 +1,21 @@
+# Generated by Django 5.1.7 on 2026-10-19 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("agv_data", "0022_agv_route"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agv",
+            name="waiting_since",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="When the AGV was last told to wait after moving, used to reroute AGVs that wait too long",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-19 18:40
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("agv_data", "0023_agv_waiting_since"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="agv",
+            name="agv_remaining_path_gin",
+        ),
+        migrations.RemoveField(
+            model_name="agv",
+            name="remaining_path",
+        ),
+        migrations.AddIndex(
+            model_name="agv",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["route"], name="agv_route_gin"
+            ),
+        ),
+    ]
@@ -1,6 +1,46 @@
+from typing import List, Optional
+
 from django.db import models
+from django.db.models import F, Func, Q
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from order_data.models import Order
+from .fleet_state import get_fleet_state, reservation_nodes
+from .metrics import stage_timer
+
+# Fields that change the remaining path
+ROUTE_FIELDS = ["route", "route_cursor", "route_end"]
+
+
+class RouteSlice(Func):
+    """
+    route[cursor:end] of the route array in SQL. Postgres arrays are 1-based and
+    their slice bounds inclusive, an empty range gives an empty array.
+    """
+
+    def __init__(self, route, cursor, end, **extra):
+        super().__init__(
+            route, cursor, end, output_field=ArrayField(models.IntegerField()), **extra
+        )
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sqls, params = [], []
+        for expression in self.get_source_expressions():
+            sql, expression_params = compiler.compile(expression)
+            sqls.append(sql)
+            params.extend(expression_params)
+        route_sql, cursor_sql, end_sql = sqls
+        return f"({route_sql})[({cursor_sql}) + 1:({end_sql})]", params
+
+
+# Agv.remaining_path in SQL, for lookups of other AGVs' paths. Not a stored column,
+# Postgres would rewrite it and its index entries with every cursor move. Filter
+# with route__overlap as well, the GIN index of route finds the candidate rows.
+REMAINING_PATH = RouteSlice(F("route"), F("route_cursor"), F("route_end"))
+
+# AGVs with nodes left in their journey phase, with an order or without one (idle
+# AGVs driving to a staging node, see prepositioning)
+ROUTE_LEFT = Q(route_cursor__lt=F("route_end"))
 
 
 class Agv(models.Model):
@@ -63,6 +103,12 @@ class Agv(models.Model):
     )
     next_node = models.IntegerField(null=True, help_text="Next point to visit (v_n^i)")
     reserved_node = models.IntegerField(null=True, help_text="Reserved point (v_r^i)")
+    reserved_segment = ArrayField(
+        models.IntegerField(),
+        help_text="Consecutive free nodes reserved beyond reserved_node, so the AGV can traverse a corridor without stopping at every node",
+        default=list,
+        size=None,
+    )
 
     # State management from Algorithm 2
 
@@ -97,6 +143,11 @@ class Agv(models.Model):
         blank=True,
         help_text="ID of the AGV that this AGV had head-on deadlock with (used to trigger control policy when partner moves)",
     )
+    waiting_since = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the AGV was last told to wait after moving, used to reroute AGVs that wait too long",
+    )
 
     # Path information according to Algorithm 1 - Using ArrayField for better type clarity
     initial_path = ArrayField(
@@ -105,11 +156,18 @@ class Agv(models.Model):
         default=list,
         size=None,  # No size limit
     )
-    remaining_path = ArrayField(
+    route = ArrayField(
         models.IntegerField(),
-        help_text="Pi_i: Remaining points to be visited by AGV i. Name in research paper: residual path",
+        help_text="Nodes the AGV drives for its order: outbound path followed by the inbound path. Only replaced when the AGV is rerouted, progress is tracked by route_cursor.",
         default=list,
-        size=None,  # No size limit
+        size=None,
+    )
+    route_cursor = models.IntegerField(
+        default=0, help_text="Index in route of the next node to visit"
+    )
+    route_end = models.IntegerField(
+        default=0,
+        help_text="Index in route after the last node of the current journey phase",
     )
     outbound_path = ArrayField(
         models.IntegerField(),
@@ -146,39 +204,157 @@ class Agv(models.Model):
         help_text="Currently executing order",
     )
 
+    # === Route ===
+
+    def set_route(self, route: List[int], end: Optional[int] = None) -> None:
+        """
+        Start a new route from its first node. Not saved.
+
+        Args:
+            route: Nodes to drive
+            end: Index after the last node of the current journey phase, the whole
+                route if None
+        """
+        self.route = list(route)
+        self.route_cursor = 0
+        self.route_end = len(self.route) if end is None else end
+
+    def replace_remaining_path(self, nodes: List[int]) -> None:
+        """
+        Drive the given nodes instead of the rest of the current journey phase, then
+        continue with the route after it (e.g. the inbound path). Not saved.
+        """
+        self.route = list(nodes) + self.route[self.route_end :]
+        self.route_cursor = 0
+        self.route_end = len(nodes)
+
+    def advance_route(self) -> None:
+        """Mark the next node of the route as visited. Not saved."""
+        self.route_cursor += 1
+
+    def start_next_route_phase(self) -> bool:
+        """
+        Extend the current journey phase to the end of the route, e.g. to continue
+        with the inbound path after the workstation. Not saved.
+
+        Returns:
+            bool: False if the route has no nodes after the current phase
+        """
+        if self.route_end >= len(self.route):
+            return False
+        self.route_end = len(self.route)
+        return True
+
+    def clear_route(self) -> None:
+        """Drop the route, leaving no remaining path. Not saved."""
+        self.set_route([])
+
+    def has_finished_route_phase(self) -> bool:
+        """Check if every node of the current journey phase was visited."""
+        return self.route_cursor >= self.route_end
+
+    @property
+    def remaining_path(self) -> List[int]:
+        """
+        Pi_i: Remaining points to be visited by AGV i, route[route_cursor:route_end].
+        Name in research paper: residual path. REMAINING_PATH in queries.
+        """
+        return self.route[self.route_cursor : self.route_end]
+
     def save(self, *args, **kwargs):
         """
         Override the save method to send WebSocket updates whenever an AGV instance is saved.
         This replaces the post_save signal handler with equivalent functionality.
         """
         # Call the parent class's save method to save the model
-        super().save(*args, **kwargs)
+        with stage_timer("db_write"):
+            super().save(*args, **kwargs)
+
+        self.sync_fleet_state(kwargs.get("update_fields"))
+        self.broadcast_update(kwargs.get("update_fields"))
 
+    def sync_fleet_state(self, update_fields=None):
+        """
+        Mirror the saved reservation and remaining path into the shared fleet state,
+        so other server processes see them. Does nothing with the database backend.
+
+        Args:
+            update_fields: Fields that were saved, None for all fields
+        """
+        fleet_state = get_fleet_state()
+        if not fleet_state.is_shared:
+            return
+
+        saved_fields = set(update_fields) if update_fields is not None else None
+        with stage_timer("fleet_state"):
+            if saved_fields is None or saved_fields & {
+                "reserved_node",
+                "reserved_segment",
+            }:
+                fleet_state.sync_reservation(self.agv_id, reservation_nodes(self))
+            if saved_fields is None or saved_fields & set(ROUTE_FIELDS):
+                fleet_state.set_path(self.agv_id, self.remaining_path or [])
+
+    def broadcast_update(self, update_fields=None):
+        """
+        Send the changed fields of this AGV to the WebSocket group. The consumers
+        turn them into patches (or full updates for legacy clients).
+
+        Args:
+            update_fields: Saved model fields, None to send every field
+        """
         # Import here to avoid circular imports
-        from .serializers import AGVSerializer
+        from .serializers import serialize_agv_fields
         from channels.layers import get_channel_layer
         from asgiref.sync import async_to_sync
 
-        # Serialize the AGV instance
-        serializer = AGVSerializer(self)
-        agv_data = serializer.data
+        with stage_timer("websocket_broadcast"):
+            # Serialize only what was saved
+            agv_data = serialize_agv_fields(self, update_fields)
 
-        # Get the channel layer
-        channel_layer = get_channel_layer()
+            # Get the channel layer
+            channel_layer = get_channel_layer()
 
-        # Send message to the WebSocket group
-        async_to_sync(channel_layer.group_send)(
-            "agv_group",  # Group name for AGV updates
-            {
-                "type": "agv_message",
-                "message": {"type": "agv_update", "data": agv_data},
-            },
-        )
+            # Send message to the WebSocket group
+            async_to_sync(channel_layer.group_send)(
+                "agv_group",  # Group name for AGV updates
+                {"type": "agv_delta", "agv_id": self.agv_id, "data": agv_data},
+            )
+
+    @classmethod
+    def broadcast_updates(cls, agv_ids, update_fields=None):
+        """
+        Send the state of several AGVs to the WebSocket group.
+        Used after set-based updates, which bypass save().
+
+        Args:
+            agv_ids: IDs of the AGVs whose rows were changed
+            update_fields: Model fields the update changed, None for all fields
+        """
+        if not agv_ids:
+            return
+        agvs = cls.objects.filter(agv_id__in=agv_ids)
+        if update_fields is None or "active_order" in update_fields:
+            agvs = agvs.select_related("active_order")
+        for agv in agvs:
+            agv.broadcast_update(update_fields)
 
     class Meta:
         verbose_name = "AGV"
         verbose_name_plural = "AGVs"
         ordering = ["agv_id"]
+        indexes = [
+            # Array containment/overlap lookups of the control policy and deadlock checks
+            GinIndex(fields=["route"], name="agv_route_gin"),
+            GinIndex(fields=["common_nodes"], name="agv_common_nodes_gin"),
+            GinIndex(fields=["adjacent_common_nodes"], name="agv_adj_common_nodes_gin"),
+            GinIndex(fields=["reserved_segment"], name="agv_reserved_segment_gin"),
+            # Point lookups by position and reservation
+            models.Index(fields=["current_node"], name="agv_current_node_idx"),
+            models.Index(fields=["next_node"], name="agv_next_node_idx"),
+            models.Index(fields=["reserved_node"], name="agv_reserved_node_idx"),
+            models.Index(fields=["motion_state"], name="agv_motion_state_idx"),
+        ]
 
     def __str__(self):
         return f"AGV {self.agv_id} likes to park at {self.preferred_parking_node} and is currently at {self.current_node} with state {self.get_motion_state_display()}."
@@ -1,27 +1,65 @@
+import logging
+import queue
+import threading
+import time
 import paho.mqtt.client as mqtt
 from django.conf import settings
-from typing import Optional, Tuple
+from django.core.exceptions import ImproperlyConfigured
+from typing import Dict, List, Tuple
 
 from .models import Agv
-from .encode_decode_data_frames.agv_to_server_decoder import decode_message
-from .encode_decode_data_frames.server_to_agv_encoder import encode_message
-
-from .apply_main_algorithms.apply_main_algorithms import (
-    _update_agv_position,
-    _get_agv_by_id,
-    _apply_control_policy,
-    _trigger_deadlock_partner_control_policy,
+from .encode_decode_data_frames.agv_to_server_decoder import (
+    SequenceTracker,
+    decode_messages,
 )
+from .encode_decode_data_frames.frame_format import (
+    MAX_RECORDS_PER_FRAME,
+    MAX_RESERVATION_HORIZON,
+    SEQUENCE_NUMBER_MODULO,
+)
+from .encode_decode_data_frames.server_to_agv_encoder import (
+    encode_message,
+    encode_batch_message,
+)
+
+from .fleet_state import get_fleet_state
+from .metrics import REGISTRY, stage_timer
+from .mqtt_transport import create_client
+from .prepositioning import PrepositioningLoop
+from .zones import REPORTS_SKIPPED, get_zone_map, is_sharded
+from .apply_main_algorithms.apply_main_algorithms import process_agv_position_report
+
+logger = logging.getLogger(__name__)
 
 MQTT_TOPIC_AGVDATA = settings.MQTT_TOPIC_AGVDATA
 MQTT_TOPIC_AGVROUTE = settings.MQTT_TOPIC_AGVROUTE
 MQTT_TOPIC_AGVHELLO = settings.MQTT_TOPIC_AGVHELLO
+MQTT_TOPIC_AGVROUTE_BROADCAST = settings.MQTT_TOPIC_AGVROUTE_BROADCAST
+MQTT_DOWNLINK_PROTOCOL_VERSION = settings.MQTT_DOWNLINK_PROTOCOL_VERSION
+MQTT_TOPIC_QOS = settings.MQTT_TOPIC_QOS
+
+sequence_tracker = SequenceTracker(
+    reset_after=settings.AGV_SEQUENCE_RESET_SECONDS,
+    duplicate_window=settings.AGV_DUPLICATE_POSITION_SECONDS,
+)
+
+PUBLISH_QUEUE_LATENCY = REGISTRY.histogram(
+    "agv_mqtt_publish_queue_seconds",
+    "Time from queueing a downlink command until it was handed to the MQTT client",
+)
+PUBLISH_ACK_LATENCY = REGISTRY.histogram(
+    "agv_mqtt_publish_ack_seconds",
+    "Time from queueing a downlink command until the broker acknowledged it",
+)
 
 
 def _on_connect(client: mqtt.Client, userdata, flags, rc):
     if rc == 0:
         print("Connected to MQTT broker successfully")
-        client.subscribe(f"{settings.MQTT_TOPIC_AGVDATA}/#")
+        client.subscribe(
+            f"{settings.MQTT_TOPIC_AGVDATA}/#", qos=_get_topic_qos(MQTT_TOPIC_AGVDATA)
+        )
+        client.subscribe(f"{MQTT_TOPIC_AGVHELLO}/#")
     else:
         print("Bad connection. Code:", rc)
 
@@ -30,12 +68,16 @@ def _on_message(client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
     """
     Route incoming MQTT messages to appropriate handlers based on topic.
     """
-    print(f"Received message on topic: {message.topic} with payload: {message.payload}")
+    logger.debug(
+        f"Received message on topic: {message.topic} with payload: {message.payload}"
+    )
     # Route message to appropriate handler based on topic prefix
     topic_name = str(message.topic)
     if topic_name.startswith(f"{MQTT_TOPIC_AGVDATA}/"):
         # include decoding and processing logic
         handle_agv_data_message(client, message)
+    elif topic_name.startswith(f"{MQTT_TOPIC_AGVHELLO}/"):
+        handle_agv_hello_message(message)
     else:
         print(f"Received message on unhandled topic: {message.topic}")
 
@@ -43,63 +85,248 @@ def _on_message(client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
 def handle_agv_data_message(client: mqtt.Client, message: mqtt.MQTTMessage) -> None:
     """
     Handle AGV data messages containing location updates.
-    Processes AGV location update and applies DSPA control policy.
+    Processes every AGV location update in the frame and applies DSPA control policy.
 
     Args:
         mqtt_client: MQTT client instance
         message: MQTT message object with payload containing AGV data
     """
+    # Parse and validate message
+    reports = _parse_agv_messages(message.payload)
+    if is_sharded():
+        reports = _filter_reports_of_own_zone(reports)
+
+    for this_agv_id, this_agv_current_node in reports:
+        try:
+            _handle_agv_report(client, this_agv_id, this_agv_current_node)
+        except Exception:
+            # Already counted by the failing stage, keep handling the other reports
+            logger.exception(
+                f"Failed to handle position report of AGV {this_agv_id} "
+                f"at node {this_agv_current_node}"
+            )
+
+
+def _filter_reports_of_own_zone(
+    reports: List[Tuple[int, int]],
+) -> List[Tuple[int, int]]:
+    """Keep the reports from nodes of this shard's zone, the other shards handle the rest."""
+    zone_map = get_zone_map()
+    own_reports = [
+        (agv_id, current_node)
+        for agv_id, current_node in reports
+        if zone_map.owns(current_node)
+    ]
+    if len(own_reports) < len(reports):
+        REPORTS_SKIPPED.inc(len(reports) - len(own_reports))
+    return own_reports
+
+
+def handle_agv_hello_message(message: mqtt.MQTTMessage) -> None:
+    """
+    Handle the hello an AGV sends after (re)starting.
+    The AGV's sequence numbers start over, so the last one seen is forgotten.
+
+    Args:
+        message: MQTT message object, the topic ends with the AGV id
+    """
     try:
-        # Parse and validate message
-        this_agv_data = _parse_agv_message(message.payload)
-        if this_agv_data is None:
-            return
+        agv_id = int(str(message.topic).rsplit("/", 1)[-1])
+    except ValueError:
+        return
+    sequence_tracker.reset(agv_id)
+
+
+def _handle_agv_report(
+    client: mqtt.Client, this_agv_id: int, this_agv_current_node: int
+) -> None:
+    """Apply DSPA control policy for one AGV location update and send the resulting commands."""
+    # Send MQTT messages to the main AGV, to AGVs affected by initial deadlock
+    # resolution and to any partner AGVs that were affected by deadlock resolution
+    with stage_timer("report"):
+        affected_agvs = process_agv_position_report(this_agv_id, this_agv_current_node)
+        if affected_agvs:
+            _send_mqtt_messages_to_agvs(client, affected_agvs)
+
+
+def _parse_agv_messages(payload) -> List[Tuple[int, int]]:
+    """Parse and validate AGV message payload into (agv_id, current_node) reports."""
+    try:
+        with stage_timer("decode"):
+            reports = []
+            # Duplicated and out-of-order reports are dropped before any database work
+            for decoded_data in decode_messages(payload, sequence_tracker):
+                agv_id = decoded_data.get("agv_id")
+                current_node = decoded_data.get("current_node")
+
+                if not agv_id or current_node is None:
+                    continue
+
+                reports.append((int(agv_id), int(current_node)))
+            return reports
+    except ValueError as e:
+        logger.warning(f"Discarding invalid AGV message: {str(e)}")
+        return []
 
-        (this_agv_id, this_agv_current_node) = this_agv_data
-        this_agv = _get_agv_by_id(this_agv_id)
-        if not this_agv:
+
+class DownlinkPublisher:
+    """
+    Publishes downlink commands from a background thread.
+
+    The commands of one control decision are encoded on the ingest thread and queued
+    as one batch, then published back to back by the worker, so the MQTT ingest loop
+    never waits on outgoing traffic. Every command gets a per-AGV sequence number that
+    AGVs use to drop redelivered QoS 1 commands.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._sequence_numbers: Dict[int, int] = {}
+        self._pending_acknowledgements: Dict[int, float] = {}
+        # Reentrant, paho may call on_publish from inside publish()
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def next_sequence_number(self, agv_id: int) -> int:
+        """Get the next downlink sequence number for an AGV."""
+        with self._lock:
+            sequence_number = (
+                self._sequence_numbers.get(agv_id, -1) + 1
+            ) % SEQUENCE_NUMBER_MODULO
+            self._sequence_numbers[agv_id] = sequence_number
+            return sequence_number
+
+    def submit(
+        self, client: mqtt.Client, messages: List[Tuple[str, bytes, int]]
+    ) -> None:
+        """Queue the (topic, payload, qos) messages of one control decision."""
+        if not messages:
             return
-        # Update AGV position and path information
-        # Apply DSPA control policy to determine next action
-        _update_agv_position(agv=this_agv, current_node=this_agv_current_node)
-        initially_affected_agvs = _apply_control_policy(agv=this_agv)
-
-        # Check if any other AGVs were waiting for this AGV due to deadlock resolution
-        # and collect them to send MQTT messages
-        partner_agvs = _trigger_deadlock_partner_control_policy(
-            moved_agv_id=this_agv_id
-        )
+        self._ensure_worker_started()
+        self._queue.put((client, messages, time.perf_counter()))
 
-        # Send MQTT message to the main AGV
-        _send_mqtt_message_to_agv(client, this_agv)
+    def wait_until_idle(self, timeout: float) -> bool:
+        """
+        Wait until every queued batch was published.
 
-        # Send MQTT messages to AGVs affected by initial deadlock resolution
-        if initially_affected_agvs:
-            for affected_agv in initially_affected_agvs:
-                _send_mqtt_message_to_agv(client, affected_agv)
+        Returns:
+            bool: True if the queue is empty, False if the timeout expired first
+        """
+        deadline = time.perf_counter() + timeout
+        while self._queue.unfinished_tasks:
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
 
-        # Send MQTT messages to any partner AGVs that were affected by deadlock resolution
-        if partner_agvs:
-            for partner_agv in partner_agvs:
-                _send_mqtt_message_to_agv(client, partner_agv)
+    def on_publish(self, client: mqtt.Client, userdata, mid: int) -> None:
+        """Record the time until the broker acknowledged a queued message."""
+        with self._lock:
+            queued_at = self._pending_acknowledgements.pop(mid, None)
+        if queued_at is not None:
+            PUBLISH_ACK_LATENCY.observe(time.perf_counter() - queued_at)
 
-    except Exception:
-        pass
+    def _ensure_worker_started(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, daemon=True, name="mqtt_downlink_publisher_thread"
+            )
+            self._thread.start()
 
+    def _run(self) -> None:
+        """Publish queued batches in order."""
+        while True:
+            client, messages, queued_at = self._queue.get()
+            for topic, payload, qos in messages:
+                try:
+                    # Hold the lock so on_publish cannot run before the mid is known
+                    with stage_timer("mqtt_publish"), self._lock:
+                        message_info = client.publish(
+                            topic=topic, payload=payload, qos=qos
+                        )
+                        self._pending_acknowledgements[message_info.mid] = queued_at
+                    PUBLISH_QUEUE_LATENCY.observe(time.perf_counter() - queued_at)
+                except Exception:
+                    logger.exception(f"Failed to publish message on topic {topic}")
+            self._queue.task_done()
 
-def _parse_agv_message(payload) -> Optional[Tuple[int, int]]:
-    """Parse and validate AGV message payload."""
-    try:
-        decoded_data = decode_message(payload)
-        agv_id = decoded_data.get("agv_id")
-        current_node = decoded_data.get("current_node")
 
-        if not agv_id or current_node is None:
-            return None
+def _get_topic_qos(topic: str) -> int:
+    """Get the QoS level configured for a topic, matching the longest topic prefix."""
+    matching_prefixes = [
+        prefix
+        for prefix in MQTT_TOPIC_QOS
+        if topic == prefix or topic.startswith(f"{prefix}/")
+    ]
+    if not matching_prefixes:
+        return 2
+    return MQTT_TOPIC_QOS[max(matching_prefixes, key=len)]
 
-        return int(agv_id), int(current_node)
-    except ValueError:
-        return None
+
+def validate_downlink_settings() -> None:
+    """
+    Raises:
+        ImproperlyConfigured: If downlink commands are published below QoS 2 without
+            the version 2 protocol, whose sequence numbers let AGVs drop redelivered
+            commands, or if the reservation horizon does not fit its byte in the frame
+    """
+    if settings.CONTROL_POLICY_RESERVATION_HORIZON > MAX_RESERVATION_HORIZON:
+        raise ImproperlyConfigured(
+            "CONTROL_POLICY_RESERVATION_HORIZON must not exceed "
+            f"{MAX_RESERVATION_HORIZON}, the frames carry it in a single byte"
+        )
+    if MQTT_DOWNLINK_PROTOCOL_VERSION >= 2:
+        return
+    for topic, qos in MQTT_TOPIC_QOS.items():
+        is_downlink_topic = topic == MQTT_TOPIC_AGVROUTE or topic.startswith(
+            f"{MQTT_TOPIC_AGVROUTE}/"
+        )
+        if is_downlink_topic and qos < 2:
+            raise ImproperlyConfigured(
+                f"QoS {qos} on {topic} needs MQTT_DOWNLINK_PROTOCOL_VERSION=2, "
+                "version 1 frames carry no sequence number to drop redelivered commands"
+            )
+
+
+def _send_mqtt_messages_to_agvs(client: mqtt.Client, agvs: List[Agv]) -> None:
+    """
+    Send the commands decided for several AGVs.
+
+    With the version 2 downlink protocol, commands for more than one AGV are batched
+    into as few broadcast frames as possible. Otherwise every AGV gets its own frame.
+    All frames of the decision are handed to the downlink publisher together.
+
+    Args:
+        client: MQTT client instance
+        agvs: AGV instances to send messages to, later duplicates win
+    """
+    with stage_timer("encode"):
+        unique_agvs: Dict[int, Agv] = {}
+        for agv in agvs:
+            unique_agvs.pop(agv.agv_id, None)
+            unique_agvs[agv.agv_id] = agv
+        agvs = list(unique_agvs.values())
+
+        if MQTT_DOWNLINK_PROTOCOL_VERSION < 2 or len(agvs) == 1:
+            messages = [_build_agv_message(agv) for agv in agvs]
+        else:
+            messages = []
+            for start in range(0, len(agvs), MAX_RECORDS_PER_FRAME):
+                batch = agvs[start : start + MAX_RECORDS_PER_FRAME]
+                encoded_message = encode_batch_message(
+                    [_build_agv_command(agv) for agv in batch]
+                )
+                messages.append(
+                    (
+                        MQTT_TOPIC_AGVROUTE_BROADCAST,
+                        encoded_message,
+                        _get_topic_qos(MQTT_TOPIC_AGVROUTE_BROADCAST),
+                    )
+                )
+
+    downlink_publisher.submit(client, messages)
 
 
 def _send_mqtt_message_to_agv(client: mqtt.Client, agv: Agv) -> None:
@@ -110,27 +337,106 @@ def _send_mqtt_message_to_agv(client: mqtt.Client, agv: Agv) -> None:
         client: MQTT client instance
         agv: AGV instance to send message to
     """
-    try:
+    _send_mqtt_messages_to_agvs(client, [agv])
+
+
+def _build_agv_message(agv: Agv) -> Tuple[str, bytes, int]:
+    """Encode the command for a single AGV into a (topic, payload, qos) message."""
+    if MQTT_DOWNLINK_PROTOCOL_VERSION >= 2:
+        encoded_message = encode_batch_message([_build_agv_command(agv)])
+    else:
         encoded_message = encode_message(
             motion_state=agv.motion_state,
             reserved_node=agv.reserved_node,
             direction_change=agv.direction_change,
+            reservation_horizon=_get_reservation_horizon(agv),
         )
 
-        client.publish(
-            topic=f"{MQTT_TOPIC_AGVROUTE}/{agv.agv_id}", payload=encoded_message, qos=2
-        )
+    topic = f"{MQTT_TOPIC_AGVROUTE}/{agv.agv_id}"
+    return topic, encoded_message, _get_topic_qos(topic)
+
 
-    except Exception:
-        pass
+def _build_agv_command(agv: Agv) -> Dict:
+    """Build the version 2 downlink command record for an AGV."""
+    return {
+        "agv_id": agv.agv_id,
+        "motion_state": agv.motion_state,
+        "reserved_node": agv.reserved_node,
+        "direction_change": agv.direction_change,
+        "reservation_horizon": _get_reservation_horizon(agv),
+        "sequence": downlink_publisher.next_sequence_number(agv.agv_id),
+    }
 
 
-client = mqtt.Client()
+def _get_reservation_horizon(agv: Agv) -> int:
+    """Get the number of consecutive nodes the AGV may traverse without waiting."""
+    if agv.motion_state != Agv.MOVING or agv.reserved_node is None:
+        return 1
+    return 1 + len(agv.reserved_segment)
+
+
+downlink_publisher = DownlinkPublisher()
+
+client = create_client(settings.MQTT_TRANSPORT)
 client.on_connect = _on_connect
 client.on_message = _on_message
+client.on_publish = downlink_publisher.on_publish
 client.username_pw_set(username=settings.MQTT_USER, password=settings.MQTT_PASSWORD)
-client.connect(
-    host=settings.MQTT_BROKER,
-    port=settings.MQTT_PORT,
-    keepalive=settings.MQTT_KEEPALIVE,
+
+# Commands of idle AGVs sent to staging nodes go out like those of position reports
+prepositioning_loop = PrepositioningLoop(
+    send_commands=lambda agvs: _send_mqtt_messages_to_agvs(client, agvs)
 )
+
+_consumer_lock = threading.Lock()
+_consumer_running = False
+
+
+def _get_controlled_agvs() -> List[Agv]:
+    """AGVs whose reports this process handles, the AGVs of its zone if sharded."""
+    agvs = Agv.objects.all()
+    if not is_sharded():
+        return list(agvs)
+    zone_map = get_zone_map()
+    return [agv for agv in agvs if zone_map.owns(agv.current_node)]
+
+
+def start_consumer() -> None:
+    """
+    Connect to the broker and start handling AGV reports. Called in the process that
+    holds the MQTT leadership (see leader_election), after rebuilding the in-memory
+    state the previous leader may have left behind.
+    """
+    global _consumer_running
+    with _consumer_lock:
+        if _consumer_running:
+            return
+
+        # Sequence numbers seen before (or by the previous leader) are stale now
+        sequence_tracker.reset_all()
+        get_fleet_state().rebuild(_get_controlled_agvs())
+
+        client.connect(
+            host=settings.MQTT_BROKER,
+            port=settings.MQTT_PORT,
+            keepalive=settings.MQTT_KEEPALIVE,
+        )
+        client.loop_start()
+        if settings.PREPOSITIONING:
+            prepositioning_loop.start()
+        _consumer_running = True
+        logger.info("MQTT consumer started")
+
+
+def stop_consumer() -> None:
+    """Stop handling AGV reports and drop the subscriptions, e.g. after losing leadership."""
+    global _consumer_running
+    with _consumer_lock:
+        if not _consumer_running:
+            return
+
+        prepositioning_loop.stop()
+        client.disconnect()
+        client.loop_stop()
+        _consumer_running = False
+        logger.info("MQTT consumer stopped")
@@ -0,0 +1,204 @@
+"""
+Transports behind the MQTT client of agv_data.mqtt.
+
+"paho" connects to a real broker (Mosquitto in compose.yaml). "memory" uses an
+in-process broker with the same client interface, so the ingest path can be load
+tested on a single machine without network or broker.
+"""
+
+import itertools
+import logging
+import queue
+import threading
+from typing import Dict, List, Tuple
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+PAHO_TRANSPORT = "paho"
+MEMORY_TRANSPORT = "memory"
+
+
+def topic_matches_filter(topic_filter: str, topic: str) -> bool:
+    """
+    Check if a topic matches a subscription filter with MQTT wildcards
+    ("+" matches one level, a trailing "#" matches any number of levels).
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    for index, filter_level in enumerate(filter_levels):
+        if filter_level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if filter_level != "+" and filter_level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class InMemoryMessage:
+    """Message delivered by the in-memory broker, mirrors paho's MQTTMessage fields."""
+
+    def __init__(self, topic: str, payload: bytes, qos: int, mid: int):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.mid = mid
+
+
+class InMemoryMessageInfo:
+    """Result of InMemoryClient.publish, mirrors paho's MQTTMessageInfo."""
+
+    def __init__(self, mid: int):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout=None) -> None:
+        """Messages are handed to subscribers synchronously, nothing to wait for."""
+
+
+class InMemoryBroker:
+    """Routes published messages to the inboxes of subscribed in-memory clients."""
+
+    def __init__(self):
+        self._subscriptions: List[Tuple[str, "InMemoryClient"]] = []
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.published_count = 0
+
+    def subscribe(self, client: "InMemoryClient", topic_filter: str) -> None:
+        with self._lock:
+            if (topic_filter, client) not in self._subscriptions:
+                self._subscriptions.append((topic_filter, client))
+
+    def unsubscribe_all(self, client: "InMemoryClient") -> None:
+        with self._lock:
+            self._subscriptions = [
+                (topic_filter, subscriber)
+                for topic_filter, subscriber in self._subscriptions
+                if subscriber is not client
+            ]
+
+    def publish(self, topic: str, payload: bytes, qos: int) -> int:
+        """
+        Deliver a message to every client with a matching subscription.
+
+        Returns:
+            int: Message id of the publish
+        """
+        with self._lock:
+            mid = next(self._message_ids)
+            self.published_count += 1
+            subscribers = {
+                subscriber
+                for topic_filter, subscriber in self._subscriptions
+                if topic_matches_filter(topic_filter, topic)
+            }
+
+        for subscriber in subscribers:
+            subscriber.deliver(InMemoryMessage(topic, payload, qos, mid))
+        return mid
+
+
+# Broker shared by every in-memory client of the process
+default_broker = InMemoryBroker()
+
+
+class InMemoryClient:
+    """
+    Client of the in-memory broker with the subset of the paho client interface
+    used by this project. Callbacks run on the client's loop thread, like in paho.
+    """
+
+    def __init__(self, broker: InMemoryBroker = None, client_id: str = ""):
+        self.broker = broker or default_broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+        self._inbox: "queue.Queue" = queue.Queue()
+        self._thread = None
+        self._running = False
+
+    def username_pw_set(self, username=None, password=None) -> None:
+        """Credentials are not checked by the in-memory broker."""
+
+    def connect(self, host=None, port=None, keepalive=None) -> int:
+        self._inbox.put(("connack", None))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self) -> int:
+        self.broker.unsubscribe_all(self)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic: str, qos: int = 0) -> Tuple[int, int]:
+        self.broker.subscribe(self, topic)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        mid = self.broker.publish(topic, payload or b"", qos)
+        self._inbox.put(("puback", mid))
+        return InMemoryMessageInfo(mid)
+
+    def deliver(self, message: InMemoryMessage) -> None:
+        """Called by the broker to hand a message to this client."""
+        self._inbox.put(("message", message))
+
+    def loop_start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._loop, daemon=True, name=f"in_memory_mqtt_{self.client_id}"
+        )
+        self._thread.start()
+
+    def loop_stop(self) -> None:
+        self._running = False
+        self._inbox.put(("stop", None))
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def pending_count(self) -> int:
+        """Number of events not yet handled by the loop thread."""
+        return self._inbox.qsize()
+
+    def _loop(self) -> None:
+        while self._running:
+            event, value = self._inbox.get()
+            try:
+                if event == "connack" and self.on_connect:
+                    self.on_connect(self, None, {}, 0)
+                elif event == "message" and self.on_message:
+                    self.on_message(self, None, value)
+                elif event == "puback" and self.on_publish:
+                    self.on_publish(self, None, value)
+            except Exception:
+                logger.exception(f"Error in in-memory MQTT {event} callback")
+
+
+def create_client(transport: str, client_id: str = ""):
+    """
+    Create an MQTT client for the given transport.
+
+    Args:
+        transport: "paho" for a real broker or "memory" for the in-process broker
+        client_id: Client identifier
+
+    Returns:
+        mqtt.Client or InMemoryClient: Client with the paho client interface
+
+    Raises:
+        ValueError: If the transport is unknown
+    """
+    transports: Dict[str, type] = {
+        PAHO_TRANSPORT: mqtt.Client,
+        MEMORY_TRANSPORT: InMemoryClient,
+    }
+    if transport not in transports:
+        raise ValueError(f"Unknown MQTT transport: {transport}")
+    return transports[transport](client_id=client_id)
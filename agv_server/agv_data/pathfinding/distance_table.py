@@ -0,0 +1,51 @@
+import heapq
+import threading
+from typing import Dict
+
+
+class DistanceTable:
+    """
+    Shortest-path distances between map nodes, filled one source node at a time.
+    Each source is searched once with Dijkstra's algorithm and then cached, so
+    looking up the distance of every idle AGV to a storage node is a dict lookup.
+    """
+
+    def __init__(self, connections):
+        """
+        Args:
+            connections (list): List of connections between nodes.
+        """
+        self.graph: Dict[int, Dict[int, float]] = {}
+        for conn in connections:
+            node1, node2, distance = conn["node1"], conn["node2"], conn["distance"]
+            self.graph.setdefault(node1, {})[node2] = distance
+            self.graph.setdefault(node2, {})[node1] = distance  # Bidirectional
+        self._distances: Dict[int, Dict[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def get_distances(self, source: int) -> Dict[int, float]:
+        """Get the distance from source to every node reachable from it."""
+        with self._lock:
+            distances = self._distances.get(source)
+        if distances is not None:
+            return distances
+
+        distances = {source: 0}
+        queue = [(0, source)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if distance > distances[node]:
+                continue
+            for neighbor, edge_distance in self.graph.get(node, {}).items():
+                new_distance = distance + edge_distance
+                if new_distance < distances.get(neighbor, float("inf")):
+                    distances[neighbor] = new_distance
+                    heapq.heappush(queue, (new_distance, neighbor))
+
+        with self._lock:
+            self._distances[source] = distances
+        return distances
+
+    def get_distance(self, source: int, target: int) -> float:
+        """Get the shortest-path distance between two nodes, infinite if unreachable."""
+        return self.get_distances(source).get(target, float("inf"))
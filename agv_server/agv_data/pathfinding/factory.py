@@ -5,6 +5,7 @@ Factory class for creating pathfinding algorithm instances.
 from .dijkstra import Dijkstra
 from .greedy import GreedyDistance
 from .hill_climbing import HillClimbing
+from .turn_penalized import TurnPenalizedDijkstra
 
 
 class PathfindingFactory:
@@ -21,7 +22,7 @@ class PathfindingFactory:
         Get an instance of the specified pathfinding algorithm.
 
         Args:
-            algorithm_name (str): The name of the algorithm ("dijkstra", "greedy", "hill_climbing").
+            algorithm_name (str): The name of the algorithm ("dijkstra", "greedy", "hill_climbing", "turn_penalized").
             nodes (list): List of all nodes in the graph.
             connections (list): List of connections between nodes.
 
@@ -35,6 +36,7 @@ class PathfindingFactory:
             "dijkstra": Dijkstra,
             "greedy": GreedyDistance,
             "hill_climbing": HillClimbing,
+            "turn_penalized": TurnPenalizedDijkstra,
         }
 
         if algorithm_name in algorithms:
@@ -45,4 +47,4 @@ class PathfindingFactory:
     @staticmethod
     def get_available_algorithms():
         """Get list of available algorithm names."""
-        return ["dijkstra", "greedy", "hill_climbing"]
+        return ["dijkstra", "greedy", "hill_climbing", "turn_penalized"]
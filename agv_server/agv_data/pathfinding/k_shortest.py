@@ -0,0 +1,168 @@
+import heapq
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from .dijkstra import Dijkstra
+
+
+class YenKShortestPaths(Dijkstra):
+    """
+    Yen's algorithm for the k shortest loopless paths between two nodes.
+
+    The first path is the Dijkstra result. Every further path deviates from one of
+    the paths found so far at a spur node: the edges the known paths take from
+    the same root are removed, the root's nodes are excluded and the cheapest spur
+    path to the end completes a candidate.
+    """
+
+    def find_k_shortest_paths(self, start, end, k: int) -> List[List[int]]:
+        """
+        Find up to k loopless paths from start to end, shortest first.
+
+        Args:
+            start (int): The starting node.
+            end (int): The destination node.
+            k (int): Maximum number of paths.
+
+        Returns:
+            List[List[int]]: The paths, empty if end is unreachable.
+        """
+        first_path = self._search(start, end, set(), set())
+        if not first_path:
+            return []
+
+        paths = [first_path]
+        candidates: List[Tuple[float, List[int]]] = []
+        seen = {tuple(first_path)}
+        while len(paths) < k:
+            previous_path = paths[-1]
+            for index in range(len(previous_path) - 1):
+                spur_node = previous_path[index]
+                root = previous_path[: index + 1]
+                removed_edges = {
+                    (path[index], path[index + 1])
+                    for path in paths
+                    if len(path) > index + 1 and path[: index + 1] == root
+                }
+                spur_path = self._search(spur_node, end, set(root[:-1]), removed_edges)
+                if not spur_path:
+                    continue
+                candidate = root[:-1] + spur_path
+                if tuple(candidate) in seen:
+                    continue
+                seen.add(tuple(candidate))
+                heapq.heappush(candidates, (self.get_path_length(candidate), candidate))
+
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates)[1])
+
+        return paths
+
+    def get_path_length(self, path: List[int]) -> float:
+        """Sum of the distances along a path."""
+        return sum(
+            self.graph[node][next_node] for node, next_node in zip(path, path[1:])
+        )
+
+    def _search(
+        self,
+        start,
+        end,
+        removed_nodes: Set[int],
+        removed_edges: Set[Tuple[int, int]],
+    ) -> List[int]:
+        """Dijkstra search that skips the removed nodes and edges."""
+        if start not in self.graph:
+            return []
+        distances = {start: 0}
+        previous: Dict[int, int] = {}
+        queue = [(0, start)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if node == end:
+                path = [node]
+                while path[-1] != start:
+                    path.append(previous[path[-1]])
+                return path[::-1]
+            if distance > distances[node]:
+                continue
+            for neighbor, edge_distance in self.graph[node].items():
+                if neighbor in removed_nodes or (node, neighbor) in removed_edges:
+                    continue
+                new_distance = distance + edge_distance
+                if new_distance < distances.get(neighbor, float("inf")):
+                    distances[neighbor] = new_distance
+                    previous[neighbor] = node
+                    heapq.heappush(queue, (new_distance, neighbor))
+        return []
+
+
+class AlternativePaths:
+    """
+    Cache of the k shortest paths between node pairs, each pair searched once.
+    Only paths at most max_detour_ratio times as long as the shortest are kept.
+    """
+
+    def __init__(self, engine: YenKShortestPaths, k: int, max_detour_ratio: float):
+        self.engine = engine
+        self.k = k
+        self.max_detour_ratio = max_detour_ratio
+        self._paths: Dict[Tuple[int, int], List[List[int]]] = {}
+        self._lock = threading.Lock()
+
+    def get_paths(self, start: int, end: int) -> List[List[int]]:
+        """Get the alternative paths from start to end, shortest first."""
+        with self._lock:
+            paths = self._paths.get((start, end))
+        if paths is not None:
+            return paths
+
+        paths = self.engine.find_k_shortest_paths(start, end, self.k)
+        if paths:
+            max_length = self.engine.get_path_length(paths[0]) * self.max_detour_ratio
+            paths = [
+                path
+                for path in paths
+                if self.engine.get_path_length(path) <= max_length
+            ]
+        with self._lock:
+            self._paths[(start, end)] = paths
+        return paths
+
+    def precompute(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        """
+        Search the alternatives of node pairs ahead of time.
+
+        Returns:
+            int: Number of pairs that were not cached yet
+        """
+        computed = 0
+        for start, end in pairs:
+            with self._lock:
+                if (start, end) in self._paths:
+                    continue
+            self.get_paths(start, end)
+            computed += 1
+        return computed
+
+
+def pick_least_loaded(
+    paths: List[List[int]], node_loads: Mapping[int, int]
+) -> Optional[List[int]]:
+    """
+    Pick the path whose nodes lie on the fewest other paths. Ties go to the earlier
+    path, so with paths ordered shortest first the shorter one wins.
+
+    Args:
+        paths: Candidate paths
+        node_loads: Number of other AGV paths through every node
+
+    Returns:
+        Optional[List[int]]: The least loaded path, None if there is no candidate
+    """
+    return min(
+        paths,
+        key=lambda path: sum(node_loads.get(node, 0) for node in path),
+        default=None,
+    )
@@ -0,0 +1,191 @@
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from map_data.models import Direction
+from .base import BasePathfinding
+from ..direction_change.direction_to_turn import (
+    EAST,
+    GO_STRAIGHT,
+    NORTH,
+    SOUTH,
+    TURN_AROUND,
+    WEST,
+    get_action_between_directions,
+)
+
+OPPOSITE_DIRECTIONS = {NORTH: SOUTH, SOUTH: NORTH, EAST: WEST, WEST: EAST}
+
+
+class TurnPenalizedDijkstra(BasePathfinding):
+    """
+    Dijkstra's algorithm over (node, heading) states that minimizes travel time.
+
+    Driving an edge costs its distance divided by the AGV speed. Arriving at a node
+    in one heading and leaving in another costs the time of the turn the AGV has to
+    make there, determined from the Direction data like the turn commands sent to
+    the AGVs (get_action). The heading at the start node is that of the edge from
+    previous_node if it is given; otherwise it is unknown and the first edge is never
+    penalized. Routes of several legs are searched leg by leg with
+    find_shortest_path_chain, which carries the heading from one leg into the next.
+    """
+
+    def __init__(
+        self,
+        nodes,
+        connections,
+        directions: Optional[Dict[Tuple[int, int], int]] = None,
+        speed: Optional[float] = None,
+        turn_penalty: Optional[float] = None,
+        turn_around_penalty: Optional[float] = None,
+    ):
+        """
+        Args:
+            nodes (list): List of all nodes in the graph.
+            connections (list): List of connections between nodes.
+            directions: Cardinal direction of every edge (node1, node2), loaded from
+                the Direction table if None
+            speed: Distance units per second (AGV_SPEED if None)
+            turn_penalty: Seconds a left or right turn takes (TURN_PENALTY_SECONDS)
+            turn_around_penalty: Seconds a reversal takes (TURN_AROUND_PENALTY_SECONDS)
+        """
+        super().__init__(nodes, connections)
+        self.graph = self._build_graph(connections)
+        self.directions = (
+            directions if directions is not None else self._load_directions()
+        )
+        self.speed = speed if speed is not None else settings.AGV_SPEED
+        turn_penalty = (
+            turn_penalty if turn_penalty is not None else settings.TURN_PENALTY_SECONDS
+        )
+        turn_around_penalty = (
+            turn_around_penalty
+            if turn_around_penalty is not None
+            else settings.TURN_AROUND_PENALTY_SECONDS
+        )
+        self.action_penalties = {
+            GO_STRAIGHT: 0,
+            TURN_AROUND: turn_around_penalty,
+        }
+        self.turn_penalty = turn_penalty
+
+    def _build_graph(self, connections):
+        graph = {node: {} for node in self.nodes}
+        for conn in connections:
+            node1, node2, distance = conn["node1"], conn["node2"], conn["distance"]
+            graph[node1][node2] = distance
+            graph[node2][node1] = distance  # Assuming bidirectional paths
+        return graph
+
+    @staticmethod
+    def _load_directions() -> Dict[Tuple[int, int], int]:
+        """Get the direction of every edge in both orders, like get_direction."""
+        directions = {}
+        rows = list(Direction.objects.values_list("node1", "node2", "direction"))
+        for node1, node2, direction in rows:
+            directions[(node1, node2)] = direction
+        for node1, node2, direction in rows:
+            # The stored order wins over the one derived from the reverse edge
+            directions.setdefault((node2, node1), OPPOSITE_DIRECTIONS.get(direction))
+        return directions
+
+    def get_turn_penalty(self, incoming_direction, outgoing_direction) -> float:
+        """Seconds the AGV needs to change from one heading to the other."""
+        action = get_action_between_directions(incoming_direction, outgoing_direction)
+        return self.action_penalties.get(action, self.turn_penalty)
+
+    def find_shortest_path(self, start, end, previous_node=None):
+        """
+        Find the fastest path from start to end.
+
+        Args:
+            start (int): The starting node.
+            end (int): The destination node.
+            previous_node (Optional[int]): The node the AGV arrived at start from,
+                so leaving start in another heading is penalized
+
+        Returns:
+            list: A list of nodes representing the fastest path.
+        """
+        if start not in self.graph:
+            return []
+
+        # State: (node, heading the AGV arrived in); None if the heading is unknown
+        start_heading = (
+            self.directions.get((previous_node, start))
+            if previous_node is not None
+            else None
+        )
+        start_state = (start, start_heading)
+        best_costs = {start_state: 0}
+        parents = {start_state: None}
+        # (seconds, tie breaker, node, heading)
+        priority_queue = [(0, 0, start, start_heading)]
+        counter = 1
+        settled = set()
+
+        while priority_queue:
+            cost, _, node, heading = heapq.heappop(priority_queue)
+            state = (node, heading)
+
+            if state in settled:
+                continue
+            settled.add(state)
+
+            if node == end:
+                return self._build_path(parents, state)
+
+            for neighbor, distance in self.graph[node].items():
+                outgoing_direction = self.directions.get((node, neighbor))
+                new_cost = cost + distance / self.speed
+                if heading is not None:
+                    new_cost += self.get_turn_penalty(heading, outgoing_direction)
+
+                next_state = (neighbor, outgoing_direction)
+                if next_state in settled or new_cost >= best_costs.get(
+                    next_state, float("inf")
+                ):
+                    continue
+                best_costs[next_state] = new_cost
+                parents[next_state] = state
+                heapq.heappush(
+                    priority_queue, (new_cost, counter, neighbor, outgoing_direction)
+                )
+                counter += 1
+
+        return []  # No path found
+
+    def find_shortest_path_chain(
+        self, waypoints: List[int], previous_node: Optional[int] = None
+    ) -> List[List[int]]:
+        """
+        Find the fastest path of every leg between consecutive waypoints. Each leg
+        starts in the heading the previous one ended in, so turning around at a
+        waypoint is charged.
+
+        Args:
+            waypoints (List[int]): The nodes to visit in order
+            previous_node (Optional[int]): The node the AGV arrived at the first
+                waypoint from
+
+        Returns:
+            List[List[int]]: One path per leg, empty if any leg has no path
+        """
+        legs = []
+        for start, end in zip(waypoints, waypoints[1:]):
+            path = self.find_shortest_path(start, end, previous_node)
+            if not path:
+                return []
+            legs.append(path)
+            if len(path) > 1:
+                previous_node = path[-2]
+        return legs
+
+    @staticmethod
+    def _build_path(parents, state):
+        path = []
+        while state is not None:
+            path.append(state[0])
+            state = parents[state]
+        return path[::-1]
@@ -0,0 +1,283 @@
+"""
+Prepositioning of idle AGVs based on recent demand.
+
+Idle AGVs wait wherever their last order left them, usually their parking node. With
+PREPOSITIONING, the storage nodes with the most orders due in the last
+PREPOSITIONING_WINDOW_SECONDS are served first: the free staging node closest to such
+a storage node gets an idle AGV, unless an idle AGV already stands as close. The AGV
+gets a route without an order; the DSPA control policy drives it like any other
+route, and it is idle again once it arrived. Orders are matched to the nearest idle
+AGV (AGV_ASSIGNMENT_MODE "nearest"), so an order at a busy storage node finds an AGV
+close by.
+"""
+
+import datetime
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from order_data.models import Order
+from .apply_main_algorithms.apply_main_algorithms import (
+    decision_lock,
+    process_agv_position_report,
+)
+from .dispatcher_service import get_dispatcher_service
+from .main_algorithms.algorithm1.algorithm1 import NEAREST_ASSIGNMENT, TaskDispatcher
+from .main_algorithms.algorithm1.common_nodes import (
+    update_common_nodes_for_path_change,
+)
+from .metrics import REGISTRY, stage_timer
+from .models import ROUTE_FIELDS, Agv
+from .rerouting import get_time
+from .zones import get_zone_map, is_sharded
+
+logger = logging.getLogger(__name__)
+
+INFINITY = float("inf")
+
+REPOSITIONS = REGISTRY.counter(
+    "agv_repositions_total",
+    "Idle AGVs sent to a staging node close to recent demand",
+)
+
+
+def get_recent_demand(window_seconds: float) -> Counter:
+    """
+    Count the orders that became due in the last window_seconds per storage node.
+    Orders are due at the start time of their order date, windows longer than a day
+    are cut to one day.
+
+    Returns:
+        Counter: Number of due orders by storage node
+    """
+    window_end = timezone.localtime(get_time())
+    window_start = window_end - datetime.timedelta(seconds=min(window_seconds, 86400))
+    if window_start.date() == window_end.date():
+        due = Q(
+            order_date=window_end.date(),
+            start_time__gt=window_start.time(),
+            start_time__lte=window_end.time(),
+        )
+    else:
+        due = Q(order_date=window_start.date(), start_time__gt=window_start.time()) | Q(
+            order_date=window_end.date(), start_time__lte=window_end.time()
+        )
+    return Counter(Order.objects.filter(due).values_list("storage_node", flat=True))
+
+
+class Prepositioner:
+    """Sends idle AGVs to the staging nodes closest to recent demand."""
+
+    def __init__(
+        self, task_dispatcher: TaskDispatcher, staging_nodes: Iterable[int] = None
+    ):
+        """
+        Args:
+            task_dispatcher: Dispatcher of the current map, for distances and paths
+            staging_nodes: Nodes idle AGVs may wait on, PREPOSITIONING_STAGING_NODES
+                if None
+        """
+        self.task_dispatcher = task_dispatcher
+        self.staging_nodes = set(
+            settings.PREPOSITIONING_STAGING_NODES
+            if staging_nodes is None
+            else staging_nodes
+        )
+
+    def reposition_idle_agvs(self) -> List[Agv]:
+        """
+        Send idle AGVs towards the storage nodes with the most recent demand.
+
+        Returns:
+            List[Agv]: The AGVs whose command changed, like process_agv_position_report
+        """
+        if settings.AGV_ASSIGNMENT_MODE != NEAREST_ASSIGNMENT:
+            # Routes of parking mode start at the order's parking node, an AGV
+            # waiting elsewhere could not drive them
+            logger.warning(
+                'Prepositioning needs AGV_ASSIGNMENT_MODE "nearest", skipping'
+            )
+            return []
+
+        with stage_timer("preposition"):
+            demand = get_recent_demand(settings.PREPOSITIONING_WINDOW_SECONDS)
+            if not demand or not self.staging_nodes:
+                return []
+            moves = self._plan_moves(demand, self._get_idle_agvs())
+
+            affected_agvs = []
+            for agv, staging_node in moves:
+                # The AGV may have reported or taken an order since it was picked
+                with decision_lock:
+                    if self._start_reposition(agv, staging_node):
+                        affected_agvs.extend(
+                            process_agv_position_report(agv.agv_id, agv.current_node)
+                        )
+        return affected_agvs
+
+    def _get_idle_agvs(self) -> List[Agv]:
+        """Idle AGVs that stand on a known node and are not repositioning yet."""
+        idle_agvs = Agv.objects.filter(
+            motion_state=Agv.IDLE,
+            active_order__isnull=True,
+            next_node__isnull=True,
+            current_node__isnull=False,
+        )
+        if is_sharded():
+            # AGVs of other zones are repositioned by their own shard
+            zone_map = get_zone_map()
+            return [agv for agv in idle_agvs if zone_map.owns(agv.current_node)]
+        return list(idle_agvs)
+
+    def _get_free_staging_nodes(self) -> Set[int]:
+        """
+        Staging nodes no AGV stands on, reserved or drives to. Parking nodes stay
+        free for the AGVs returning to them.
+        """
+        taken_nodes = set()
+        for (
+            current_node,
+            reserved_node,
+            preferred_parking_node,
+            route,
+        ) in Agv.objects.values_list(
+            "current_node", "reserved_node", "preferred_parking_node", "route"
+        ):
+            taken_nodes.update((current_node, reserved_node, preferred_parking_node))
+            if route:
+                taken_nodes.add(route[-1])
+        return self.staging_nodes - taken_nodes
+
+    def _plan_moves(
+        self, demand: Counter, idle_agvs: List[Agv]
+    ) -> List[Tuple[Agv, int]]:
+        """
+        Pair idle AGVs with staging nodes, busiest storage node first. Every storage
+        node is covered by one idle AGV, either one that already stands at least as
+        close as the closest free staging node or one sent there.
+
+        Returns:
+            List[Tuple[Agv, int]]: (AGV, staging node) pairs
+        """
+        distance_table = self.task_dispatcher.distance_table
+        free_staging_nodes = self._get_free_staging_nodes()
+        unused_agvs: Dict[int, Agv] = {agv.agv_id: agv for agv in idle_agvs}
+        moves = []
+
+        for storage_node, _ in demand.most_common():
+            if not unused_agvs:
+                break
+            # The graph is undirected, distances from a node are distances to it
+            distances = distance_table.get_distances(storage_node)
+            closest_agv = min(
+                unused_agvs.values(),
+                key=lambda agv: (distances.get(agv.current_node, INFINITY), agv.agv_id),
+            )
+            staging_node = min(
+                free_staging_nodes,
+                key=lambda node: (distances.get(node, INFINITY), node),
+                default=None,
+            )
+            staging_distance = distances.get(staging_node, INFINITY)
+            if staging_distance >= distances.get(closest_agv.current_node, INFINITY):
+                # Nothing to gain, the closest idle AGV keeps covering this node
+                del unused_agvs[closest_agv.agv_id]
+                continue
+
+            staging_distances = distance_table.get_distances(staging_node)
+            agv = min(
+                unused_agvs.values(),
+                key=lambda agv: (
+                    staging_distances.get(agv.current_node, INFINITY),
+                    agv.agv_id,
+                ),
+            )
+            if staging_distances.get(agv.current_node, INFINITY) == INFINITY:
+                continue
+            del unused_agvs[agv.agv_id]
+            free_staging_nodes.discard(staging_node)
+            moves.append((agv, staging_node))
+
+        return moves
+
+    def _start_reposition(self, agv: Agv, staging_node: int) -> bool:
+        """
+        Give an idle AGV a route to a staging node, without an order. Other AGVs
+        sharing nodes of the route get them as common nodes.
+
+        Returns:
+            bool: False if the AGV is no longer idle or there is no path to the
+            staging node
+        """
+        agv.refresh_from_db()
+        if (
+            agv.motion_state != Agv.IDLE
+            or agv.active_order_id is not None
+            or agv.next_node is not None
+        ):
+            return False
+        path = self._find_path(agv.current_node, staging_node)
+        if not path or len(path) < 2:
+            return False
+
+        agv.set_route(path)
+        # The route starts at the node the AGV stands on
+        agv.advance_route()
+        agv.next_node = agv.remaining_path[0]
+        agv.save(update_fields=[*ROUTE_FIELDS, "next_node"])
+        update_common_nodes_for_path_change(agv, [])
+        REPOSITIONS.inc()
+        logger.info(
+            f"AGV {agv.agv_id} repositioning from {path[0]} to staging node "
+            f"{staging_node}: {path}"
+        )
+        return True
+
+    def _find_path(self, start: int, end: int) -> Optional[List[int]]:
+        engine = self.task_dispatcher.get_pathfinding_algorithm("dijkstra")
+        return engine.find_shortest_path(start, end)
+
+
+class PrepositioningLoop:
+    """
+    Background thread that runs the Prepositioner every
+    PREPOSITIONING_INTERVAL_SECONDS in the process that consumes AGV reports, and
+    hands the resulting commands to send_commands.
+    """
+
+    def __init__(self, send_commands: Callable[[List[Agv]], None]):
+        self.send_commands = send_commands
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start repositioning idle AGVs."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="agv_prepositioning_thread"
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop after the current round."""
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(settings.PREPOSITIONING_INTERVAL_SECONDS):
+            self._tick()
+
+    def _tick(self) -> None:
+        try:
+            prepositioner = Prepositioner(get_dispatcher_service().get_dispatcher())
+            affected_agvs = prepositioner.reposition_idle_agvs()
+            if affected_agvs:
+                self.send_commands(affected_agvs)
+        except Exception:
+            logger.exception("Error repositioning idle AGVs")
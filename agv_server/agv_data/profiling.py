@@ -0,0 +1,224 @@
+"""
+Opt-in profiling of control decisions.
+
+While a decision is profiled, every SQL query is attributed to the control loop
+stage it ran in (see metrics.stage_timer), together with the rows it returned and
+its duration. The results can be checked against per-stage query budgets and
+dumped as collapsed stacks for flame graph tools (flamegraph.pl, speedscope).
+
+Enable it for the server with the CONTROL_LOOP_PROFILING setting, or for one run
+of the fleet simulator with --profile-output.
+"""
+
+import contextlib
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import add_stage_observer, current_stage_path, remove_stage_observer
+
+# Stage path of queries that run outside of any stage
+UNSTAGED = ("unstaged",)
+
+PROFILE_METRICS = ("queries", "rows", "time")
+
+
+class ControlLoopProfiler:
+    """Collects query counts, rows fetched and wall time per decision and stage path."""
+
+    def __init__(self):
+        # Per stage path, for the path itself (not its children)
+        self.query_counts: Dict[Tuple[str, ...], int] = defaultdict(int)
+        self.rows_fetched: Dict[Tuple[str, ...], int] = defaultdict(int)
+        self.query_seconds: Dict[Tuple[str, ...], float] = defaultdict(float)
+        # Per stage path, including time spent in nested stages
+        self.stage_seconds: Dict[Tuple[str, ...], float] = defaultdict(float)
+        self.decisions: List[Dict] = []
+        self._active = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start receiving stage timings."""
+        add_stage_observer(self._on_stage_end)
+
+    def stop(self) -> None:
+        """Stop receiving stage timings."""
+        remove_stage_observer(self._on_stage_end)
+
+    @contextlib.contextmanager
+    def profile_decision(self):
+        """Profile every query and stage of the current thread until exit."""
+        decision = {"queries": 0, "rows": 0, "stage_queries": defaultdict(int)}
+        self._active.decision = decision
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._make_query_recorder(decision)):
+                yield
+        finally:
+            self._active.decision = None
+            decision["seconds"] = time.perf_counter() - started
+            decision["stage_queries"] = dict(decision["stage_queries"])
+            with self._lock:
+                self.decisions.append(decision)
+
+    def _make_query_recorder(self, decision: Dict):
+        def record_query(execute, sql, params, many, context):
+            stage_path = current_stage_path() or UNSTAGED
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                elapsed = time.perf_counter() - started
+                rows = max(getattr(context.get("cursor"), "rowcount", 0) or 0, 0)
+                with self._lock:
+                    self.query_counts[stage_path] += 1
+                    self.rows_fetched[stage_path] += rows
+                    self.query_seconds[stage_path] += elapsed
+                decision["queries"] += 1
+                decision["rows"] += rows
+                # A query counts towards the budget of every stage it is nested in
+                for stage in set(stage_path):
+                    decision["stage_queries"][stage] += 1
+
+        return record_query
+
+    def _on_stage_end(self, stage_path: Tuple[str, ...], seconds: float) -> None:
+        if getattr(self._active, "decision", None) is None:
+            return
+        with self._lock:
+            self.stage_seconds[stage_path] += seconds
+
+    # === Results ===
+
+    def max_queries_by_stage(self) -> Dict[str, int]:
+        """Get the most queries a single decision ran in each stage."""
+        max_queries: Dict[str, int] = defaultdict(int)
+        for decision in self.decisions:
+            for stage, count in decision["stage_queries"].items():
+                max_queries[stage] = max(max_queries[stage], count)
+        max_queries["decision"] = max(
+            (decision["queries"] for decision in self.decisions), default=0
+        )
+        return dict(max_queries)
+
+    def budget_violations(self, budgets: Dict[str, int]) -> List[Tuple[str, int, int]]:
+        """
+        Compare the worst decision of every stage against its query budget.
+
+        Args:
+            budgets: Maximum queries per decision by stage name ("decision" for the
+                whole decision)
+
+        Returns:
+            List[Tuple[str, int, int]]: (stage, queries, budget) of every exceeded budget
+        """
+        max_queries = self.max_queries_by_stage()
+        return [
+            (stage, max_queries[stage], budget)
+            for stage, budget in sorted(budgets.items())
+            if max_queries.get(stage, 0) > budget
+        ]
+
+    def collapsed_stacks(self, metric: str = "queries") -> List[str]:
+        """
+        Render the profile as collapsed stacks ("stage;nested_stage value").
+
+        Args:
+            metric: "queries", "rows" or "time" (self time in microseconds)
+
+        Returns:
+            List[str]: One line per stage path with a non-zero value
+        """
+        if metric not in PROFILE_METRICS:
+            raise ValueError(f"Unknown profile metric: {metric}")
+
+        if metric == "queries":
+            values = dict(self.query_counts)
+        elif metric == "rows":
+            values = dict(self.rows_fetched)
+        else:
+            values = {
+                stage_path: seconds
+                - sum(
+                    child_seconds
+                    for child_path, child_seconds in self.stage_seconds.items()
+                    if child_path[:-1] == stage_path
+                )
+                for stage_path, seconds in self.stage_seconds.items()
+            }
+            values = {
+                stage_path: int(seconds * 1_000_000)
+                for stage_path, seconds in values.items()
+            }
+
+        return [
+            f"{';'.join(stage_path)} {value}"
+            for stage_path, value in sorted(values.items())
+            if value > 0
+        ]
+
+    def write_collapsed_stacks(self, path: str, metric: str = "queries") -> None:
+        """Write the collapsed stacks of a metric to a file."""
+        with open(path, "w") as output:
+            output.write("\n".join(self.collapsed_stacks(metric)) + "\n")
+
+    def summary(self) -> Dict:
+        """Summarize the profiled decisions."""
+        decision_count = len(self.decisions)
+        total_queries = sum(decision["queries"] for decision in self.decisions)
+        return {
+            "decisions": decision_count,
+            "queries_per_decision": (
+                round(total_queries / decision_count, 2) if decision_count else 0.0
+            ),
+            "rows_per_decision": (
+                round(
+                    sum(decision["rows"] for decision in self.decisions)
+                    / decision_count,
+                    2,
+                )
+                if decision_count
+                else 0.0
+            ),
+            "max_queries_by_stage": self.max_queries_by_stage(),
+        }
+
+
+_active_profiler: Optional[ControlLoopProfiler] = None
+
+
+def get_profiler() -> Optional[ControlLoopProfiler]:
+    """Get the active profiler, None if profiling is disabled."""
+    return _active_profiler
+
+
+def enable_profiling() -> ControlLoopProfiler:
+    """Start profiling control decisions with a fresh profiler."""
+    global _active_profiler
+    disable_profiling()
+    _active_profiler = ControlLoopProfiler()
+    _active_profiler.start()
+    return _active_profiler
+
+
+def disable_profiling() -> None:
+    """Stop profiling control decisions."""
+    global _active_profiler
+    if _active_profiler is not None:
+        _active_profiler.stop()
+    _active_profiler = None
+
+
+def profile_decision():
+    """Profile the enclosed control decision if profiling is enabled."""
+    if _active_profiler is None:
+        return contextlib.nullcontext()
+    return _active_profiler.profile_decision()
+
+
+if settings.CONTROL_LOOP_PROFILING:
+    enable_profiling()
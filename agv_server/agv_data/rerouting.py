@@ -0,0 +1,376 @@
+"""
+Rerouting of AGVs that wait too long for a blocked node.
+
+Once an AGV has waited REROUTE_AFTER_WAIT_SECONDS, a new remaining path to the end
+of its current journey phase is searched that avoids every node other AGVs stand
+on or reserved. The search is incremental (D* Lite): every AGV keeps its search
+tree towards its goal, and a replan only repairs the part of the tree affected by
+the nodes that became blocked or free since the last one, so an AGV that keeps
+waiting can be replanned on every report without searching the map again.
+
+With ALTERNATIVE_PATHS_K of 2 or more, the least loaded of the precomputed
+alternatives of the AGV's order leg is tried before searching.
+"""
+
+import datetime
+import heapq
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .main_algorithms.algorithm1.common_nodes import (
+    get_common_nodes_calculator,
+    get_node_loads,
+    update_common_nodes_for_path_change,
+)
+from .metrics import REGISTRY, stage_timer
+from .models import ROUTE_FIELDS, Agv
+from .pathfinding.k_shortest import pick_least_loaded
+
+logger = logging.getLogger(__name__)
+
+INFINITY = float("inf")
+
+REROUTES = REGISTRY.counter(
+    "agv_reroutes_total",
+    "Replans of AGVs that waited too long for a blocked node",
+    label_names=("outcome",),
+)
+
+
+class IncrementalPlanner:
+    """
+    D* Lite search from a moving start towards a fixed goal.
+
+    g and rhs hold the cost of the cheapest path from every node to the goal, the
+    search runs backwards from the goal so the tree stays valid while the AGV moves.
+    Map nodes have no coordinates, so the heuristic is zero; the key modifier of
+    D* Lite is then always zero as well and left out.
+    """
+
+    def __init__(
+        self,
+        adjacency: Dict[int, Set[int]],
+        distances: Dict[Tuple[int, int], float],
+        goal: int,
+    ):
+        self.adjacency = adjacency
+        self.distances = distances
+        self.goal = goal
+        self.blocked: Set[int] = set()
+        self.g: Dict[int, float] = {}
+        self.rhs: Dict[int, float] = {goal: 0}
+        # Lazy deletion: heap entries whose key differs from _queued are stale
+        self._queue: List[Tuple[float, int]] = [(0, goal)]
+        self._queued: Dict[int, float] = {goal: 0}
+
+    def plan(self, start: int, blocked: Iterable[int]) -> Optional[List[int]]:
+        """
+        Find the cheapest path from start to the goal that avoids the blocked nodes.
+        The goal itself is never treated as blocked.
+
+        Args:
+            start: Node the AGV stands on
+            blocked: Nodes that can not be entered
+
+        Returns:
+            Optional[List[int]]: Path from start to the goal, None if there is none
+        """
+        blocked = set(blocked)
+        changed_nodes = self.blocked ^ blocked
+        self.blocked = blocked
+        # Only the cost of edges into a changed node changed
+        for node in changed_nodes:
+            for neighbour in self.adjacency.get(node, ()):
+                self._update_vertex(neighbour)
+
+        self._compute_shortest_path(start)
+        if self.get_cost(start) == INFINITY:
+            return None
+
+        # Follow the cheapest neighbour, the tree is consistent along the path
+        path = [start]
+        while path[-1] != self.goal and len(path) <= len(self.adjacency):
+            node = path[-1]
+            costs = {
+                neighbour: self._cost(node, neighbour) + self.g.get(neighbour, INFINITY)
+                for neighbour in self.adjacency.get(node, ())
+            }
+            next_node = min(costs, key=costs.get, default=None)
+            if next_node is None or costs[next_node] == INFINITY:
+                return None
+            path.append(next_node)
+        return path if path[-1] == self.goal else None
+
+    def get_cost(self, start: int) -> float:
+        """Get the cost of the last planned path from start, INFINITY if there is none."""
+        return self.g.get(start, INFINITY)
+
+    def _cost(self, node: int, neighbour: int) -> float:
+        if neighbour in self.blocked and neighbour != self.goal:
+            return INFINITY
+        return self.distances.get((node, neighbour), INFINITY)
+
+    def _key(self, node: int) -> float:
+        return min(self.g.get(node, INFINITY), self.rhs.get(node, INFINITY))
+
+    def _update_vertex(self, node: int) -> None:
+        if node != self.goal:
+            self.rhs[node] = min(
+                (
+                    self._cost(node, neighbour) + self.g.get(neighbour, INFINITY)
+                    for neighbour in self.adjacency.get(node, ())
+                ),
+                default=INFINITY,
+            )
+        self._queued.pop(node, None)
+        if self.g.get(node, INFINITY) != self.rhs.get(node, INFINITY):
+            key = self._key(node)
+            self._queued[node] = key
+            heapq.heappush(self._queue, (key, node))
+
+    def _top_key(self) -> float:
+        while self._queue:
+            key, node = self._queue[0]
+            if self._queued.get(node) == key:
+                return key
+            heapq.heappop(self._queue)
+        return INFINITY
+
+    def _compute_shortest_path(self, start: int) -> None:
+        while self._queue and (
+            self._top_key() < self._key(start)
+            or self.rhs.get(start, INFINITY) != self.g.get(start, INFINITY)
+        ):
+            if not self._queue:
+                break
+            _, node = heapq.heappop(self._queue)
+            del self._queued[node]
+
+            if self.g.get(node, INFINITY) > self.rhs.get(node, INFINITY):
+                # Overconsistent: the node got cheaper, settle it
+                self.g[node] = self.rhs[node]
+            else:
+                # Underconsistent: the node got more expensive, reopen it
+                self.g[node] = INFINITY
+                self._update_vertex(node)
+            for neighbour in self.adjacency.get(node, ()):
+                self._update_vertex(neighbour)
+
+
+_planners: Dict[int, IncrementalPlanner] = {}
+_planners_lock = threading.Lock()
+_clock: Callable[[], datetime.datetime] = timezone.now
+
+
+def get_planner(agv_id: int, goal: int) -> IncrementalPlanner:
+    """Get the planner of an AGV towards a goal, kept while the goal stays the same."""
+    with _planners_lock:
+        planner = _planners.get(agv_id)
+        if planner is None or planner.goal != goal:
+            calculator = get_common_nodes_calculator()
+            planner = IncrementalPlanner(
+                calculator.adjacent_points, calculator.distances, goal
+            )
+            _planners[agv_id] = planner
+        return planner
+
+
+def reset_planners() -> None:
+    """Drop every cached search tree, e.g. after the map data changed."""
+    with _planners_lock:
+        _planners.clear()
+
+
+def get_time() -> datetime.datetime:
+    """Get the current time, simulated time while the fleet simulator runs."""
+    return _clock()
+
+
+def set_clock(clock: Optional[Callable[[], datetime.datetime]]) -> None:
+    """Replace the clock used to measure waiting times, None for the real clock."""
+    global _clock
+    _clock = clock or timezone.now
+
+
+class ReroutePolicy:
+    """Decides when a waiting AGV is rerouted and replaces its remaining path."""
+
+    def __init__(self, agv: Agv):
+        self.agv = agv
+
+    def should_reroute(self) -> bool:
+        """Check if the AGV has waited longer than REROUTE_AFTER_WAIT_SECONDS."""
+        threshold = settings.REROUTE_AFTER_WAIT_SECONDS
+        return (
+            threshold > 0
+            and self.agv.motion_state == Agv.WAITING
+            and self.agv.waiting_since is not None
+            and not self.agv.waiting_for_deadlock_resolution
+            and self.agv.current_node is not None
+            and not self.agv.has_finished_route_phase()
+            and get_time() - self.agv.waiting_since
+            >= datetime.timedelta(seconds=threshold)
+        )
+
+    def reroute(self) -> bool:
+        """
+        Replace the remaining path of the current journey phase with a path around
+        the nodes of other AGVs, if there is one that is not too long. Common nodes
+        are updated for the AGVs that share a changed node.
+
+        Returns:
+            bool: True if the AGV got a new remaining path
+        """
+        with stage_timer("reroute"):
+            agv = self.agv
+            blocked_nodes = self._get_blocked_nodes()
+            path = self._pick_alternative_path(blocked_nodes)
+            if path is None:
+                path = self._plan_rest_of_phase(blocked_nodes)
+
+            if path is None or len(path) < 2:
+                REROUTES.inc(outcome="no_path")
+                return False
+            new_nodes = path[1:]
+            if new_nodes == agv.remaining_path:
+                REROUTES.inc(outcome="unchanged")
+                return False
+
+            current_cost = self._get_path_cost([agv.current_node, *agv.remaining_path])
+            if (
+                self._get_path_cost(path)
+                > current_cost * settings.REROUTE_MAX_DETOUR_RATIO
+            ):
+                REROUTES.inc(outcome="detour_too_long")
+                return False
+
+            old_path = list(agv.remaining_path)
+            agv.replace_remaining_path(new_nodes)
+            agv.next_node = new_nodes[0]
+            # Backup nodes were allocated for the shared nodes of the old path
+            agv.spare_flag = False
+            agv.backup_nodes = {}
+            # The new path gets the full waiting time before the next replan
+            agv.waiting_since = get_time()
+            agv.save(
+                update_fields=[
+                    *ROUTE_FIELDS,
+                    "next_node",
+                    "spare_flag",
+                    "backup_nodes",
+                    "waiting_since",
+                ]
+            )
+            update_common_nodes_for_path_change(agv, old_path)
+
+        REROUTES.inc(outcome="rerouted")
+        logger.info(
+            f"AGV {agv.agv_id} rerouted after waiting: {old_path} -> {new_nodes}"
+        )
+        return True
+
+    def _plan_rest_of_phase(self, blocked_nodes: Set[int]) -> Optional[List[int]]:
+        """
+        Search a path around the blocked nodes with the AGV's incremental planner.
+        While the storage node of an outbound order is still ahead, only the way to
+        it is replanned and the rest of the journey phase is kept, so the pickup is
+        never skipped.
+
+        Returns:
+            Optional[List[int]]: Path from the current node to the end of the journey
+            phase, None if there is none or the storage node can not be placed
+        """
+        agv = self.agv
+        remaining_path = list(agv.remaining_path)
+        goal, rest_of_phase = remaining_path[-1], []
+
+        order = agv.active_order
+        if order is not None and agv.journey_phase == Agv.OUTBOUND:
+            storage_node = order.storage_node
+            if storage_node in remaining_path:
+                goal = storage_node
+                rest_of_phase = remaining_path[remaining_path.index(storage_node) + 1 :]
+            elif storage_node not in agv.route[: agv.route_cursor]:
+                # Neither ahead nor visited, a new path could skip the pickup
+                return None
+
+        path = get_planner(agv.agv_id, goal).plan(agv.current_node, blocked_nodes)
+        if path is None:
+            return None
+        return path + rest_of_phase
+
+    def _pick_alternative_path(self, blocked_nodes: Set[int]) -> Optional[List[int]]:
+        """
+        Pick the least loaded precomputed alternative of the order leg the AGV is on
+        that passes its current node and avoids the blocked nodes, followed by the
+        rest of the journey phase.
+
+        Returns:
+            Optional[List[int]]: Path from the current node to the end of the journey
+            phase, None if alternatives are disabled or none fits
+        """
+        order = self.agv.active_order
+        if (
+            order is None
+            or settings.ALTERNATIVE_PATHS_K < 2
+            or not self.agv.outbound_path
+            or not self.agv.inbound_path
+        ):
+            return None
+        # Imported here, the dispatcher service resets the planners of this module
+        from .dispatcher_service import get_dispatcher_service
+
+        if self.agv.journey_phase == Agv.OUTBOUND:
+            legs = [
+                (self.agv.outbound_path[0], order.storage_node),
+                (order.storage_node, order.workstation_node),
+            ]
+        else:
+            legs = [(order.workstation_node, self.agv.inbound_path[-1])]
+
+        current_node = self.agv.current_node
+        remaining_path = [current_node, *self.agv.remaining_path]
+        for leg_start, leg_end in legs:
+            if leg_end not in remaining_path:
+                # The AGV already drove this leg
+                continue
+            rest_of_phase = remaining_path[remaining_path.index(leg_end) + 1 :]
+            candidates = []
+            for leg_path in get_dispatcher_service().get_alternative_paths(
+                leg_start, leg_end
+            ):
+                if current_node not in leg_path:
+                    continue
+                path = leg_path[leg_path.index(current_node) :] + rest_of_phase
+                if not blocked_nodes.intersection(path[1:-1]):
+                    candidates.append(path)
+            if not candidates:
+                return None
+            return pick_least_loaded(
+                candidates, get_node_loads(exclude_agv_id=self.agv.agv_id)
+            )
+        return None
+
+    def _get_blocked_nodes(self) -> Set[int]:
+        """Nodes other AGVs stand on or reserved."""
+        blocked = set()
+        for current_node, reserved_node, reserved_segment in Agv.objects.exclude(
+            agv_id=self.agv.agv_id
+        ).values_list("current_node", "reserved_node", "reserved_segment"):
+            blocked.update(reserved_segment or [])
+            blocked.add(current_node)
+            blocked.add(reserved_node)
+        blocked.discard(None)
+        return blocked
+
+    @staticmethod
+    def _get_path_cost(path: List[int]) -> float:
+        distances = get_common_nodes_calculator().distances
+        return sum(
+            distances.get((node, next_node), INFINITY)
+            for node, next_node in zip(path, path[1:])
+        )
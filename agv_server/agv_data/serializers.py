@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Agv
+from .models import ROUTE_FIELDS, Agv
 from order_data.models import Order
 
 
@@ -27,6 +27,10 @@ class AGVSerializer(serializers.ModelSerializer):
 
     # Include order information for API compatibility
     active_order_info = serializers.SerializerMethodField()
+    # Not a model field, the part of the route between its cursor and phase end
+    remaining_path = serializers.ListField(
+        child=serializers.IntegerField(), read_only=True
+    )
 
     def get_active_order_info(self, obj):
         """
@@ -45,3 +49,35 @@ class AGVSerializer(serializers.ModelSerializer):
     class Meta:
         model = Agv
         fields = "__all__"
+
+
+def serialize_agv_fields(agv: Agv, update_fields=None) -> dict:
+    """
+    Serialize an AGV like AGVSerializer, or only the fields behind the given model
+    fields, so a save that touched two fields does not serialize all arrays.
+
+    Args:
+        agv: The AGV instance
+        update_fields: Saved model fields, None for all fields
+
+    Returns:
+        dict: Serialized fields, always including agv_id
+    """
+    serializer = AGVSerializer(agv)
+    if update_fields is None:
+        return dict(serializer.data)
+
+    field_names = set(update_fields) & set(serializer.fields.keys())
+    if "active_order" in update_fields:
+        field_names.add("active_order_info")
+    if set(update_fields) & set(ROUTE_FIELDS):
+        field_names.add("remaining_path")
+
+    data = {"agv_id": agv.agv_id}
+    for field_name in field_names:
+        field = serializer.fields[field_name]
+        attribute = field.get_attribute(agv)
+        data[field_name] = (
+            None if attribute is None else field.to_representation(attribute)
+        )
+    return data
@@ -1 +1,516 @@
-# Create your tests here.
+import random
+from typing import Dict, List, Tuple
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from map_data.services.map_service import MapService
+from order_data.models import Order
+
+from .encode_decode_data_frames.agv_to_server_decoder import (
+    SequenceTracker,
+    decode_batch_message,
+    decode_message,
+    decode_messages,
+    example_batch_frame_from_agv_to_server,
+)
+from .encode_decode_data_frames.calculate_crc import calculate_crc
+from .encode_decode_data_frames.server_to_agv_encoder import (
+    encode_batch_message,
+    encode_message,
+)
+from .direction_change.direction_to_turn import EAST, NORTH, SOUTH, WEST
+from .fleet_simulator import FleetSimulator, build_grid_map
+from .main_algorithms.algorithm1.common_nodes import reset_common_nodes_calculator
+from .main_algorithms.algorithm2.algorithm2 import LookAheadSafetyChecker
+from .management.commands.mqtt_load_test import decode_downlink_commands
+from .pathfinding.dijkstra import Dijkstra
+from .pathfinding.k_shortest import YenKShortestPaths
+from .pathfinding.turn_penalized import TurnPenalizedDijkstra
+from .models import Agv
+from .profiling import disable_profiling, enable_profiling
+from .rerouting import IncrementalPlanner, ReroutePolicy, reset_planners
+
+
+def build_random_grid(
+    rng: random.Random, rows: int, cols: int
+) -> Tuple[List[int], List[Dict]]:
+    """Grid of nodes 1 to rows * cols with random edge distances, as nodes and connections."""
+    nodes = list(range(1, rows * cols + 1))
+    connections = []
+    for index in range(rows * cols):
+        row, col = divmod(index, cols)
+        if col + 1 < cols:
+            connections.append(
+                {"node1": index + 1, "node2": index + 2, "distance": rng.randint(1, 9)}
+            )
+        if row + 1 < rows:
+            connections.append(
+                {
+                    "node1": index + 1,
+                    "node2": index + cols + 1,
+                    "distance": rng.randint(1, 9),
+                }
+            )
+    return nodes, connections
+
+
+def get_path_length(connections: List[Dict], path: List[int]) -> float:
+    distances = {}
+    for connection in connections:
+        distances[(connection["node1"], connection["node2"])] = connection["distance"]
+        distances[(connection["node2"], connection["node1"])] = connection["distance"]
+    return sum(distances[edge] for edge in zip(path, path[1:]))
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class ControlDecisionQueryBudgetTest(TestCase):
+    """
+    Fails when a control decision runs more SQL queries than the budgets in
+    CONTROL_QUERY_BUDGETS allow. Raise a budget only together with the change
+    that needs the extra queries.
+    """
+
+    def setUp(self):
+        # Enough AGVs that a query per AGV exceeds the budgets
+        self.simulator = FleetSimulator(
+            agv_count=16, order_count=32, seed=7, order_interval=2.0
+        )
+        self.simulator.load_map(*build_grid_map(8, 8))
+        self.simulator.setup_fleet()
+        self.profiler = enable_profiling()
+        self.addCleanup(disable_profiling)
+
+    def test_decisions_stay_within_query_budgets(self):
+        self.simulator.run()
+
+        self.assertGreater(len(self.profiler.decisions), 0)
+        violations = self.profiler.budget_violations(settings.CONTROL_QUERY_BUDGETS)
+        self.assertEqual(
+            violations,
+            [],
+            "Stages exceeding their query budget (stage, queries, budget): "
+            f"{violations}\n" + "\n".join(self.profiler.collapsed_stacks("queries")),
+        )
+
+
+class IncrementalPlannerTest(SimpleTestCase):
+    """The repaired D* Lite tree must give the same costs as a search from scratch."""
+
+    def test_plan_matches_dijkstra_while_nodes_are_blocked_and_freed(self):
+        rng = random.Random(11)
+        nodes, connections = build_random_grid(rng, 6, 6)
+        adjacency = {node: set() for node in nodes}
+        distances = {}
+        for connection in connections:
+            node1, node2 = connection["node1"], connection["node2"]
+            adjacency[node1].add(node2)
+            adjacency[node2].add(node1)
+            distances[(node1, node2)] = distances[(node2, node1)] = connection[
+                "distance"
+            ]
+        goal = nodes[-1]
+        planner = IncrementalPlanner(adjacency, distances, goal)
+
+        blocked = set()
+        for _ in range(200):
+            blocked ^= {rng.choice(nodes[:-1])}
+            start = rng.choice([node for node in nodes if node not in blocked])
+
+            path = planner.plan(start, blocked)
+
+            # The start and the goal are never entered through a blocked node
+            open_connections = [
+                connection
+                for connection in connections
+                if connection["node1"] not in blocked
+                and connection["node2"] not in blocked
+            ]
+            expected = Dijkstra(nodes, open_connections).find_shortest_path(start, goal)
+            if not expected:
+                self.assertIsNone(path, f"start {start}, blocked {sorted(blocked)}")
+                continue
+            self.assertIsNotNone(path, f"start {start}, blocked {sorted(blocked)}")
+            self.assertEqual((path[0], path[-1]), (start, goal))
+            self.assertFalse(blocked & set(path))
+            self.assertEqual(
+                get_path_length(connections, path),
+                get_path_length(connections, expected),
+            )
+            self.assertEqual(
+                planner.get_cost(start), get_path_length(connections, expected)
+            )
+
+
+def build_legacy_uplink_frame(agv_id: int, current_node: int) -> bytes:
+    """Version 1 position report, as AGVs build it."""
+    data_for_crc = bytearray([0x09, 0x02])
+    data_for_crc.extend(agv_id.to_bytes(2, byteorder="little"))
+    data_for_crc.extend(current_node.to_bytes(2, byteorder="little"))
+    return bytes([0x7A, *data_for_crc, calculate_crc(data_for_crc), 0x7F])
+
+
+def corrupt(frame: bytes, index: int) -> bytes:
+    """Flip one bit of a frame."""
+    data = bytearray(frame)
+    data[index] ^= 0x10
+    return bytes(data)
+
+
+class FrameCodecTest(SimpleTestCase):
+    """Frames of both protocol versions decode to what was encoded, or not at all."""
+
+    def test_legacy_uplink_round_trip(self):
+        frame = build_legacy_uplink_frame(513, 42)
+
+        self.assertEqual(decode_message(frame), {"agv_id": 513, "current_node": 42})
+        self.assertEqual(decode_messages(frame), [{"agv_id": 513, "current_node": 42}])
+
+    def test_legacy_uplink_crc_rejection(self):
+        frame = build_legacy_uplink_frame(513, 42)
+
+        # Every byte the CRC covers, including the CRC itself
+        for index in range(1, len(frame) - 1):
+            with self.subTest(index=index):
+                with self.assertRaises(ValueError):
+                    decode_message(corrupt(frame, index))
+
+    def test_batch_uplink_round_trip(self):
+        reports = [
+            {"agv_id": 1, "current_node": 300, "sequence": 0},
+            {"agv_id": 2, "current_node": 7, "sequence": 65535},
+            {"agv_id": 700, "current_node": 1, "sequence": 12},
+        ]
+        self.assertEqual(
+            decode_batch_message(example_batch_frame_from_agv_to_server(reports)),
+            reports,
+        )
+
+        unsequenced = [{"agv_id": 3, "current_node": 9}]
+        self.assertEqual(
+            decode_message(example_batch_frame_from_agv_to_server(unsequenced)),
+            unsequenced[0],
+        )
+
+    def test_batch_uplink_crc_rejection(self):
+        frame = example_batch_frame_from_agv_to_server(
+            [
+                {"agv_id": 1, "current_node": 300, "sequence": 5},
+                {"agv_id": 2, "current_node": 7, "sequence": 6},
+            ]
+        )
+
+        for index in range(1, len(frame) - 1):
+            with self.subTest(index=index):
+                with self.assertRaises(ValueError):
+                    decode_batch_message(corrupt(frame, index))
+
+    def test_legacy_downlink_layout(self):
+        frame = encode_message(1, 258, 3)
+        self.assertEqual(len(frame), 9)
+        self.assertEqual(decode_downlink_commands(frame, "agvroute/4"), [(4, 1, 258)])
+        # The CRC leaves a zero remainder over the bytes it covers
+        self.assertEqual(calculate_crc(frame[1:-1]), 0)
+        self.assertNotEqual(calculate_crc(corrupt(frame, 4)[1:-1]), 0)
+
+        frame = encode_message(1, 258, 3, reservation_horizon=255)
+        self.assertEqual((len(frame), frame[1], frame[7]), (10, 0x0A, 255))
+        self.assertEqual(calculate_crc(frame[1:-1]), 0)
+
+        with self.assertRaises(ValueError):
+            encode_message(1, 258, 3, reservation_horizon=256)
+
+    def test_batch_downlink_round_trip(self):
+        commands = [
+            {
+                "agv_id": 1,
+                "motion_state": 1,
+                "reserved_node": 500,
+                "direction_change": 2,
+                "reservation_horizon": 4,
+                "sequence": 65536 + 3,
+            },
+            {
+                "agv_id": 900,
+                "motion_state": 2,
+                "reserved_node": None,
+                "direction_change": 0,
+            },
+        ]
+        frame = encode_batch_message(commands)
+
+        self.assertEqual(
+            decode_downlink_commands(frame, "agvroute/all"),
+            [(1, 1, 500), (900, 2, 0)],
+        )
+        self.assertEqual(calculate_crc(frame[1:-1]), 0)
+        for index in range(1, len(frame) - 1):
+            with self.subTest(index=index):
+                self.assertNotEqual(calculate_crc(corrupt(frame, index)[1:-1]), 0)
+
+
+class YenKShortestPathsTest(SimpleTestCase):
+    """Yen's paths are distinct loopless paths between the two nodes, shortest first."""
+
+    def test_paths_are_loopless_distinct_and_ascending(self):
+        rng = random.Random(5)
+        nodes, connections = build_random_grid(rng, 5, 5)
+        engine = YenKShortestPaths(nodes, connections)
+        edges = {
+            (connection["node1"], connection["node2"]) for connection in connections
+        }
+        edges |= {(node2, node1) for node1, node2 in edges}
+
+        for _ in range(20):
+            start, end = rng.sample(nodes, 2)
+            paths = engine.find_k_shortest_paths(start, end, 8)
+
+            self.assertEqual(len(paths), 8)
+            self.assertEqual(
+                get_path_length(connections, paths[0]),
+                get_path_length(connections, engine.find_shortest_path(start, end)),
+            )
+            self.assertEqual(len({tuple(path) for path in paths}), len(paths))
+            costs = [get_path_length(connections, path) for path in paths]
+            self.assertEqual(costs, sorted(costs))
+            for path in paths:
+                self.assertEqual((path[0], path[-1]), (start, end))
+                self.assertEqual(len(set(path)), len(path), f"loop in {path}")
+                self.assertTrue(set(zip(path, path[1:])) <= edges)
+
+    def test_fewer_paths_than_k_and_unreachable_end(self):
+        nodes = [1, 2, 3, 4]
+        connections = [
+            {"node1": 1, "node2": 2, "distance": 1},
+            {"node1": 2, "node2": 3, "distance": 1},
+            {"node1": 1, "node2": 3, "distance": 3},
+        ]
+        engine = YenKShortestPaths(nodes, connections)
+
+        self.assertEqual(engine.find_k_shortest_paths(1, 3, 5), [[1, 2, 3], [1, 3]])
+        self.assertEqual(engine.find_k_shortest_paths(1, 4, 5), [])
+
+
+class TurnPenalizedDijkstraTest(SimpleTestCase):
+    """
+    Square of unit edges, 1 south-west, 2 south-east, 3 north-east, 4 north-west.
+    Going around it from 2 back to 1 takes three turns instead of one reversal.
+    """
+
+    def setUp(self):
+        self.nodes = [1, 2, 3, 4]
+        self.connections = [
+            {"node1": 1, "node2": 2, "distance": 1},
+            {"node1": 2, "node2": 3, "distance": 1},
+            {"node1": 3, "node2": 4, "distance": 1},
+            {"node1": 4, "node2": 1, "distance": 1},
+        ]
+        self.directions = {
+            (1, 2): EAST,
+            (2, 1): WEST,
+            (2, 3): NORTH,
+            (3, 2): SOUTH,
+            (3, 4): WEST,
+            (4, 3): EAST,
+            (4, 1): SOUTH,
+            (1, 4): NORTH,
+        }
+
+    def build_engine(self, turn_around_penalty: float) -> TurnPenalizedDijkstra:
+        return TurnPenalizedDijkstra(
+            self.nodes,
+            self.connections,
+            directions=self.directions,
+            speed=1.0,
+            turn_penalty=1.0,
+            turn_around_penalty=turn_around_penalty,
+        )
+
+    def test_detour_beats_turning_around_only_if_the_penalty_is_high(self):
+        # Arrived at 2 heading east, driving back to 1 means turning around
+        self.assertEqual(
+            self.build_engine(10.0).find_shortest_path(2, 1, previous_node=1),
+            [2, 3, 4, 1],
+        )
+        self.assertEqual(
+            self.build_engine(2.0).find_shortest_path(2, 1, previous_node=1), [2, 1]
+        )
+        # Without a heading at the start the first edge is never penalized
+        self.assertEqual(self.build_engine(10.0).find_shortest_path(2, 1), [2, 1])
+
+    def test_chain_carries_the_heading_into_the_next_leg(self):
+        engine = self.build_engine(10.0)
+
+        # The second leg starts heading east, as the first one ended
+        self.assertEqual(
+            engine.find_shortest_path_chain([1, 2, 1]), [[1, 2], [2, 3, 4, 1]]
+        )
+        # The heading before the first waypoint is taken from previous_node
+        self.assertEqual(
+            engine.find_shortest_path_chain([2, 1], previous_node=3), [[2, 1]]
+        )
+        self.assertEqual(
+            engine.find_shortest_path_chain([2, 1], previous_node=1), [[2, 3, 4, 1]]
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    REROUTE_MAX_DETOUR_RATIO=2.0,
+)
+class ReroutePolicyTest(TestCase):
+    """
+    3x3 grid, node 1 in the south-west corner:
+
+        7 8 9
+        4 5 6
+        1 2 3
+    """
+
+    def setUp(self):
+        connections_csv, directions_csv = build_grid_map(3, 3)
+        MapService.import_connections(connections_csv)
+        MapService.import_directions(directions_csv)
+        reset_common_nodes_calculator()
+        reset_planners()
+        self.addCleanup(reset_planners)
+
+        now = timezone.localtime()
+        self.order = Order.objects.create(
+            order_id=1,
+            order_date=now.date(),
+            start_time=now.time(),
+            parking_node=1,
+            storage_node=3,
+            workstation_node=5,
+        )
+        self.agv = Agv(
+            agv_id=1,
+            preferred_parking_node=1,
+            current_node=1,
+            active_order=self.order,
+            journey_phase=Agv.OUTBOUND,
+            motion_state=Agv.WAITING,
+            outbound_path=[1, 2, 3, 6, 5],
+            inbound_path=[5, 4, 1],
+        )
+        self.agv.set_route([1, 2, 3, 6, 5, 4, 1], end=5)
+        self.agv.advance_route()
+        self.agv.next_node = 2
+        self.agv.save()
+        # Blocks the way to the storage node
+        Agv.objects.create(agv_id=2, preferred_parking_node=2, current_node=2)
+
+    def test_outbound_reroute_keeps_the_storage_node(self):
+        # Straight to the workstation (1, 4, 5) would skip the pickup at node 3
+        self.assertTrue(ReroutePolicy(self.agv).reroute())
+
+        self.agv.refresh_from_db()
+        self.assertEqual(self.agv.remaining_path, [4, 5, 6, 3, 6, 5])
+        self.assertEqual(self.agv.route[self.agv.route_end :], [4, 1])
+
+    def test_outbound_reroute_without_storage_node_is_refused(self):
+        # The route lost the storage node, a new path could not restore it
+        self.order.storage_node = 8
+        self.order.save()
+
+        self.assertFalse(ReroutePolicy(self.agv).reroute())
+        self.agv.refresh_from_db()
+        self.assertEqual(self.agv.remaining_path, [2, 3, 6, 5])
+
+
+class SequenceTrackerTest(SimpleTestCase):
+    def test_waiting_legacy_agv_is_not_silenced(self):
+        tracker = SequenceTracker(duplicate_window=2.0)
+
+        # A waiting version 1 AGV reports its node every second
+        accepted = [
+            second
+            for second in range(10)
+            if tracker.accept(1, None, now=float(second), current_node=5)[0]
+        ]
+
+        self.assertEqual(accepted, [0, 3, 6, 9])
+
+    def test_legacy_redelivery_and_move_are_told_apart(self):
+        tracker = SequenceTracker(duplicate_window=2.0)
+
+        self.assertEqual(tracker.accept(1, None, now=0.0, current_node=5), (True, None))
+        self.assertEqual(
+            tracker.accept(1, None, now=0.1, current_node=5), (False, "duplicate")
+        )
+        self.assertEqual(tracker.accept(1, None, now=0.2, current_node=6), (True, None))
+        # Another AGV on the same node is tracked on its own
+        self.assertEqual(tracker.accept(2, None, now=0.2, current_node=6), (True, None))
+
+    def test_sequence_numbers_drop_duplicates_and_stale_reports(self):
+        tracker = SequenceTracker()
+
+        self.assertEqual(tracker.accept(1, 65535, now=0.0), (True, None))
+        self.assertEqual(tracker.accept(1, 65535, now=0.1), (False, "duplicate"))
+        # The counter wrapped around
+        self.assertEqual(tracker.accept(1, 1, now=0.2), (True, None))
+        self.assertEqual(tracker.accept(1, 65534, now=0.3), (False, "stale"))
+
+
+class LookAheadSafetyCheckerTest(SimpleTestCase):
+    """
+    Windows map an AGV to its current node followed by the nodes it still needs, and
+    whether its path continues beyond the window.
+    """
+
+    def test_head_on_corridor_is_unsafe(self):
+        # Each AGV needs the node the other one stands on
+        for leaves_horizon in (True, False):
+            windows = {
+                1: ([1, 2, 3], leaves_horizon),
+                2: ([3, 2, 1], leaves_horizon),
+            }
+            self.assertFalse(LookAheadSafetyChecker._is_safe_state(windows))
+
+        # Following each other through the corridor is fine
+        windows = {1: ([1, 2, 3], True), 2: ([2, 3, 4], True)}
+        self.assertTrue(LookAheadSafetyChecker._is_safe_state(windows))
+
+    def test_three_agv_loop_is_unsafe(self):
+        windows = {1: ([1, 2], True), 2: ([2, 3], True), 3: ([3, 1], True)}
+        self.assertFalse(LookAheadSafetyChecker._is_safe_state(windows))
+
+        # AGV 3 leaving the loop frees the node AGV 2 needs, then AGV 1 can go
+        windows[3] = ([3, 4], True)
+        self.assertTrue(LookAheadSafetyChecker._is_safe_state(windows))
+
+    def test_agv_parking_inside_the_window_keeps_its_destination(self):
+        # AGV 1 stops on node 3, which AGV 2 has to drive through
+        windows = {1: ([2, 3], False), 2: ([1, 2, 3, 4], True)}
+        self.assertFalse(LookAheadSafetyChecker._is_safe_state(windows))
+
+        # It only holds its destination, the node it leaves is free again
+        windows = {1: ([2, 3], False), 2: ([1, 2], False)}
+        self.assertTrue(LookAheadSafetyChecker._is_safe_state(windows))
+
+        # Driving on beyond the window releases node 3 as well
+        windows = {1: ([2, 3], True), 2: ([1, 2, 3, 4], True)}
+        self.assertTrue(LookAheadSafetyChecker._is_safe_state(windows))
+
+    def test_reservation_refused_only_if_it_makes_the_state_unsafe(self):
+        # AGV 1 on node 1 wants to drive 2, 3, AGV 2 on node 3 turns off at node 2
+        agv = Agv(agv_id=1, current_node=1, next_node=2, route=[2, 3], route_end=2)
+        checker = LookAheadSafetyChecker(agv, horizon=3)
+
+        with mock.patch.object(
+            checker, "_get_corridor_windows", return_value={2: ([3, 2, 5], True)}
+        ):
+            # AGV 2 can pass before AGV 1 enters node 2, not after
+            self.assertFalse(checker.is_reservation_safe())
+
+        with mock.patch.object(
+            checker, "_get_corridor_windows", return_value={2: ([3, 2, 1], False)}
+        ):
+            # Already a head-on deadlock, refusing would not avoid it, so the
+            # reservation is left to the deadlock resolution
+            self.assertTrue(checker.is_reservation_safe())
@@ -7,6 +7,7 @@ from .views import (
     BulkDeleteAGVsView,
     DispatchOrdersToAGVsView,
     ResetAGVsView,
+    MetricsView,
 )
 
 urlpatterns = [
@@ -21,4 +22,5 @@ urlpatterns = [
         DispatchOrdersToAGVsView.as_view(),
         name="dispatch_orders_to_agvs",
     ),
+    path("metrics/", MetricsView.as_view(), name="agv_metrics"),
 ]
@@ -12,6 +12,11 @@ from asgiref.sync import async_to_sync
 import csv
 import io
 from rest_framework.parsers import MultiPartParser, FormParser
+from django.http import HttpResponse
+from .dispatcher_service import get_dispatcher_service
+from .fleet_state import get_fleet_state
+from .main_algorithms.algorithm1.algorithm1 import ORDER_JOB_TAG
+from .metrics import REGISTRY
 
 
 def send_order_assignment_notification(order_id, agv_id, message, additional_data=None):
@@ -131,12 +136,6 @@ class DispatchOrdersToAGVsView(APIView):
     This replaces the functionality previously in the schedule_generate app.
     """
 
-    def __init__(self):
-        super().__init__()
-        from .main_algorithms.algorithm1.algorithm1 import TaskDispatcher
-
-        self.task_dispatcher = TaskDispatcher()
-
     def post(self, request):
         """
         Schedule orders to be assigned to idle AGVs at their specified start_time and order_date.
@@ -147,37 +146,29 @@ class DispatchOrdersToAGVsView(APIView):
         try:  # Get the algorithm parameter (defaults to dijkstra)
             algorithm = request.data.get("algorithm", "dijkstra")
 
+            # The dispatcher is shared by all requests and rebuilt only when the map changes
+            dispatcher_service = get_dispatcher_service()
+            task_dispatcher = dispatcher_service.get_dispatcher()
+
             # Get all unassigned orders with their scheduling information
-            unassigned_orders = self.task_dispatcher.get_unassigned_orders()
+            unassigned_orders = task_dispatcher.get_unassigned_orders()
 
             if not unassigned_orders.exists():
                 return self._create_no_orders_response()
 
-            # Clear any existing scheduled jobs to avoid duplicates
-            schedule.clear()
+            # Clear any existing scheduled order jobs to avoid duplicates
+            schedule.clear(ORDER_JOB_TAG)
+            get_fleet_state().clear_scheduled_orders()
 
-            # Process orders for scheduling or immediate assignment
+            # Process orders for scheduling or immediate assignment, recalculating
+            # common nodes once after all immediate assignments
             scheduled_orders, immediate_orders = (
-                self.task_dispatcher.process_orders_for_scheduling(algorithm)
+                task_dispatcher.process_orders_for_scheduling(algorithm)
             )
 
-            # Start scheduler if needed
-            # Recalculate common nodes for all active AGVs after immediate assignments
-            self.task_dispatcher.start_scheduler_if_needed(scheduled_orders)
-            if immediate_orders:
-                try:
-                    from .main_algorithms.algorithm1.common_nodes import (
-                        recalculate_all_common_nodes,
-                    )
-
-                    recalculate_all_common_nodes(log_summary=True)
-                    print(
-                        f"Recalculated common nodes for all AGVs after {len(immediate_orders)} immediate assignments"
-                    )
-                except Exception as e:
-                    print(
-                        f"Error recalculating common nodes after immediate assignments: {str(e)}"
-                    )
+            # Start scheduler if needed. Common nodes were already recalculated once
+            # for the whole batch of immediate assignments.
+            dispatcher_service.start_scheduler_if_needed(scheduled_orders)
 
             return self._create_success_response(scheduled_orders, immediate_orders)
 
@@ -251,11 +242,13 @@ class ResetAGVsView(APIView):
                 agv.current_node = None
                 agv.next_node = None
                 agv.reserved_node = None
+                agv.reserved_segment = []
                 agv.motion_state = Agv.IDLE
                 agv.spare_flag = False
                 agv.backup_nodes = {}
+                agv.waiting_since = None
                 agv.initial_path = []
-                agv.remaining_path = []
+                agv.clear_route()
                 agv.common_nodes = []
                 agv.adjacent_common_nodes = []
                 agv.active_order = None
@@ -268,11 +261,15 @@ class ResetAGVsView(APIView):
                         "current_node",
                         "next_node",
                         "reserved_node",
+                        "reserved_segment",
                         "motion_state",
                         "spare_flag",
                         "backup_nodes",
+                        "waiting_since",
                         "initial_path",
-                        "remaining_path",
+                        "route",
+                        "route_cursor",
+                        "route_end",
                         "common_nodes",
                         "adjacent_common_nodes",
                         "active_order",
@@ -462,3 +459,13 @@ class CreateAGVsViaCSVView(APIView):
                 },
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
+
+
+class MetricsView(APIView):
+    """Expose the control loop metrics in the Prometheus text exposition format."""
+
+    def get(self, request):
+        return HttpResponse(
+            REGISTRY.render_prometheus(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
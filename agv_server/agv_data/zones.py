@@ -0,0 +1,161 @@
+"""
+Partitioning of the map into zones for a sharded control loop.
+
+With CONTROL_LOOP_ZONES > 1, one server process (shard) runs per zone, selected
+by CONTROL_LOOP_SHARD. Every shard subscribes to all AGV reports but only
+handles the reports of AGVs standing on a node of its own zone, so each AGV is
+controlled by exactly one shard at a time. Reservations go through the shared
+fleet state (FLEET_STATE_BACKEND=redis), which makes the handoff atomic: when an
+AGV's next node lies in another zone, its current shard reserves that node in
+Redis exactly like a node of its own zone, and the AGV's first report from the
+new zone is handled by the shard owning it.
+"""
+
+import logging
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .fleet_state import REDIS_BACKEND
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+REPORTS_SKIPPED = REGISTRY.counter(
+    "agv_zone_reports_skipped_total",
+    "Position reports left to the shard that owns the reported node",
+)
+ZONE_HANDOFFS = REGISTRY.counter(
+    "agv_zone_handoffs_total",
+    "Reservations of a next node that lies in another shard's zone",
+)
+
+
+def partition_nodes(adjacency: Dict[int, Set[int]], zone_count: int) -> Dict[int, int]:
+    """
+    Split the map graph into zone_count connected-as-possible zones of about equal
+    size, by cutting a breadth-first traversal of the graph into consecutive runs.
+    Deterministic, so every shard computes the same partition.
+
+    Args:
+        adjacency: Neighbours of every node
+        zone_count: Number of zones
+
+    Returns:
+        Dict[int, int]: Zone index (0 based) of every node
+    """
+    traversal: List[int] = []
+    visited: Set[int] = set()
+    for start_node in sorted(adjacency):
+        if start_node in visited:
+            continue
+        # Each connected component is traversed from its smallest node
+        visited.add(start_node)
+        queue = deque([start_node])
+        while queue:
+            node = queue.popleft()
+            traversal.append(node)
+            for neighbour in sorted(adjacency[node]):
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    queue.append(neighbour)
+
+    zone_count = max(1, min(zone_count, len(traversal) or 1))
+    zone_size = -(-len(traversal) // zone_count)
+    return {node: index // zone_size for index, node in enumerate(traversal)}
+
+
+class ZoneMap:
+    """Zone of every map node and the shard this process runs as."""
+
+    def __init__(self, connections: Iterable[Dict], zone_count: int, shard: int):
+        self.adjacency: Dict[int, Set[int]] = {}
+        for connection in connections:
+            node1, node2 = int(connection["node1"]), int(connection["node2"])
+            self.adjacency.setdefault(node1, set()).add(node2)
+            self.adjacency.setdefault(node2, set()).add(node1)
+
+        self.zone_count = zone_count
+        self.shard = shard
+        self.node_zones = partition_nodes(self.adjacency, zone_count)
+
+    def get_zone(self, node: Optional[int]) -> Optional[int]:
+        """Get the zone of a node, None for nodes that are not on the map."""
+        if node is None:
+            return None
+        return self.node_zones.get(node)
+
+    def owns(self, node: Optional[int]) -> bool:
+        """
+        Check if this shard controls AGVs standing on the node. Nodes that are not
+        on the map belong to zone 0, so their reports are not lost.
+        """
+        if self.zone_count <= 1:
+            return True
+        zone = self.get_zone(node)
+        return (zone if zone is not None else 0) == self.shard
+
+    def is_boundary_node(self, node: int) -> bool:
+        """Check if the node has a neighbour in another zone."""
+        zone = self.get_zone(node)
+        return any(
+            self.get_zone(neighbour) != zone
+            for neighbour in self.adjacency.get(node, ())
+        )
+
+
+_zone_map: Optional[ZoneMap] = None
+_zone_map_lock = threading.Lock()
+
+
+def get_zone_map() -> ZoneMap:
+    """Get the zone map of the current map data, built on first use."""
+    global _zone_map
+    with _zone_map_lock:
+        if _zone_map is None:
+            from map_data.models import Connection
+
+            validate_sharding_settings()
+            _zone_map = ZoneMap(
+                Connection.objects.values("node1", "node2"),
+                zone_count=settings.CONTROL_LOOP_ZONES,
+                shard=settings.CONTROL_LOOP_SHARD,
+            )
+            logger.info(
+                f"Control loop shard {_zone_map.shard} of {_zone_map.zone_count} owns "
+                f"{sum(zone == _zone_map.shard for zone in _zone_map.node_zones.values())} nodes"
+            )
+        return _zone_map
+
+
+def reset_zone_map() -> None:
+    """Drop the cached zone map, e.g. after the map data changed."""
+    global _zone_map
+    with _zone_map_lock:
+        _zone_map = None
+
+
+def is_sharded() -> bool:
+    """Check if the control loop is split into several zones."""
+    return settings.CONTROL_LOOP_ZONES > 1
+
+
+def validate_sharding_settings() -> None:
+    """
+    Raises:
+        ImproperlyConfigured: If the shard index is out of range, or several zones
+            are configured without shared fleet state for the handoff
+    """
+    if not 0 <= settings.CONTROL_LOOP_SHARD < max(1, settings.CONTROL_LOOP_ZONES):
+        raise ImproperlyConfigured(
+            f"CONTROL_LOOP_SHARD must be between 0 and CONTROL_LOOP_ZONES - 1, "
+            f"got {settings.CONTROL_LOOP_SHARD}"
+        )
+    if is_sharded() and settings.FLEET_STATE_BACKEND != REDIS_BACKEND:
+        raise ImproperlyConfigured(
+            "A sharded control loop (CONTROL_LOOP_ZONES > 1) needs "
+            f"FLEET_STATE_BACKEND={REDIS_BACKEND} to hand reservations over between zones"
+        )
@@ -169,6 +169,29 @@ CHANNEL_LAYERS = {
     },
 }
 
+# "database" keeps fleet state in the Agv table only (single server process),
+# "redis" shares reservations, path refcounts and scheduled orders between processes
+FLEET_STATE_BACKEND = os.getenv("FLEET_STATE_BACKEND", "database")
+FLEET_STATE_REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+FLEET_STATE_REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+FLEET_STATE_REDIS_DB = int(os.getenv("FLEET_STATE_REDIS_DB", 1))
+FLEET_STATE_KEY_PREFIX = os.getenv("FLEET_STATE_KEY_PREFIX", "agv_fleet")
+
+# Split the control loop into one shard per map zone. Run one server process per
+# shard with CONTROL_LOOP_SHARD = 0 .. CONTROL_LOOP_ZONES - 1 (needs the redis
+# fleet state for reservations that cross zones).
+CONTROL_LOOP_ZONES = int(os.getenv("CONTROL_LOOP_ZONES", 1))
+CONTROL_LOOP_SHARD = int(os.getenv("CONTROL_LOOP_SHARD", 0))
+
+# Which server process consumes AGV reports: "none" (every process, single-process
+# deployments), "redis" (key with TTL) or "postgres" (advisory lock). A standby takes
+# over within MQTT_LEADER_LOCK_TTL_SECONDS plus a third of it.
+MQTT_LEADER_ELECTION = os.getenv("MQTT_LEADER_ELECTION", "none")
+MQTT_LEADER_LOCK_NAME = os.getenv("MQTT_LEADER_LOCK_NAME", "agv_mqtt_leader")
+MQTT_LEADER_LOCK_TTL_SECONDS = float(os.getenv("MQTT_LEADER_LOCK_TTL_SECONDS", 10))
+
+# "paho" connects to MQTT_BROKER, "memory" uses an in-process broker (load testing)
+MQTT_TRANSPORT = os.getenv("MQTT_TRANSPORT", "paho")
 MQTT_BROKER = os.getenv("MQTT_BROKER", "localhost")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_KEEPALIVE = 60
@@ -178,3 +201,127 @@ MQTT_PASSWORD = ""
 MQTT_TOPIC_AGVDATA = "agvdata"
 MQTT_TOPIC_AGVROUTE = "agvroute"
 MQTT_TOPIC_AGVHELLO = "agvhello"
+# Commands for several AGVs decided together are published once on this topic
+# when the version 2 downlink protocol is enabled
+MQTT_TOPIC_AGVROUTE_BROADCAST = "agvroute/all"
+
+# Downlink frame format: 1 sends one fixed 9-byte frame per AGV, 2 sends versioned
+# variable-length frames that batch the commands of several AGVs in one publish
+MQTT_DOWNLINK_PROTOCOL_VERSION = int(os.getenv("MQTT_DOWNLINK_PROTOCOL_VERSION", 1))
+
+# Seconds without a report after which an AGV's uplink sequence numbers are no longer
+# compared, so a restarted AGV is not mistaken for replaying old reports
+AGV_SEQUENCE_RESET_SECONDS = float(os.getenv("AGV_SEQUENCE_RESET_SECONDS", 30))
+
+# Seconds within which a report without sequence number (version 1 firmware) of the
+# node of an AGV's last accepted report is dropped as a redelivery (0 disables it).
+# A waiting AGV that keeps reporting its node gets a decision once per window. Full duplicate and
+# out-of-order protection needs the sequence numbers of version 2 firmware
+AGV_DUPLICATE_POSITION_SECONDS = float(os.getenv("AGV_DUPLICATE_POSITION_SECONDS", 2))
+
+# QoS level per topic (prefix match). QoS 1 avoids the four-packet QoS 2 handshake;
+# AGVs then drop redelivered commands by the sequence number of version 2 frames, so
+# downlink QoS below 2 requires MQTT_DOWNLINK_PROTOCOL_VERSION=2 (checked at startup)
+MQTT_TOPIC_QOS = {
+    MQTT_TOPIC_AGVDATA: int(os.getenv("MQTT_AGVDATA_QOS", 0)),
+    MQTT_TOPIC_AGVROUTE: int(os.getenv("MQTT_AGVROUTE_QOS", 2)),
+}
+
+# Control loop profiling
+# Record SQL queries, rows fetched and time per control decision and stage
+CONTROL_LOOP_PROFILING = os.getenv("CONTROL_LOOP_PROFILING", "False") == "True"
+# Maximum SQL queries a single control decision may run per stage ("decision" for
+# the whole decision), enforced by the regression test in agv_data/tests.py. Each is
+# the worst case of its stage for the test's 16 AGVs plus a small margin: a query
+# per AGV or per path node on top of that exceeds them
+CONTROL_QUERY_BUDGETS = {
+    "decision": 100,
+    # Fixed position and shared nodes updates (18) plus one save per AGV whose
+    # common nodes change when a journey phase ends
+    "update_position": 40,
+    "control_policy": 30,
+    # Head-on resolution (15), or one query per AGV of a loop deadlock chain
+    "deadlock_resolution": 20,
+    "backup_allocation": 5,
+    # One partner AGV and its control policy
+    "deadlock_partners": 35,
+}
+
+# DSPA control policy
+# Number of upcoming nodes of every AGV's remaining path considered by the look-ahead
+# deadlock avoidance check in the control policy (0 disables the check)
+CONTROL_POLICY_LOOKAHEAD_NODES = int(os.getenv("CONTROL_POLICY_LOOKAHEAD_NODES", 0))
+# Maximum number of consecutive free nodes an AGV may reserve ahead in one control
+# decision (1 reserves only the next node, as in the original DSPA control policy).
+# Frames carry it in a single byte, so at most 255 (checked at startup)
+CONTROL_POLICY_RESERVATION_HORIZON = int(
+    os.getenv("CONTROL_POLICY_RESERVATION_HORIZON", 1)
+)
+
+# Log the common nodes summary after one in every N fleet-wide recalculations
+# (per-AGV detail only at DEBUG level)
+COMMON_NODES_SUMMARY_SAMPLE_EVERY = int(
+    os.getenv("COMMON_NODES_SUMMARY_SAMPLE_EVERY", 20)
+)
+
+# Look-ahead horizon of shared-point detection: a node is only a common node of two
+# AGVs if it lies within the next COMMON_NODES_HORIZON_NODES nodes and within
+# COMMON_NODES_HORIZON_SECONDS of travel of both paths (0 disables a limit, both 0
+# compare whole paths as in the original DSPA). Travel time uses AGV_SPEED in
+# distance units per second.
+COMMON_NODES_HORIZON_NODES = int(os.getenv("COMMON_NODES_HORIZON_NODES", 0))
+COMMON_NODES_HORIZON_SECONDS = float(os.getenv("COMMON_NODES_HORIZON_SECONDS", 0))
+AGV_SPEED = float(os.getenv("AGV_SPEED", 1.0))
+
+# Seconds an AGV needs to turn left or right, and to turn around, at a node. Used by
+# the "turn_penalized" pathfinding algorithm to minimize travel time.
+TURN_PENALTY_SECONDS = float(os.getenv("TURN_PENALTY_SECONDS", 2.0))
+TURN_AROUND_PENALTY_SECONDS = float(os.getenv("TURN_AROUND_PENALTY_SECONDS", 5.0))
+
+# Seconds an AGV may wait for a blocked node before it is rerouted around the nodes
+# other AGVs occupy or reserve (0 disables rerouting). A detour is only taken if it
+# is at most REROUTE_MAX_DETOUR_RATIO times as long as the blocked remaining path.
+REROUTE_AFTER_WAIT_SECONDS = float(os.getenv("REROUTE_AFTER_WAIT_SECONDS", 0))
+REROUTE_MAX_DETOUR_RATIO = float(os.getenv("REROUTE_MAX_DETOUR_RATIO", 1.5))
+
+# Number of shortest loopless paths (Yen) precomputed between the stations of every
+# order. With 2 or more, Dijkstra dispatch and rerouting take the alternative the
+# fewest active AGVs pass, among those at most ALTERNATIVE_PATHS_MAX_DETOUR_RATIO
+# times as long as the shortest (1 keeps the single shortest path).
+ALTERNATIVE_PATHS_K = int(os.getenv("ALTERNATIVE_PATHS_K", 1))
+ALTERNATIVE_PATHS_MAX_DETOUR_RATIO = float(
+    os.getenv("ALTERNATIVE_PATHS_MAX_DETOUR_RATIO", 1.25)
+)
+
+# Seconds between checks whether another server process imported a new map, which
+# rebuilds the dispatcher and the caches built from the map. Imports in this process
+# take effect at once (map_data_changed signal), 0 checks on every decision.
+MAP_VERSION_CHECK_SECONDS = float(os.getenv("MAP_VERSION_CHECK_SECONDS", 5))
+
+# Let an AGV that delivered its order at the workstation take the oldest pending
+# order of its parking node (one no idle AGV could take) instead of returning to
+# parking first, if that is shorter. Up to ORDER_CHAINING_CANDIDATES pending orders
+# are checked.
+ORDER_CHAINING = os.getenv("ORDER_CHAINING", "False") == "True"
+ORDER_CHAINING_CANDIDATES = int(os.getenv("ORDER_CHAINING_CANDIDATES", 5))
+
+# How idle AGVs are matched to orders: "parking" only considers the AGVs whose
+# preferred parking node is the order's parking node, "nearest" considers every idle
+# AGV, takes the one closest to the storage node and returns it to its own parking.
+AGV_ASSIGNMENT_MODE = os.getenv("AGV_ASSIGNMENT_MODE", "parking")
+
+# Move idle AGVs to the staging nodes PREPOSITIONING_STAGING_NODES (comma separated,
+# nodes AGVs may wait on without blocking traffic) closest to the storage nodes with
+# the most orders due in the last PREPOSITIONING_WINDOW_SECONDS, every
+# PREPOSITIONING_INTERVAL_SECONDS. Requires AGV_ASSIGNMENT_MODE "nearest", parking
+# mode routes start at the order's parking node.
+PREPOSITIONING = os.getenv("PREPOSITIONING", "False") == "True"
+PREPOSITIONING_STAGING_NODES = [
+    int(node)
+    for node in os.getenv("PREPOSITIONING_STAGING_NODES", "").split(",")
+    if node.strip()
+]
+PREPOSITIONING_WINDOW_SECONDS = float(os.getenv("PREPOSITIONING_WINDOW_SECONDS", 600))
+PREPOSITIONING_INTERVAL_SECONDS = float(
+    os.getenv("PREPOSITIONING_INTERVAL_SECONDS", 10)
+)
@@ -5,6 +5,7 @@ import io
 from typing import List, Dict, Any, TypedDict, Optional
 from ..models import MapData, Connection, Direction
 from ..constants import MapConstants
+from ..signals import map_data_changed
 
 
 class MapResponse(TypedDict):
@@ -78,6 +79,7 @@ class MapService:
             )
 
             Connection.objects.bulk_create(connections)
+            map_data_changed.send(sender=cls)
             return cls._create_success_response(
                 "Connection data imported successfully",
                 connection_count=len(connections),
@@ -104,6 +106,7 @@ class MapService:
             )
 
             Direction.objects.bulk_create(directions)
+            map_data_changed.send(sender=cls)
             return cls._create_success_response(
                 "Direction data imported successfully", direction_count=len(directions)
             )
@@ -173,6 +176,7 @@ class MapService:
             Connection.objects.all().delete()
             Direction.objects.all().delete()
             MapData.objects.all().delete()
+            map_data_changed.send(sender=MapService)
 
             return MapService._create_success_response(
                 "All map data deleted successfully",
@@ -0,0 +1,7 @@
+"""Signals sent by the map data app."""
+
+from django.dispatch import Signal
+
+# Sent after connections or directions were imported or deleted, so caches built
+# from the map (task dispatcher, pathfinding engines, zones) can be refreshed
+map_data_changed = Signal()
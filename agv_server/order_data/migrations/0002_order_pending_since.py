@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-19 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("order_data", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="order",
+            name="pending_since",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -8,6 +8,8 @@ class Order(models.Model):
     parking_node = models.IntegerField()
     storage_node = models.IntegerField()
     workstation_node = models.IntegerField()
+    # Set when no idle AGV could take the order, cleared once an AGV takes it
+    pending_since = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"Order {self.order_id} at {self.start_time} of {self.order_date} / Nodes {self.parking_node} → {self.storage_node} → {self.workstation_node}"
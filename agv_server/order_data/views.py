@@ -114,11 +114,13 @@ class DeleteOrderView(APIView):
         agv.current_node = None
         agv.next_node = None
         agv.reserved_node = None
+        agv.reserved_segment = []
         agv.motion_state = Agv.IDLE
         agv.spare_flag = False
         agv.backup_nodes = {}
+        agv.waiting_since = None
         agv.initial_path = []
-        agv.remaining_path = []
+        agv.clear_route()
         agv.common_nodes = []
         agv.adjacent_common_nodes = []
         agv.active_order = None
@@ -129,11 +131,15 @@ class DeleteOrderView(APIView):
                 "current_node",
                 "next_node",
                 "reserved_node",
+                "reserved_segment",
                 "motion_state",
                 "spare_flag",
                 "backup_nodes",
+                "waiting_since",
                 "initial_path",
-                "remaining_path",
+                "route",
+                "route_cursor",
+                "route_end",
                 "common_nodes",
                 "adjacent_common_nodes",
                 "active_order",
@@ -206,11 +212,13 @@ class BulkDeleteOrdersView(APIView):
             agv.current_node = None
             agv.next_node = None
             agv.reserved_node = None
+            agv.reserved_segment = []
             agv.motion_state = Agv.IDLE
             agv.spare_flag = False
             agv.backup_nodes = {}
+            agv.waiting_since = None
             agv.initial_path = []
-            agv.remaining_path = []
+            agv.clear_route()
             agv.common_nodes = []
             agv.adjacent_common_nodes = []
             agv.active_order = None
@@ -221,11 +229,15 @@ class BulkDeleteOrdersView(APIView):
                     "current_node",
                     "next_node",
                     "reserved_node",
+                    "reserved_segment",
                     "motion_state",
                     "spare_flag",
                     "backup_nodes",
+                    "waiting_since",
                     "initial_path",
-                    "remaining_path",
+                    "route",
+                    "route_cursor",
+                    "route_end",
                     "common_nodes",
                     "adjacent_common_nodes",
                     "active_order",
@@ -29,6 +29,9 @@ export function AlgorithmSelect({
         <SelectGroup>
           <SelectLabel>Algorithms</SelectLabel>
           <SelectItem value="dijkstra">Dijkstra</SelectItem>
+          <SelectItem value="turn_penalized">
+            Dijkstra (turn-penalized)
+          </SelectItem>
         </SelectGroup>
       </SelectContent>
     </Select>
@@ -16,6 +16,7 @@ import { fetchMapData } from "@/services/APIs/mapAPI";
 import { AGV } from "@/types/AGV.types";
 import { MapData } from "@/types/Map.types";
 import { Order } from "@/types/Order.types";
+import { AgvPatchMessage } from "@/types/WebSocket.types";
 import { CalendarPlus, RefreshCcw, Upload } from "lucide-react";
 import { useEffect, useState } from "react";
 import { toast } from "sonner";
@@ -84,32 +85,33 @@ export function PageAGVs() {
       }
     };
 
-    // Setup WebSocket
-    const ws = new WebSocket(WS_URL);
+    // Setup WebSocket: one snapshot, then patches of the changed fields
+    const ws = new WebSocket(`${WS_URL}?protocol=delta`);
+    let lastSequence = 0;
+    let awaitingResync = false;
 
     ws.onopen = () => console.log("WebSocket connection established");
     ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
 
-        if (data.type === "agv_update") {
-          const updatedAgv = data.data;
-
-          setAgvs((prevAgvs) => {
-            const index = prevAgvs.findIndex(
-              (agv) => agv.agv_id === updatedAgv.agv_id,
-            );
-
-            if (index !== -1) {
-              // Update existing AGV
-              const newAgvs = [...prevAgvs];
-              newAgvs[index] = updatedAgv;
-              return newAgvs;
-            } else {
-              // Add new AGV
-              return [...prevAgvs, updatedAgv];
-            }
-          });
+        if (data.type === "agv_snapshot") {
+          lastSequence = data.seq;
+          awaitingResync = false;
+          setAgvs(data.data);
+        } else if (data.type === "agv_patch") {
+          const patch = data as AgvPatchMessage;
+          if (awaitingResync) {
+            return;
+          }
+          if (patch.seq !== lastSequence + 1) {
+            // Missed a patch, ask for a fresh snapshot
+            awaitingResync = true;
+            ws.send(JSON.stringify({ type: "resync" }));
+            return;
+          }
+          lastSequence = patch.seq;
+          setAgvs((prevAgvs) => applyAgvPatch(prevAgvs, patch));
         } else if (data.type === "order_assignment_notification") {
           // Handle order assignment notifications
           const notificationData = data.data;
@@ -326,3 +328,29 @@ export function PageAGVs() {
     </div>
   );
 }
+
+function applyAgvPatch(agvs: AGV[], patch: AgvPatchMessage): AGV[] {
+  const index = agvs.findIndex((agv) => agv.agv_id === patch.agv_id);
+  let patchedAgv = index !== -1 ? { ...agvs[index] } : null;
+
+  for (const operation of patch.ops) {
+    if (operation.op === "add") {
+      patchedAgv = { ...operation.value };
+    } else if (patchedAgv) {
+      const fieldName = operation.path.slice(1) as keyof AGV;
+      patchedAgv = { ...patchedAgv, [fieldName]: operation.value };
+    }
+  }
+
+  if (!patchedAgv) {
+    return agvs;
+  }
+  if (index === -1) {
+    // Add new AGV
+    return [...agvs, patchedAgv];
+  }
+  // Update existing AGV
+  const newAgvs = [...agvs];
+  newAgvs[index] = patchedAgv;
+  return newAgvs;
+}
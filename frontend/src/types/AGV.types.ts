@@ -29,6 +29,7 @@ export interface AGV {
   current_node: number | null;
   next_node: number | null;
   reserved_node: number | null;
+  reserved_segment: number[];
   previous_node: number | null;
   direction_change: number | null;
   motion_state: AGVMotionState;
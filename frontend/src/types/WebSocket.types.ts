@@ -1,3 +1,5 @@
+import { AGV } from "./AGV.types";
+
 export interface WebSocketData {
   car_id: number;
   agv_state: number;
@@ -9,3 +11,21 @@ export interface WebSocketData {
   distance_sum: number;
   distance: number;
 }
+
+// Delta protocol of the AGV consumer (ws/agv-consumer/?protocol=delta)
+export interface AgvSnapshotMessage {
+  type: "agv_snapshot";
+  seq: number;
+  data: AGV[];
+}
+
+export type AgvPatchOperation =
+  | { op: "add"; path: ""; value: AGV }
+  | { op: "replace"; path: `/${string}`; value: unknown };
+
+export interface AgvPatchMessage {
+  type: "agv_patch";
+  seq: number;
+  agv_id: number;
+  ops: AgvPatchOperation[];
+}